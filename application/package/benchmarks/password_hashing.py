@@ -0,0 +1,70 @@
+'''
+Benchmark login throughput and latency of the password hashing service
+
+Simulates concurrent logins (one password verification each) from the
+request threads of a single gunicorn worker for several process pool
+sizes and scrypt costs.
+
+Usage: python benchmarks/password_hashing.py [--threads 4] [--duration 5]
+'''
+import argparse
+import threading
+from time import perf_counter
+from backsite.utils.hashing import PasswordHasher, HashingBusyError, legacy_hash
+
+SALT = "0123456789abcdef0123456789abcdef"
+PASSWORD = "correct horse battery staple"
+
+def run(hasher: PasswordHasher, stored: str, threads: int, duration: float):
+    latencies = []
+    rejected = [0]
+    lock = threading.Lock()
+    deadline = perf_counter() + duration
+
+    def login_loop():
+        while perf_counter() < deadline:
+            start = perf_counter()
+            try:
+                hasher.verify(PASSWORD, SALT, stored)
+            except HashingBusyError:
+                with lock:
+                    rejected[0] += 1
+                continue
+            with lock:
+                latencies.append(perf_counter() - start)
+
+    workers = [threading.Thread(target=login_loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "logins_per_second": count / duration,
+        "p50_ms": latencies[count // 2] * 1000 if count > 0 else 0.0,
+        "p95_ms": latencies[int(count * 0.95)] * 1000 if count > 0 else 0.0,
+        "rejected": rejected[0],
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=4, help="concurrent request threads")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per configuration")
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--log-n", type=int, nargs="+", default=[12, 14, 15])
+    args = parser.parse_args()
+
+    print(f"{'kdf':<16}{'pool':>6}{'logins/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'rejected':>10}")
+    legacy = PasswordHasher(0, args.threads, 1.0, 14, 8, 1)
+    result = run(legacy, legacy_hash(SALT, PASSWORD), args.threads, args.duration)
+    print(f"{'sha512 (legacy)':<16}{'-':>6}{result['logins_per_second']:>12.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['rejected']:>10}")
+    for log_n in args.log_n:
+        for pool_size in args.pool_sizes:
+            hasher = PasswordHasher(pool_size, args.threads * 2, 1.0, log_n, 8, 1)
+            stored = hasher.hash(PASSWORD, SALT)
+            result = run(hasher, stored, args.threads, args.duration)
+            print(f"{'scrypt ln=' + str(log_n):<16}{pool_size:>6}{result['logins_per_second']:>12.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['rejected']:>10}")
+
+if __name__ == "__main__":
+    main()
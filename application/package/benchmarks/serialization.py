@@ -0,0 +1,83 @@
+'''
+Benchmark query count and time of serializing lists of posts
+
+Compares the old per-post serialization (each post lazily loads its author,
+whose full JSON loads groups and permissions) against Post.serialize, both
+on a plain query and on one using Post.load_options(). Contents are left
+out since they come from Elasticsearch.
+
+Runs against an in-memory SQLite database unless --database-url is given.
+
+Usage: python benchmarks/serialization.py [--sizes 1 100 1000] [--posts-per-author 2]
+'''
+import argparse
+from time import perf_counter
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.orm import Session
+from backsite.db.schema import Base, User, Post
+
+def populate(engine, posts: int, posts_per_author: int):
+    authors = max(1, posts // posts_per_author)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"user_id": i + 1, "username": f"user{i}", "email": f"user{i}@example.com", "password_hash": "x", "salt": "s", "user_secret": str(i)}
+            for i in range(authors)
+        ])
+        conn.execute(insert(Post), [
+            {"post_id": i + 1, "title": f"Post {i}", "user_id": i % authors + 1}
+            for i in range(posts)
+        ])
+
+def legacy_json(post) -> dict:
+    return {
+        "post_id": post.post_id,
+        "title": post.title,
+        "author": post.author.json,
+        "timestamp": post.timestamp.isoformat(),
+        "replying_to": post.replying_to,
+    }
+
+STRATEGIES = {
+    "legacy": lambda conn, limit: [legacy_json(post) for post in conn.scalars(select(Post).limit(limit)).all()],
+    "serialize": lambda conn, limit: Post.serialize(conn.scalars(select(Post).limit(limit)).all()),
+    "serialize+options": lambda conn, limit: Post.serialize(conn.scalars(select(Post).options(*Post.load_options()).limit(limit)).all()),
+}
+
+def run(engine, strategy, size: int, repeat: int):
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    event.listen(engine, "before_cursor_execute", count)
+    timings = []
+    try:
+        for _ in range(repeat):
+            queries[0] = 0
+            with Session(engine) as conn:
+                start = perf_counter()
+                strategy(conn, size)
+                timings.append(perf_counter() - start)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    timings.sort()
+    return queries[0], timings[len(timings) // 2] * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", default="sqlite://", help="empty database to fill with test data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--posts-per-author", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the median is reported")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    Base.metadata.create_all(engine)
+    populate(engine, max(args.sizes), args.posts_per_author)
+
+    print(f"{'strategy':<20}{'posts':>8}{'queries':>10}{'ms':>10}")
+    for size in args.sizes:
+        for name, strategy in STRATEGIES.items():
+            queries, milliseconds = run(engine, strategy, size, args.repeat)
+            print(f"{name:<20}{size:>8}{queries:>10}{milliseconds:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+'''
+Benchmark the per-request cost of request body validation
+
+Compares the old requires decorator, which interpreted the schema and
+matched raw regex strings on every request, against the current one,
+which compiles the schema once. Both run inside the same request
+context, whose parsed JSON body Flask caches, so only validation is timed.
+
+Usage: python benchmarks/validation.py [--iterations 100000]
+'''
+import argparse
+from functools import wraps
+from time import perf_counter
+from flask import Flask, request
+from backsite.app.utils import requires, pattern, PASSWORD_REGEX, EMAIL_REGEX, USERNAME_REGEX
+
+def legacy_requires(data_schema, optional=False):
+    '''
+    The decorator as it was before schemas were compiled
+    '''
+    def _requires(f):
+        @wraps(f)
+        def __requires(*args, **kwargs):
+            data = request.get_json()
+            for key in data_schema:
+                if key not in data:
+                    if not optional:
+                        return {"success": False, "msg": f"Missing required key {key}"}, 400
+                    else:
+                        data[key] = ""
+                elif type(data_schema[key]) == type and type(data[key]) != data_schema[key]:
+                    return {"success": False, "msg": f"Expected {key} to be of type {str(data_schema[key].__name__)}"}, 400
+                elif type(data_schema[key]) == tuple:
+                    if callable(data_schema[key][0]):
+                        validation_function = data_schema[key][0]
+                        validation_arguments = data_schema[key][1:]
+                    else:
+                        validation_function = pattern
+                        validation_arguments = data_schema[key]
+                    validation_result = validation_function(*validation_arguments, input=data[key], key=key)
+                    if validation_result != True:
+                        return {"success": False, "msg": validation_result}, 400
+                kwargs[key] = data[key]
+            return f(*args, **kwargs)
+        return __requires
+    return _requires
+
+SCHEMAS = {
+    "types": ({"username": str, "password": str, "secret": str}, {"username": "someuser", "password": "password123", "secret": "abc"}),
+    "regex": ({
+        "username": (USERNAME_REGEX, 'Username must be at least 6 characters long'),
+        "email": (EMAIL_REGEX, 'Email must be in the form XXX@XXX.XXX'),
+        "password": (PASSWORD_REGEX, 'Password must be at least 8 characters long'),
+    }, {"username": "someuser", "email": "someone@example.com", "password": "password123"}),
+}
+
+def view(**kwargs):
+    return kwargs
+
+def run(decorator, schema: dict, iterations: int) -> float:
+    validated = decorator(schema)(view)
+    start = perf_counter()
+    for _ in range(iterations):
+        validated()
+    return (perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    print(f"{'schema':<10}{'legacy us':>12}{'compiled us':>14}{'speedup':>10}")
+    for name, (schema, body) in SCHEMAS.items():
+        with app.test_request_context(method="POST", json=body):
+            legacy = run(legacy_requires, schema, args.iterations)
+            compiled = run(requires, schema, args.iterations)
+        print(f"{name:<10}{legacy:>12.2f}{compiled:>14.2f}{legacy / compiled:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
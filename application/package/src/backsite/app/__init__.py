@@ -6,6 +6,16 @@ from flask import request
 from flask_cors import CORS
 from backsite.app.basic import basic_app
 from backsite.app.user import user_app
+from backsite.app.post import post_app
+from backsite.app.utils import close_request_connection
+from backsite.db.availability import AVAILABILITY_INDEX
+from backsite.utils.hashing import HashingBusyError
+
+def hashing_busy(error):
+    '''
+    Fail fast when password hashing capacity is exhausted
+    '''
+    return {"success": False, "msg": "Server is busy. Please try again later."}, 503
 
 # Create app and set CORS
 def create_application():
@@ -13,6 +23,14 @@ def create_application():
     
     app.register_blueprint(basic_app)
     app.register_blueprint(user_app)
+    app.register_blueprint(post_app)
+
+    # Release the request-scoped DB session once each request finishes
+    app.teardown_appcontext(close_request_connection)
+    app.register_error_handler(HashingBusyError, hashing_busy)
+
+    # Start building this worker's username/email availability index
+    AVAILABILITY_INDEX.start()
     
     CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
     
@@ -1,2 +1,104 @@
 import json
-from flask import Blueprint, request, jsonify
\ No newline at end of file
+from flask import Blueprint, request, jsonify
+from backsite.db.schema import Post
+from backsite.db.search import search_posts, SEARCH_STATISTICS, SEARCH_CACHE
+from backsite.app.utils import get_request_connection
+from backsite.app.user import authorized, get_principal
+
+post_app = Blueprint("post", __name__, template_folder="templates")
+
+TIMELINE_PAGE_SIZE = 20
+TIMELINE_MAX_PAGE_SIZE = 100
+# Reply levels returned by default and at most, and posts per thread response.
+# Larger threads are cut to their first posts, level by level
+THREAD_MAX_DEPTH = 20
+THREAD_MAX_POSTS = 1000
+
+def get_page_size():
+    '''
+    Read the requested page size, None if it isn't valid
+    '''
+    limit = request.args.get("limit", str(TIMELINE_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= TIMELINE_MAX_PAGE_SIZE:
+        return None
+    return int(limit)
+
+def timeline_response(load_page):
+    '''
+    Respond with a page of posts from load_page(conn, cursor, limit)
+    '''
+    limit = get_page_size()
+    if limit is None:
+        return {"success": False, "msg": f"Expected limit to be between 1 and {TIMELINE_MAX_PAGE_SIZE}"}, 400
+    conn = get_request_connection()
+    try:
+        posts, next_cursor = load_page(conn, request.args.get("cursor") or None, limit)
+    except ValueError as e:
+        return {"success": False, "msg": str(e)}, 400
+    return jsonify({
+        "success": True,
+        "posts": Post.serialize(posts, include_content=True),
+        "next_cursor": next_cursor
+    })
+
+@post_app.route("/api/post/timeline", methods=["GET"])
+def timeline():
+    '''
+    Page through every post, newest first
+    '''
+    return timeline_response(lambda conn, cursor, limit: Post.timeline(conn, None, cursor, limit))
+
+@post_app.route("/api/user/<int:user_id>/posts", methods=["GET"])
+def author_timeline(user_id: int):
+    '''
+    Page through a user's posts, newest first
+    '''
+    return timeline_response(lambda conn, cursor, limit: Post.timeline(conn, user_id, cursor, limit))
+
+@post_app.route("/api/post/home", methods=["GET"])
+@authorized()
+def home_timeline():
+    '''
+    Page through posts of the users the session user follows, newest first
+    '''
+    user_id = get_principal().user_id
+    return timeline_response(lambda conn, cursor, limit: Post.home_timeline(conn, user_id, cursor, limit))
+
+@post_app.route("/api/post/<int:post_id>/thread", methods=["GET"])
+def thread(post_id: int):
+    '''
+    Get a post and its replies as a tree, optionally only depth levels deep.
+    truncated is set when the thread had more posts than one response holds
+    '''
+    try:
+        depth = int(request.args.get("depth", str(THREAD_MAX_DEPTH)))
+    except ValueError:
+        depth = None
+    if depth is None or not 0 <= depth <= THREAD_MAX_DEPTH:
+        return {"success": False, "msg": f"Expected depth to be between 0 and {THREAD_MAX_DEPTH}"}, 400
+    tree, truncated = Post.thread(get_request_connection(), post_id, depth, THREAD_MAX_POSTS)
+    if tree is None:
+        return {"success": False, "msg": "Post not found"}, 404
+    return jsonify({"success": True, "post": tree, "truncated": truncated})
+
+@post_app.route("/api/post/search", methods=["GET"])
+def search():
+    '''
+    Page through posts matching the q parameter, best match first
+    '''
+    limit = get_page_size()
+    if limit is None:
+        return {"success": False, "msg": f"Expected limit to be between 1 and {TIMELINE_MAX_PAGE_SIZE}"}, 400
+    try:
+        page = search_posts(request.args.get("q", ""), request.args.get("cursor") or None, limit)
+    except ValueError as e:
+        return {"success": False, "msg": str(e)}, 400
+    return jsonify(dict(page, success=True))
+
+@post_app.route("/api/post/search/stats", methods=["GET"])
+def search_stats():
+    '''
+    Get this worker's search counters and result cache statistics
+    '''
+    cache = dict(SEARCH_CACHE.stats.json, entries=len(SEARCH_CACHE)) if SEARCH_CACHE is not None else None
+    return jsonify({"success": True, "search": SEARCH_STATISTICS.json, "cache": cache})
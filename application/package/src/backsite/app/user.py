@@ -1,8 +1,13 @@
 import json
-from flask import Blueprint, request, jsonify
-from backsite.db.schema import User, Session
-from backsite.db.connection import create_connection
-from backsite.app.utils import requires, pattern, send_rabbitmq_message, optional, log
+from flask import Blueprint, request, jsonify, g
+from sqlalchemy.exc import IntegrityError
+from backsite.db.schema import User, Session, OutboxMessage
+from backsite.db.schema.session import SESSION_TOKEN_MODE
+from backsite.db.schema.follow import follow, unfollow
+from backsite.app.utils import requires, pattern, optional, log
+from backsite.app.utils import get_request_connection
+from backsite.db.principal import PRINCIPAL_CACHE, Principal
+from backsite.db.availability import AVAILABILITY_INDEX
 from backsite.app.utils import PASSWORD_REGEX, EMAIL_REGEX, USERNAME_REGEX
 from functools import wraps
 
@@ -14,10 +19,57 @@ def get_token():
     '''
     return request.cookies.get("session", "")
 
-def get_session_user(conn):
-    token = get_token()
-    session = Session.validate(token, conn)
-    return session.user
+def create_session_token(user: User, conn):
+    '''
+    Start a new session for the user and return its token
+    '''
+    if SESSION_TOKEN_MODE == "signed":
+        return Session.issue_signed(user, conn)
+    s = Session(user_id = user.user_id)
+    conn.add(s)
+    conn.commit()
+    return s.token
+
+def set_session_cookie(response, token: str):
+    response.set_cookie(
+        "session",
+        value = token,
+        httponly = True,
+        max_age = 14 * 60 * 60 * 24
+    )
+
+def get_session():
+    '''
+    Validate the request's session token, looking it up at most once per request
+    '''
+    if "user_session" not in g:
+        g.user_session = Session.validate(get_token(), get_request_connection())
+    return g.user_session
+
+def get_principal():
+    '''
+    Resolve the request's principal, preferring the principal cache over the DB
+    '''
+    if "principal" not in g:
+        token = get_token()
+        if Session.is_signed(token):
+            # Signed tokens are verified without touching the database
+            g.principal = Session.verify_signed(token, get_request_connection())
+            return g.principal
+        principal = PRINCIPAL_CACHE.get(token) if token != "" else None
+        if principal is None:
+            session = get_session()
+            if session is not None:
+                principal = Principal.from_session(session)
+                PRINCIPAL_CACHE.put(token, principal)
+        g.principal = principal
+    return g.principal
+
+def get_session_user():
+    principal = get_principal()
+    if principal is None:
+        return None
+    return get_request_connection().get(User, principal.user_id)
 
 def authorized(required_permissions = []):
     '''
@@ -32,20 +84,14 @@ def authorized(required_permissions = []):
             '''
             Receives arguments intended for decorated function
             '''
-            conn = create_connection()
-            token = get_token()
-            session = Session.validate(token, conn)
-            if session is None:
-                conn.close()
+            principal = get_principal()
+            if principal is None:
                 return {"success": False, "msg": "Unauthorized."}, 401
             
-            user = session.user
             for required in required_permissions:
-                if required not in user.all_permissions:
-                    conn.close()
+                if required not in principal.permissions:
                     return {"success": False, "msg": "Unauthorized."}, 401
 
-            conn.close()
             return f(*args, **kwargs)
         return __authorized
     
@@ -60,31 +106,20 @@ def authenticate(username: str, password: str):
     '''
     Authenticate the user and create a new user session if successful
     '''
-    conn = create_connection()
+    conn = get_request_connection()
     u = User.authenticate(username, password, conn)
 
     if u is None:
-        conn.close()
         return json.dumps({"success": False, "msg": "Invalid username or password"})
     
-    s = Session(user_id = u.user_id)
-
-    conn.add(s)
-    conn.commit()
+    token = create_session_token(u, conn)
 
     response = jsonify({
         "success": True,
         "user": u.json
     })
 
-    response.set_cookie(
-        "session",
-        value = s.token,
-        httponly = True,
-        max_age = 14 * 60 * 60 * 24
-    ),
-
-    conn.close()
+    set_session_cookie(response, token)
 
     return response
 
@@ -95,12 +130,14 @@ def logout():
     Logout the authenticated user
     '''
     token = get_token()
-    conn = create_connection()
-    session = Session.validate(token, conn)
+    conn = get_request_connection()
     
-    conn.delete(session)
-    conn.commit()
-    conn.close()
+    if Session.is_signed(token):
+        Session.revoke_signed(token, conn)
+    else:
+        conn.query(Session).where(Session.token == token).delete()
+        conn.commit()
+        PRINCIPAL_CACHE.invalidate_token(token)
 
     response = jsonify({"success": True})
     response.delete_cookie("session")
@@ -115,27 +152,54 @@ def logout():
 })
 def create_user(username: str, email: str, password: str):
     # Open a database connection and create the user
-    conn = create_connection()
-    # Make sure username and email are unique
-    if User.email_in_use(email):
-        return {"success": False, "msg": f"Email {email} is already in use."}
-    if User.username_in_use(username):
-        return {"success": False, "msg": f"Username {username} is already in use"}
+    conn = get_request_connection()
     # Create user object
     u = User.create_user(username, email, password)
-    # Add it to the database
+    # Add it to the database, the unique constraints keep username and email unique
     conn.add(u)
-    conn.commit()
-    # Trigger job to send verification email
-    job_sent = send_verification_email(u)
-    conn.close()
-    # Return error if we couldn't complete the request
-    if not job_sent:
-        return {"success": False, "msg": "Unable to communicate with backend services. Please try again later."}
+    # Queue the verification email in the same transaction
+    send_verification_email(u, conn)
+    try:
+        conn.commit()
+    except IntegrityError as e:
+        conn.rollback()
+        field = User.conflicting_field(e)
+        if field == "email":
+            return {"success": False, "msg": f"Email {email} is already in use."}
+        if field == "username":
+            return {"success": False, "msg": f"Username {username} is already in use"}
+        raise
+    AVAILABILITY_INDEX.add(username, email)
     # Return success
     return {"success": True, "msg": "User created!"}
 
-def send_verification_email(user: User):
+@user_app.route("/api/user/availability", methods=["GET"])
+def check_availability():
+    '''
+    Check whether a username and/or email address can still be registered
+    '''
+    username = request.args.get("username", "")
+    email = request.args.get("email", "")
+    if username == "" and email == "":
+        return {"success": False, "msg": "Expected a username or email query parameter"}, 400
+    response = {"success": True}
+    if username != "":
+        response["username"] = {
+            "value": username,
+            "available": AVAILABILITY_INDEX.username_available(username, get_request_connection())
+        }
+    if email != "":
+        response["email"] = {
+            "value": email,
+            "available": AVAILABILITY_INDEX.email_available(email, get_request_connection())
+        }
+    return response
+
+def send_verification_email(user: User, conn):
+    '''
+    Queue a verification email through the outbox, it is sent once the
+    connection's transaction commits
+    '''
 
     data = {
         "command": "sendVerificationEmail",
@@ -146,7 +210,7 @@ def send_verification_email(user: User):
         }
     }
 
-    return send_rabbitmq_message(data, "email_jobs")
+    OutboxMessage.enqueue(conn, data, "email_jobs")
 
 @user_app.route('/api/user/verification', methods=["POST"])
 @requires({
@@ -158,19 +222,14 @@ def verify_email(username: str, password: str, secret: str):
     '''
     Authenticate the user and verify their account with the given secret
     '''
-    data = request.get_json()
-    conn = create_connection()
+    conn = get_request_connection()
     u = User.verify(username, password, secret, conn)
 
     if u is None:
-        conn.close()
         return {"success": False, "msg": f"Couldn't verify user {username}"}
 
     # Create new user session
-    s = Session(user_id = u.user_id)
-
-    conn.add(s)
-    conn.commit()
+    token = create_session_token(u, conn)
 
     # Build response
     response = jsonify({
@@ -178,14 +237,7 @@ def verify_email(username: str, password: str, secret: str):
         "user": u.json
     })
     # Set session cookie
-    response.set_cookie(
-        "session",
-        value = s.token,
-        httponly = True,
-        max_age = 14 * 60 * 60 * 24
-    ),
-    # Close connection
-    conn.close()
+    set_session_cookie(response, token)
     # Return response
     return response
 
@@ -200,47 +252,92 @@ def verify_email(username: str, password: str, secret: str):
 def update_user(username: str, email: str, old_password: str, password: str, user_id: str):
     # Open a database connection 
     user_id = int(user_id)
-    conn = create_connection()
-    session_user = get_session_user(conn)
+    conn = get_request_connection()
+    session_user = get_session_user()
     log(f"Session user id: {session_user.user_id}")
     # Verify that we have proper permissions to modify this user
-    if session_user.user_id != user_id and "ModifyUser" not in session_user.all_permissions:
+    if session_user.user_id != user_id and "ModifyUser" not in get_principal().permissions:
         return {"success": False, "msg": f"You do not have the proper permissions to modify this user"}
-    # Lookup user by ID
-    user = conn.query(User).where(User.user_id == user_id).first()
+    # Lookup user by ID, the session user is already loaded in this session
+    user = session_user if session_user.user_id == user_id else conn.get(User, user_id)
     if user is None:
         return {"success": False, "msg": f"Couldn't find user with ID {user_id}"}
-    success = True
-    error_message = ""
-    # Modify username
+    conflict_messages = {
+        "username": f"Couldn't update username, username {username} is already in use. ",
+        "email": f"Couldn't update email address, address {email} is already in use. ",
+    }
+    changes = {}
     if username != "":
-        if not User.username_in_use(username):
-            user.username = username
-        else:
-            error_message += f"Couldn't update username, username {username} is already in use. "
-    # Modify email
+        changes["username"] = username
     if email != "":
-        if not User.email_in_use(email):
-            user.email = email
-            user.verified = False
-        else:
-            error_message += f"Couldn't update email address, address {email} is already in use. "
-    # Modify password
+        changes["email"] = email
+    # Check the current password first, it doesn't need the database
     passwordChangeSuccess = False
     if old_password != "" and password != "":
         passwordChangeSuccess = user.change_password(old_password, password)
         if not passwordChangeSuccess:
+            # Nothing is saved, but still report which values were taken
+            error_message = ""
+            if "username" in changes and User.username_in_use(username, conn):
+                error_message += conflict_messages["username"]
+            if "email" in changes and User.email_in_use(email, conn):
+                error_message += conflict_messages["email"]
             error_message += "Couldn't update password. Check that you provided the correct current password. "
-        success = success and passwordChangeSuccess
-    # Check that all modifications were successful,
-    # Update user in DB and trigger any needed jobs from modification changes
-    if success:
-        if email != "":
-            send_verification_email(user)
-        if passwordChangeSuccess:
-            user.clear_sessions(conn)
-        conn.add(user)
-        conn.commit()
-        conn.close()
-        return {"success": True, "msg": "Changes made successfully"}
-    return {"success": False, "msg": error_message.strip()}
\ No newline at end of file
+            return {"success": False, "msg": error_message.strip()}
+    new_password_hash = user.password_hash if passwordChangeSuccess else None
+    # Write all changes in one statement and let the unique constraints
+    # reject taken values. A rejected value is dropped and the rest retried
+    conflicts = set()
+    while True:
+        for field, value in changes.items():
+            setattr(user, field, value)
+        if "email" in changes:
+            user.verified = False
+        if new_password_hash is not None:
+            user.password_hash = new_password_hash
+        if "email" in changes:
+            send_verification_email(user, conn)
+        try:
+            conn.commit()
+            break
+        except IntegrityError as e:
+            conn.rollback()
+            field = User.conflicting_field(e)
+            if field not in changes:
+                raise
+            conflicts.add(field)
+            del changes[field]
+    if len(conflicts) > 0:
+        log("".join(conflict_messages[field] for field in ("username", "email") if field in conflicts).strip())
+    # Sessions are cleared after the changes are saved
+    if passwordChangeSuccess:
+        user.clear_sessions(conn)
+    AVAILABILITY_INDEX.add(changes.get("username"), changes.get("email"))
+    return {"success": True, "msg": "Changes made successfully"}
+
+@user_app.route("/api/user/<int:user_id>/follow", methods=["POST"])
+@authorized()
+def follow_user(user_id: int):
+    '''
+    Follow another user, their posts show up in the home timeline
+    '''
+    conn = get_request_connection()
+    follower_id = get_principal().user_id
+    if follower_id == user_id:
+        return {"success": False, "msg": "You can't follow yourself"}, 400
+    if conn.get(User, user_id) is None:
+        return {"success": False, "msg": f"Couldn't find user with ID {user_id}"}, 404
+    follow(conn, follower_id, user_id)
+    conn.commit()
+    return {"success": True, "msg": "User followed"}
+
+@user_app.route("/api/user/<int:user_id>/follow", methods=["DELETE"])
+@authorized()
+def unfollow_user(user_id: int):
+    '''
+    Stop following a user
+    '''
+    conn = get_request_connection()
+    unfollow(conn, get_principal().user_id, user_id)
+    conn.commit()
+    return {"success": True, "msg": "User unfollowed"}
@@ -1,15 +1,11 @@
 import re
-import pika
-import os
-import json
-import sys
-from flask import request, jsonify
+from flask import request, jsonify, g
 from typing import Dict, Callable, Tuple
 from functools import wraps
-from traceback import print_exc
 from datetime import datetime
+from backsite.db.connection import create_connection
+from backsite.utils.rabbitmq import PUBLISHER
 
-RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 LOGFILE = "/var/log/backsite.log"
 
 PASSWORD_REGEX = r'^.{8,}$'
@@ -30,48 +26,62 @@ def pattern(regex, failure_message = "", input = "", key = ""):
     
     return True
 
+def compile_validator(key: str, rule):
+    '''
+    Turn one schema entry into a function of the input value that returns
+    an error message, or None if the value is valid
+    '''
+    if type(rule) == type:
+        message = f"Expected {key} to be of type {rule.__name__}"
+        return lambda value: message if type(value) != rule else None
+    if type(rule) != tuple:
+        raise TypeError(f"Unsupported schema entry for {key}: {rule!r}")
+    if callable(rule[0]) and rule[0] is not pattern:
+        # Custom validation function, called with the remaining items as arguments
+        validation_function, validation_arguments = rule[0], rule[1:]
+        def validate(value):
+            result = validation_function(*validation_arguments, input=value, key=key)
+            return result if result != True else None
+        return validate
+    # Regex, with an optional failure message
+    arguments = rule[1:] if rule[0] is pattern else rule
+    fullmatch = re.compile(arguments[0]).fullmatch
+    type_message = f"Expected {key} to be of type string"
+    failure_message = arguments[1] if len(arguments) > 1 and arguments[1] != "" else f"{key} does not match the input requirements"
+    def validate(value):
+        if type(value) != str:
+            return type_message
+        return failure_message if fullmatch(value) is None else None
+    return validate
+
 def requires(data_schema: Dict[str, type | Tuple[Callable | str, ...]], optional=False):
     '''
     Decorator to specify what data is required for an endpoint
-    and automatically handle invalid inputs
-    FIXME: This function has a large cyclomatic complexity. We should try to simplify
+    and automatically handle invalid inputs. Each schema entry is either a
+    type, a (regex, failure message) tuple or a (function, *arguments)
+    tuple. The schema is compiled into validators once, when decorating
     '''
+    validators = [(key, compile_validator(key, rule)) for key, rule in data_schema.items()]
     def _requires(f):
         '''
         Receives pointer to decorated function
         '''
         @wraps(f)
         def __requires(*args, **kwargs):
-            data = request.get_json()
-            # Validate that all required data keys exist
-            for key in data_schema:
-                # Check if key exists
+            data = request.get_json(silent=True)
+            if type(data) != dict:
+                return {"success": False, "msg": "Expected a JSON object in the request body"}, 400
+            for key, validate in validators:
                 if key not in data:
                     if not optional:
                         return {"success": False, "msg": f"Missing required key {key}"}, 400
-                    else:
-                        data[key] = ""
-                # If a required key type is specified, check that the data type matches
-                elif type(data_schema[key]) == type and type(data[key]) != data_schema[key]:
-                    return {"success": False, "msg": f"Expected {key} to be of type {str(data_schema[key].__name__)}"}, 400
-                # If a key validation function is given, check that it returns True
-                elif type(data_schema[key]) == tuple:
-                    # Check if first item in tuple is a function
-                    if callable(data_schema[key][0]):
-                        # If it is, use index 1:end as arguments
-                        validation_function = data_schema[key][0]
-                        validation_arguments = data_schema[key][1:]
-                    else:
-                        # If not, default to the pattern function and use all tuple items as arguments
-                        validation_function = pattern
-                        validation_arguments = data_schema[key]
-                    # Execute the validation function
-                    validation_result = validation_function(*validation_arguments, input=data[key], key=key)
-                    if validation_result != True:
-                        return {"success": False, "msg": validation_result}, 400
-                # Add required keys to kwargs
+                    # Missing optional keys are passed on as empty strings
+                    kwargs[key] = ""
+                    continue
+                error = validate(data[key])
+                if error is not None:
+                    return {"success": False, "msg": error}, 400
                 kwargs[key] = data[key]
-            # Call function
             return f(*args, **kwargs)
         # Return inner function
         return __requires
@@ -81,23 +91,30 @@ def requires(data_schema: Dict[str, type | Tuple[Callable | str, ...]], optional
 def optional(data_schema: Dict[str, type | Tuple[Callable | str, ...]]):
     return requires(data_schema, optional=True)
 
-def send_rabbitmq_message(data, queue_name):
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=RABBITMQ_HOST))
-        channel = connection.channel()
+def get_request_connection():
+    '''
+    Return the database session bound to the current request,
+    opening it on first use. It is closed when the request ends
+    '''
+    if "db_connection" not in g:
+        g.db_connection = create_connection()
+    return g.db_connection
 
-        channel.queue_declare(queue=queue_name)
+def close_request_connection(exception = None):
+    '''
+    Teardown handler that releases the request's database session
+    '''
+    conn = g.pop("db_connection", None)
+    if conn is not None:
+        conn.close()
 
-        channel.basic_publish(exchange='', routing_key=queue_name, body=json.dumps(data))
-        print(f"Sent data through queue {queue_name}. Data sent: {data}")
-        connection.close()
-    except Exception as e:
-        print(f"Error while trying to send message to RabbitMQ: {e}")
-        print_exc()
-        sys.stdout.flush()
+def send_rabbitmq_message(data, queue_name):
+    '''
+    Publish a message through this worker's persistent RabbitMQ publisher
+    '''
+    if not PUBLISHER.publish(data, queue_name):
         return False
-    
+    print(f"Sent data through queue {queue_name}. Data sent: {data}")
     return True
 
 def log(content):
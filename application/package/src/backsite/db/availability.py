@@ -0,0 +1,157 @@
+'''
+Per-worker index answering "is this username/email free?"
+
+Usernames and emails are kept in a Bloom filter. A miss means the value
+is definitely free and is answered without touching the database; a hit
+falls back to an indexed lookup. The filter only ever gains values, so a
+renamed user's old name costs a fallback query until the next rebuild.
+Users created by other workers are picked up every refresh interval, so
+answers are advisory; the unique constraints remain the source of truth
+'''
+import os
+import threading
+from time import monotonic
+from traceback import print_exc
+from sqlalchemy import select
+from backsite.db.connection import create_connection
+from backsite.db.schema import User
+from backsite.utils.bloom import BloomFilter
+
+AVAILABILITY_CAPACITY = int(os.getenv("AVAILABILITY_CAPACITY", "1000000"))
+AVAILABILITY_ERROR_RATE = float(os.getenv("AVAILABILITY_ERROR_RATE", "0.01"))
+# Pick up users created by other workers
+AVAILABILITY_REFRESH_INTERVAL = float(os.getenv("AVAILABILITY_REFRESH_INTERVAL", "30"))
+# Drop stale values (renamed users) and resize the filter if it filled up
+AVAILABILITY_REBUILD_INTERVAL = float(os.getenv("AVAILABILITY_REBUILD_INTERVAL", "3600"))
+STREAM_BATCH_SIZE = 5000
+
+def normalize(kind: str, value: str) -> str:
+    return f"{kind}:{value.strip().lower()}"
+
+class AvailabilityIndex:
+    '''
+    Bloom filter over normalized usernames and emails of every user
+    '''
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = None
+        self.max_user_id = 0
+        self.definitely_free = 0
+        self.fallbacks = 0
+        self.false_positives = 0
+        self._next_refresh = 0.0
+        self._next_rebuild = 0.0
+        self._lock = threading.Lock()
+
+    def _stream_users(self, conn, after_user_id: int = 0):
+        statement = select(User.user_id, User.username, User.email).where(
+            User.user_id > after_user_id
+        ).execution_options(yield_per=STREAM_BATCH_SIZE)
+        for row in conn.execute(statement):
+            yield row
+
+    def rebuild(self):
+        '''
+        Build a new filter by streaming every user, then swap it in
+        '''
+        conn = create_connection()
+        try:
+            count = conn.query(User.user_id).count()
+            new_filter = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+            max_user_id = 0
+            for user_id, username, email in self._stream_users(conn):
+                new_filter.add(normalize("username", username))
+                new_filter.add(normalize("email", email))
+                max_user_id = max(max_user_id, user_id)
+        finally:
+            conn.close()
+        self.filter = new_filter
+        self.max_user_id = max_user_id
+        self._next_refresh = monotonic() + AVAILABILITY_REFRESH_INTERVAL
+        self._next_rebuild = monotonic() + AVAILABILITY_REBUILD_INTERVAL
+        print(f"Availability index built: {new_filter.json}")
+
+    def refresh(self):
+        '''
+        Add users created since the last build or refresh
+        '''
+        conn = create_connection()
+        try:
+            for user_id, username, email in self._stream_users(conn, self.max_user_id):
+                self.add(username, email)
+                self.max_user_id = max(self.max_user_id, user_id)
+        finally:
+            conn.close()
+        self._next_refresh = monotonic() + AVAILABILITY_REFRESH_INTERVAL
+
+    def maintain(self):
+        '''
+        Refresh or rebuild the filter when due. Only one thread does the work,
+        others keep using the current filter
+        '''
+        now = monotonic()
+        if now < self._next_refresh:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.filter is None or now >= self._next_rebuild:
+                self.rebuild()
+            elif now >= self._next_refresh:
+                self.refresh()
+        except Exception as e:
+            print(f"Error maintaining availability index: {e}")
+            print_exc()
+            self._next_refresh = monotonic() + AVAILABILITY_REFRESH_INTERVAL
+        finally:
+            self._lock.release()
+
+    def start(self):
+        '''
+        Build or refresh the filter in the background so neither worker
+        startup nor requests wait on it. Until the first build finishes
+        every check falls back to the database
+        '''
+        if monotonic() >= self._next_refresh and not self._lock.locked():
+            threading.Thread(target=self.maintain, daemon=True).start()
+
+    def add(self, username: str = None, email: str = None):
+        bloom = self.filter
+        if bloom is None:
+            return
+        if username:
+            bloom.add(normalize("username", username))
+        if email:
+            bloom.add(normalize("email", email))
+
+    def _available(self, kind: str, value: str, in_use, conn) -> bool:
+        self.start()
+        bloom = self.filter
+        if bloom is not None and normalize(kind, value) not in bloom:
+            self.definitely_free += 1
+            return True
+        self.fallbacks += 1
+        available = not in_use(value, conn)
+        if available and bloom is not None:
+            self.false_positives += 1
+        return available
+
+    def username_available(self, username: str, conn = None) -> bool:
+        return self._available("username", username, User.username_in_use, conn)
+
+    def email_available(self, email: str, conn = None) -> bool:
+        return self._available("email", email, User.email_in_use, conn)
+
+    @property
+    def stats(self) -> dict:
+        bloom = self.filter
+        return {
+            "ready": bloom is not None,
+            "filter": bloom.json if bloom is not None else None,
+            "definitely_free": self.definitely_free,
+            "fallbacks": self.fallbacks,
+            "false_positives": self.false_positives,
+        }
+
+AVAILABILITY_INDEX = AvailabilityIndex(AVAILABILITY_CAPACITY, AVAILABILITY_ERROR_RATE)
@@ -1,6 +1,10 @@
 import os
-from sqlalchemy import create_engine
+import threading
+from time import perf_counter
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 
 DATABASE_NAME = os.environ.get("POSTGRES_DB_NAME", "backsite")
 DATABASE_HOST = os.environ.get("POSTGRES_HOST", "db")
@@ -8,14 +12,156 @@ DATABASE_PORT = os.environ.get("POSTGRES_PORT", "5432")
 DATABASE_USERNAME = os.environ.get("POSTGRES_USER", "backsite")
 DATABASE_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "backsite")
 
+# Connection pool tuning. Each gunicorn worker process owns one pool, so the
+# worst case number of Postgres connections is workers * (size + overflow)
+POOL_SIZE = int(os.environ.get("POSTGRES_POOL_SIZE", "5"))
+POOL_MAX_OVERFLOW = int(os.environ.get("POSTGRES_POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.environ.get("POSTGRES_POOL_TIMEOUT", "30"))
+POOL_RECYCLE = int(os.environ.get("POSTGRES_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.environ.get("POSTGRES_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+class PoolStatistics:
+    '''
+    Thread-safe counters describing how the connection pool is being used
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def increment(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def json(self) -> dict:
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "total_wait_seconds": self.total_wait,
+                "average_wait_seconds": self.total_wait / self.checkouts if self.checkouts > 0 else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+POOL_STATISTICS = PoolStatistics()
+
+class InstrumentedQueuePool(QueuePool):
+    '''
+    QueuePool that records how long callers wait for a connection
+    '''
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            POOL_STATISTICS.record_wait(perf_counter() - start, timed_out=True)
+            raise
+        POOL_STATISTICS.record_wait(perf_counter() - start)
+        return connection
+
+def _register_pool_events(engine):
+    '''
+    Attach listeners that feed the pool statistics
+    '''
+    event.listen(engine, "connect", lambda *args: POOL_STATISTICS.increment("connects"))
+    event.listen(engine, "checkout", lambda *args: POOL_STATISTICS.increment("checkouts"))
+    event.listen(engine, "checkin", lambda *args: POOL_STATISTICS.increment("checkins"))
+    event.listen(engine, "invalidate", lambda *args: POOL_STATISTICS.increment("invalidations"))
+
 def create_sql_engine():
+    '''
+    Build a new engine. Most callers should use get_sql_engine() instead,
+    which shares a single engine (and pool) per process
+    '''
     db_string = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
 
-    db = create_engine(db_string)
+    db = create_engine(
+        db_string,
+        poolclass=InstrumentedQueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_timeout=POOL_TIMEOUT,
+        pool_recycle=POOL_RECYCLE,
+        pool_pre_ping=POOL_PRE_PING,
+    )
+    _register_pool_events(db)
 
     return db
 
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+def _reset_after_fork():
+    '''
+    Drop the parent's engine in a forked child without closing the
+    parent's sockets. The child lazily builds its own engine on first use
+    '''
+    global _engine, _engine_pid, _engine_lock
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _engine = None
+    _engine_pid = None
+    _engine_lock = threading.Lock()
+    POOL_STATISTICS.reset()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def get_sql_engine():
+    '''
+    Return the engine shared by this process, creating it on first use
+    '''
+    global _engine, _engine_pid
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+    with _engine_lock:
+        if _engine is None or _engine_pid != pid:
+            if _engine is not None:
+                # Inherited from a parent process, don't touch its connections
+                _engine.dispose(close=False)
+            _engine = create_sql_engine()
+            _engine_pid = pid
+    return _engine
+
+def get_pool_metrics() -> dict:
+    '''
+    Return checkout counts, wait times and current occupancy of this process' pool
+    '''
+    metrics = POOL_STATISTICS.json
+    engine = _engine if _engine_pid == os.getpid() else None
+    if engine is not None:
+        pool = engine.pool
+        metrics.update({
+            "pool_size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+        })
+    return metrics
+
 def create_connection():
-    db = create_sql_engine()
+    db = get_sql_engine()
 
-    return Session(db)
\ No newline at end of file
+    return Session(db)
@@ -0,0 +1,76 @@
+'''
+Process-wide Elasticsearch client
+'''
+import os
+import threading
+from time import sleep
+from elasticsearch import Elasticsearch
+
+ELASTIC_HOST = os.getenv("ELASTIC_HOST", "elastic")
+ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD", "backsite")
+# HTTP connections kept open per node, enough for every request thread
+ELASTIC_MAX_CONNECTIONS = int(os.getenv("ELASTIC_MAX_CONNECTIONS", "10"))
+ELASTIC_TIMEOUT = float(os.getenv("ELASTIC_TIMEOUT", "10"))
+# _bulk item statuses worth retrying, Elasticsearch is shedding load
+RETRYABLE_STATUSES = (429, 503)
+
+class BulkIndexError(Exception):
+    pass
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def create_elastic_client() -> Elasticsearch:
+    '''
+    Create a new client with its own connection pool
+    '''
+    return Elasticsearch(
+        f"https://{ELASTIC_HOST}:9200",
+        http_auth=("elastic", ELASTIC_PASSWORD),
+        verify_certs=False,
+        maxsize=ELASTIC_MAX_CONNECTIONS,
+        timeout=ELASTIC_TIMEOUT
+    )
+
+def get_elastic_connection() -> Elasticsearch:
+    '''
+    Return the client shared by this process, creating it on first use.
+    The client is thread-safe and keeps its HTTPS connections alive
+    '''
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            # A client inherited from a parent process shares its sockets, start over
+            _client = create_elastic_client()
+            _client_pid = pid
+    return _client
+
+def bulk_index(es, index: str, documents: list, id_field: str = "post_id", max_retries: int = 5):
+    '''
+    Index documents with one _bulk request, retrying the ones rejected for
+    load with exponential backoff. Raises BulkIndexError for the rest
+    '''
+    for attempt in range(max_retries + 1):
+        lines = []
+        for document in documents:
+            lines.append({"index": {"_index": index, "_id": document[id_field]}})
+            lines.append(document)
+        response = es.bulk(body=lines)
+        if not response["errors"]:
+            return
+        retry = []
+        for document, item in zip(documents, response["items"]):
+            result = item["index"]
+            if result.get("status", 200) in RETRYABLE_STATUSES:
+                retry.append(document)
+            elif "error" in result:
+                raise BulkIndexError(f"Failed to index document {document[id_field]}: {result['error']}")
+        documents = retry
+        if len(documents) == 0:
+            return
+        sleep(0.5 * 2 ** attempt)
+    raise BulkIndexError(f"Elasticsearch kept rejecting {len(documents)} documents")
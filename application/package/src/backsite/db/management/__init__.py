@@ -1,7 +1,9 @@
+from sqlalchemy import inspect, text
 from sqlalchemy_utils import database_exists, create_database
 # Import all tables we want to create below
 from backsite.db.schema import User, Session, Permission, Group, Post
 from backsite.db.schema import user_permissions, group_permissions, user_groups
+from backsite.db.schema import user_effective_permissions, refresh_effective_permissions
 # Import Base and DBSession
 from backsite.db.schema import DBSession, Base
 from backsite.db.connection import create_sql_engine
@@ -17,4 +19,44 @@ def initialize_db():
     create_db(engine)
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    Base.metadata.create_all(engine)
+
+def ensure_indexes(engine):
+    '''
+    Create indexes added to tables that already existed, which create_all skips
+    '''
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def ensure_columns(engine):
+    '''
+    Add nullable columns added to tables that already existed, which create_all skips
+    '''
+    insp = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in insp.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            print(f"Adding column {table.name}.{column.name}...")
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(engine.dialect)}"
+                ))
+
+def upgrade_db():
+    '''
+    Create any tables, columns and indexes added since the database was initialized and backfill them
+    '''
+    engine = create_sql_engine()
+    insp = inspect(engine)
+    backfill_permissions = not insp.has_table(user_effective_permissions.name)
+    Base.metadata.create_all(engine)
+    ensure_columns(engine)
+    ensure_indexes(engine)
+    if backfill_permissions:
+        print("Backfilling effective user permissions...")
+        with engine.begin() as conn:
+            refresh_effective_permissions(conn)
@@ -0,0 +1,244 @@
+'''
+Bulk import of posts from an NDJSON file
+
+Each line is a JSON object with "author_id" and "content", and optionally
+"title", "timestamp" (ISO 8601) and "replying_to" (the id of a post that
+already exists). Lines are read in chunks. Every chunk reserves its post
+ids in one query, is written to Postgres with COPY in one transaction and
+is then indexed with parallel _bulk requests. Imported posts skip the
+outbox, so they aren't fanned out to home timelines.
+
+The checkpoint file records how far the import got. A chunk's reserved
+ids are saved before it is written, so an interrupted import can be run
+again with the same arguments and picks up where it stopped without
+duplicating posts.
+
+Usage: python -m backsite.db.management.import_posts posts.ndjson [--checkpoint posts.ndjson.checkpoint]
+'''
+import io
+import os
+import sys
+import json
+import argparse
+from time import perf_counter
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, text
+from backsite.db.connection import get_sql_engine
+from backsite.db.elastic import get_elastic_connection, bulk_index
+from backsite.db.schema import User, Post
+from backsite.db.search import POST_INDEX, post_document
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+# Documents per _bulk request, and _bulk requests in flight
+IMPORT_BULK_SIZE = int(os.getenv("IMPORT_BULK_SIZE", "1000"))
+IMPORT_INDEX_WORKERS = int(os.getenv("IMPORT_INDEX_WORKERS", "4"))
+
+RESERVE_POST_IDS = text('''
+    SELECT nextval(pg_get_serial_sequence('post', 'post_id')) FROM generate_series(1, :count)
+''')
+COPY_POSTS = "COPY post (post_id, title, timestamp, user_id, replying_to, content) FROM STDIN"
+
+class PostImportError(Exception):
+    pass
+
+def load_checkpoint(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"offset": 0, "line": 0, "pending": None, "imported": 0, "skipped": 0}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_checkpoint(path: str, checkpoint: dict):
+    '''
+    Replace the checkpoint file atomically, so a crash leaves the old or the new one
+    '''
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def parse_record(line: bytes) -> dict:
+    '''
+    Return the post described by an input line, or raise ValueError
+    '''
+    data = json.loads(line)
+    if type(data) != dict:
+        raise ValueError("Expected a JSON object")
+    if type(data.get("author_id")) != int:
+        raise ValueError("Expected author_id to be of type int")
+    if type(data.get("content")) != str:
+        raise ValueError("Expected content to be of type str")
+    if type(data.get("title", "")) not in (str, type(None)):
+        raise ValueError("Expected title to be of type str")
+    if type(data.get("replying_to")) not in (int, type(None)):
+        raise ValueError("Expected replying_to to be of type int")
+    # Postgres text can't hold NUL, COPY would reject the whole chunk
+    if "\x00" in data["content"] or "\x00" in (data.get("title") or ""):
+        raise ValueError("Title and content can't contain NUL characters")
+    timestamp = datetime.fromisoformat(data["timestamp"]) if data.get("timestamp") is not None else datetime.utcnow()
+    if timestamp.tzinfo is not None:
+        # Stored as naive UTC, like every other post timestamp
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return {
+        "title": data.get("title"),
+        "content": data["content"],
+        "timestamp": timestamp,
+        "author_id": data["author_id"],
+        "replying_to": data.get("replying_to"),
+    }
+
+def read_chunk(f, size: int):
+    '''
+    Read up to size valid records from the file's current position.
+    Returns (records, lines read, invalid line numbers with their error)
+    '''
+    records = []
+    lines = 0
+    invalid = []
+    while len(records) < size:
+        line = f.readline()
+        if not line:
+            break
+        lines += 1
+        if not line.strip():
+            continue
+        try:
+            records.append(parse_record(line))
+        except (ValueError, TypeError) as e:
+            invalid.append((lines, str(e)))
+    return records, lines, invalid
+
+def filter_references(conn, records: list):
+    '''
+    Drop records whose author or replied-to post doesn't exist, which the
+    foreign keys would reject along with the whole chunk. Returns the
+    remaining records and the usernames of their authors
+    '''
+    author_ids = {record["author_id"] for record in records}
+    usernames = dict(conn.execute(select(User.user_id, User.username).where(User.user_id.in_(author_ids))).all())
+    parent_ids = {record["replying_to"] for record in records if record["replying_to"] is not None}
+    parents = set(conn.scalars(select(Post.post_id).where(Post.post_id.in_(parent_ids))).all()) if len(parent_ids) > 0 else set()
+    valid = [
+        record for record in records
+        if record["author_id"] in usernames and (record["replying_to"] is None or record["replying_to"] in parents)
+    ]
+    return valid, usernames
+
+def reserve_post_ids(conn, count: int) -> list:
+    return conn.scalars(RESERVE_POST_IDS, {"count": count}).all()
+
+def copy_value(value) -> str:
+    '''
+    Format a value for COPY's text format
+    '''
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def copy_posts(conn, records: list, post_ids: list):
+    '''
+    Write the records to the post table with a single COPY
+    '''
+    buffer = io.StringIO()
+    for post_id, record in zip(post_ids, records):
+        row = (post_id, record["title"], record["timestamp"], record["author_id"], record["replying_to"], record["content"])
+        buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(COPY_POSTS, buffer)
+    finally:
+        cursor.close()
+
+def index_documents(executor, documents: list, bulk_size: int):
+    es = get_elastic_connection()
+    batches = [documents[start:start + bulk_size] for start in range(0, len(documents), bulk_size)]
+    for future in [executor.submit(bulk_index, es, POST_INDEX, batch) for batch in batches]:
+        future.result()
+
+def import_posts(path: str, checkpoint_path: str, chunk_size: int = IMPORT_CHUNK_SIZE,
+                 bulk_size: int = IMPORT_BULK_SIZE, index_workers: int = IMPORT_INDEX_WORKERS):
+    '''
+    Import the posts in an NDJSON file, resuming from the checkpoint file if it exists
+    '''
+    engine = get_sql_engine()
+    checkpoint = load_checkpoint(checkpoint_path)
+    start = perf_counter()
+    imported = 0
+    with open(path, "rb") as f, ThreadPoolExecutor(max_workers=index_workers) as executor:
+        f.seek(checkpoint["offset"])
+        line_number = checkpoint.get("line", 0)
+        while True:
+            records, lines, invalid = read_chunk(f, chunk_size)
+            for number, error in invalid:
+                print(f"Skipping line {line_number + number}: {error}")
+            if lines == 0:
+                break
+            parsed = len(records)
+            with engine.connect() as conn:
+                records, usernames = filter_references(conn, records)
+            if len(records) < parsed:
+                print(f"Skipping {parsed - len(records)} posts whose author or replied-to post doesn't exist")
+            skipped = len(invalid) + parsed - len(records)
+            pending = checkpoint["pending"]
+            if pending is not None:
+                # Resuming a chunk that may have been written already
+                post_ids = pending["post_ids"]
+                if pending["end"] != f.tell():
+                    raise PostImportError("The interrupted import used a different chunk size, resume it with the same one")
+                if len(post_ids) != len(records):
+                    raise PostImportError("Authors or posts referenced by the interrupted chunk changed, can't resume it")
+                with engine.connect() as conn:
+                    written = conn.scalar(select(Post.post_id).where(Post.post_id.in_(post_ids[:1]))) is not None
+            else:
+                with engine.begin() as conn:
+                    post_ids = reserve_post_ids(conn, len(records)) if len(records) > 0 else []
+                checkpoint["pending"] = {"end": f.tell(), "post_ids": post_ids}
+                save_checkpoint(checkpoint_path, checkpoint)
+                written = False
+            if not written and len(records) > 0:
+                with engine.begin() as conn:
+                    copy_posts(conn, records, post_ids)
+            index_documents(executor, [
+                post_document(post_id, record["title"], record["timestamp"], record["author_id"], usernames[record["author_id"]], record["replying_to"], record["content"])
+                for post_id, record in zip(post_ids, records)
+            ], bulk_size)
+
+            line_number += lines
+            imported += len(records)
+            checkpoint.update({
+                "offset": f.tell(),
+                "line": line_number,
+                "pending": None,
+                "imported": checkpoint["imported"] + len(records),
+                "skipped": checkpoint["skipped"] + skipped,
+            })
+            save_checkpoint(checkpoint_path, checkpoint)
+            elapsed = perf_counter() - start
+            print(f"Imported {checkpoint['imported']} posts, skipped {checkpoint['skipped']} lines ({imported / elapsed:.0f} posts/s)")
+            sys.stdout.flush()
+    return checkpoint
+
+def main():
+    parser = argparse.ArgumentParser(description="Import posts from an NDJSON file")
+    parser.add_argument("path")
+    parser.add_argument("--checkpoint", help="progress file, defaults to <path>.checkpoint")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="posts per database transaction")
+    parser.add_argument("--bulk-size", type=int, default=IMPORT_BULK_SIZE, help="documents per _bulk request")
+    parser.add_argument("--index-workers", type=int, default=IMPORT_INDEX_WORKERS, help="_bulk requests in flight")
+    args = parser.parse_args()
+    checkpoint = import_posts(
+        args.path,
+        args.checkpoint or args.path + ".checkpoint",
+        chunk_size=args.chunk_size,
+        bulk_size=args.bulk_size,
+        index_workers=args.index_workers
+    )
+    print(f"Done. Imported {checkpoint['imported']} posts, skipped {checkpoint['skipped']} lines")
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import time
 import json
 import sys
 from sqlalchemy import inspect
-from backsite.db.management import initialize_db
+from backsite.db.management import initialize_db, upgrade_db
 from backsite.db.connection import create_sql_engine, create_connection
 from backsite.db.schema import User, Permission, Group
 from backsite.utils import get_configuration
@@ -38,7 +38,8 @@ if __name__ == "__main__":
             engine = create_sql_engine()
             insp = inspect(engine)
             if (insp.has_table(User.__tablename__)):
-                print("Database has already been initialized. Exiting...")
+                print("Database has already been initialized. Upgrading schema...")
+                upgrade_db()
                 exit(0)
             initialize_db()
             populate_db()
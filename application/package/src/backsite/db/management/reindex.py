@@ -0,0 +1,178 @@
+'''
+Rebuild the posts search index from Postgres
+
+Posts are loaded into a new index, created with the current mapping, and
+the posts alias is then moved to it in one atomic update, so searches
+never see a partial index. The post id space is split into slices that a
+pool of processes streams with server-side cursors and writes with _bulk
+requests. Refreshes are disabled while the index loads. The first run
+replaces the posts index Elasticsearch created on its own with the alias,
+deleting that index.
+
+Posts created while the index loads are copied again after the swap.
+Edits to existing posts made during the load may be lost, run it when
+posts aren't being edited or run it again.
+
+Posts written before the content column existed take their content from
+the current index, and it is saved to Postgres as well.
+
+Usage: python -m backsite.db.management.reindex [--workers 4] [--delete-old]
+'''
+import os
+import sys
+import argparse
+import multiprocessing
+from time import perf_counter
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import select, update, func, bindparam
+from backsite.db.connection import get_sql_engine
+from backsite.db.elastic import get_elastic_connection, bulk_index
+from backsite.db.schema import User, Post
+from backsite.db.search import POST_INDEX, POST_INDEX_MAPPINGS, post_document
+
+REINDEX_WORKERS = int(os.getenv("REINDEX_WORKERS", "4"))
+# Rows fetched per round trip of the server-side cursor, and documents per _bulk request
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", "1000"))
+# Slices per worker. More slices balance uneven id ranges and report progress more often
+REINDEX_SLICES_PER_WORKER = int(os.getenv("REINDEX_SLICES_PER_WORKER", "8"))
+
+def current_indexes(es) -> list:
+    '''
+    Return the indexes behind the posts alias. A concrete index named like
+    the alias, created before there was one, is returned as well
+    '''
+    if es.indices.exists_alias(name=POST_INDEX):
+        return list(es.indices.get_alias(name=POST_INDEX).keys())
+    if es.indices.exists(index=POST_INDEX):
+        return [POST_INDEX]
+    return []
+
+def load_missing_contents(es, engine, post_ids: list) -> dict:
+    '''
+    Copy the contents of posts written before the content column existed
+    from the current index to Postgres. Returns contents by post id
+    '''
+    response = es.mget(index=POST_INDEX, body={"ids": post_ids}, _source_includes=["content"])
+    contents = {
+        int(doc["_id"]): doc["_source"].get("content")
+        for doc in response["docs"] if doc.get("found") and doc["_source"].get("content") is not None
+    }
+    # Postgres text can't hold NUL, such contents are only indexed
+    stored = {post_id: content for post_id, content in contents.items() if "\x00" not in content}
+    if len(stored) > 0:
+        table = Post.__table__
+        statement = update(table).where(table.c.post_id == bindparam("b_post_id"), table.c.content.is_(None)).values(content=bindparam("b_content"))
+        with engine.begin() as conn:
+            conn.execute(statement, [{"b_post_id": post_id, "b_content": content} for post_id, content in stored.items()])
+    return contents
+
+def reindex_slice(index: str, low: int, high: int = None, batch_size: int = REINDEX_BATCH_SIZE, backfill: bool = True) -> int:
+    '''
+    Index the posts with ids from low to high (inclusive, unbounded when
+    None) into the given index. Runs in the worker processes
+    '''
+    engine = get_sql_engine()
+    es = get_elastic_connection()
+    statement = select(
+        Post.post_id, Post.title, Post.timestamp, Post.user_id, Post.replying_to,
+        Post.stored_content.label("content"), User.username
+    ).join(User, User.user_id == Post.user_id).where(Post.post_id >= low)
+    if high is not None:
+        statement = statement.where(Post.post_id <= high)
+    indexed = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=batch_size).execute(statement.order_by(Post.post_id))
+        for rows in result.partitions():
+            missing = [row.post_id for row in rows if row.content is None]
+            contents = load_missing_contents(es, engine, missing) if backfill and len(missing) > 0 else {}
+            bulk_index(es, index, [
+                post_document(
+                    row.post_id, row.title, row.timestamp, row.user_id, row.username, row.replying_to,
+                    row.content if row.content is not None else contents.get(row.post_id)
+                )
+                for row in rows
+            ])
+            indexed += len(rows)
+    return indexed
+
+def id_slices(low: int, high: int, count: int) -> list:
+    '''
+    Split the ids from low to high into count contiguous (low, high) ranges
+    '''
+    size = max(1, -(-(high - low + 1) // count))
+    return [(start, min(start + size - 1, high)) for start in range(low, high + 1, size)]
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}"
+
+def reindex(workers: int = REINDEX_WORKERS, batch_size: int = REINDEX_BATCH_SIZE, delete_old: bool = False) -> str:
+    '''
+    Build a new posts index from Postgres and point the posts alias at it.
+    Returns the name of the new index
+    '''
+    engine = get_sql_engine()
+    es = get_elastic_connection()
+    old_indexes = current_indexes(es)
+    backfill = len(old_indexes) > 0
+    index = f"{POST_INDEX}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+    es.indices.create(index=index, body={
+        "settings": {"index": {"refresh_interval": "-1"}},
+        "mappings": POST_INDEX_MAPPINGS,
+    })
+    print(f"Created index {index}")
+
+    with engine.connect() as conn:
+        low, high, total = conn.execute(select(func.min(Post.post_id), func.max(Post.post_id), func.count())).one()
+    start = perf_counter()
+    done = 0
+    if total > 0:
+        slices = id_slices(low, high, workers * REINDEX_SLICES_PER_WORKER)
+        # Spawned workers build their own engine and client instead of sharing this process' sockets
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(reindex_slice, index, slice_low, slice_high, batch_size, backfill) for slice_low, slice_high in slices]
+            for future in as_completed(futures):
+                done += future.result()
+                elapsed = perf_counter() - start
+                rate = done / elapsed if elapsed > 0 else 0.0
+                eta = (total - done) / rate if rate > 0 else 0.0
+                print(f"Indexed {done}/{total} posts ({done / total:.1%}), {rate:.0f} posts/s, ETA {format_duration(max(eta, 0))}")
+                sys.stdout.flush()
+    # Catch up on posts created during the load
+    after = (high or 0) + 1
+    done += reindex_slice(index, after, None, batch_size, backfill)
+
+    es.indices.put_settings(index=index, body={"index": {"refresh_interval": None}})
+    es.indices.refresh(index=index)
+    actions = [{"add": {"index": index, "alias": POST_INDEX}}]
+    for old_index in old_indexes:
+        if old_index == POST_INDEX:
+            # A concrete index holds the alias' name, it has to go in the same update
+            actions.append({"remove_index": {"index": old_index}})
+        else:
+            actions.append({"remove": {"index": old_index, "alias": POST_INDEX}})
+    es.indices.update_aliases(body={"actions": actions})
+    print(f"Alias {POST_INDEX} now points to {index}")
+    # Posts created between the catch-up and the swap were written to the old index
+    reindex_slice(index, after, None, batch_size, False)
+
+    if delete_old:
+        for old_index in old_indexes:
+            if old_index != POST_INDEX:
+                es.indices.delete(index=old_index)
+                print(f"Deleted index {old_index}")
+    print(f"Done. Indexed {done} posts in {format_duration(perf_counter() - start)}")
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the posts search index from Postgres")
+    parser.add_argument("--workers", type=int, default=REINDEX_WORKERS, help="processes loading the index")
+    parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE, help="rows per cursor fetch and _bulk request")
+    parser.add_argument("--delete-old", action="store_true", help="delete the indexes the alias pointed to before")
+    args = parser.parse_args()
+    reindex(args.workers, args.batch_size, args.delete_old)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+'''
+Cache of validated session principals
+
+A principal is the small, immutable summary of a session that permission
+checks need. Principals are cached per worker in an LRU and shared between
+the workers on a host through a memory mapped table, so a token is only
+resolved against Postgres once per TTL instead of on every request
+'''
+import os
+import struct
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+from traceback import print_exc
+from backsite.utils.cache import LRUCache, SharedMemoryTable
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "4096"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+PRINCIPAL_CACHE_PATH = os.getenv("PRINCIPAL_CACHE_PATH", "/dev/shm/backsite_principals")
+PRINCIPAL_CACHE_SLOTS = int(os.getenv("PRINCIPAL_CACHE_SLOTS", "8192"))
+
+# user_id, session expiration (UTC timestamp)
+PRINCIPAL_HEADER = struct.Struct("<qd")
+
+class Principal(namedtuple("Principal", ["user_id", "expiration", "permissions"])):
+    '''
+    Immutable record of an authenticated session
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_session(cls, session):
+        return cls(
+            user_id=session.user_id,
+            expiration=session.expiration,
+            permissions=frozenset(session.user.all_permissions)
+        )
+
+    @property
+    def expired(self) -> bool:
+        return self.expiration <= datetime.utcnow()
+
+    def encode(self) -> bytes:
+        timestamp = (self.expiration - datetime(1970, 1, 1)).total_seconds()
+        header = PRINCIPAL_HEADER.pack(self.user_id, timestamp)
+        return header + "\n".join(sorted(self.permissions)).encode()
+
+    @classmethod
+    def decode(cls, data: bytes):
+        user_id, timestamp = PRINCIPAL_HEADER.unpack_from(data, 0)
+        permissions = data[PRINCIPAL_HEADER.size:].decode()
+        return cls(
+            user_id=user_id,
+            expiration=datetime.utcfromtimestamp(timestamp),
+            permissions=frozenset(permissions.split("\n")) if permissions != "" else frozenset()
+        )
+
+def token_key(token: str) -> bytes:
+    '''
+    Cache key for a session token. Raw tokens never leave the process
+    '''
+    return hashlib.blake2b(token.encode(), digest_size=32).digest()
+
+class PrincipalCache:
+    '''
+    Two-tier cache: a per-process LRU in front of a host-wide shared table.
+    Processes replay the tokens and users other processes invalidated
+    against their LRU on their next lookup. Only invalidate_all, used for
+    permission changes that affect every user, makes them drop it
+    '''
+    def __init__(self, max_entries: int, ttl: float, shared_path: str = "", shared_slots: int = 8192):
+        self.ttl = ttl
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.shared = None
+        self._epoch = 0
+        self._invalidations = 0
+        if shared_path != "":
+            try:
+                self.shared = SharedMemoryTable(shared_path, slots=shared_slots)
+                self._epoch = self.shared.epoch
+                self._invalidations = self.shared.invalidation_sequence
+            except OSError as e:
+                print(f"Shared principal cache unavailable, using per-process cache only: {e}")
+                print_exc()
+
+    def _sync(self):
+        '''
+        Apply invalidations made by other processes to the local LRU
+        '''
+        if self.shared is None:
+            return
+        epoch = self.shared.epoch
+        if epoch != self._epoch:
+            self._invalidations = self.shared.invalidation_sequence
+            self.local.clear()
+            self._epoch = epoch
+        if self.shared.invalidation_sequence == self._invalidations:
+            return
+        sequence, entries = self.shared.invalidations(self._invalidations)
+        if entries is None:
+            # Fell behind the shared log, the LRU can't be trusted
+            self.local.clear()
+        else:
+            for key, user_id in entries:
+                if key is not None:
+                    self.local.pop(key)
+                else:
+                    self.local.remove_where(lambda principal: principal.user_id == user_id)
+        self._invalidations = sequence
+
+    def _ttl_for(self, principal: Principal) -> float:
+        remaining = (principal.expiration - datetime.utcnow()).total_seconds()
+        return min(self.ttl, remaining)
+
+    def get(self, token: str):
+        '''
+        Return the cached principal for the token, or None
+        '''
+        self._sync()
+        key = token_key(token)
+        principal = self.local.get(key)
+        if principal is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                principal = Principal.decode(entry[0])
+                self.local.put(key, principal, self._ttl_for(principal))
+        if principal is not None and principal.expired:
+            self.invalidate_token(token)
+            return None
+        return principal
+
+    def put(self, token: str, principal: Principal):
+        key = token_key(token)
+        ttl = self._ttl_for(principal)
+        self.local.put(key, principal, ttl)
+        if self.shared is not None:
+            self.shared.put(key, principal.encode(), tag=principal.user_id, ttl=ttl)
+
+    def invalidate_token(self, token: str):
+        key = token_key(token)
+        self.local.pop(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def invalidate_user(self, user_id: int):
+        self.local.remove_where(lambda principal: principal.user_id == user_id)
+        if self.shared is not None:
+            self.shared.delete_tag(user_id)
+
+    def invalidate_all(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+            self._epoch = self.shared.epoch
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "local": dict(self.local.stats.json, entries=len(self.local)),
+            "shared": self.shared.stats.json if self.shared is not None else None,
+        }
+
+PRINCIPAL_CACHE = PrincipalCache(
+    max_entries=PRINCIPAL_CACHE_SIZE,
+    ttl=PRINCIPAL_CACHE_TTL,
+    shared_path=PRINCIPAL_CACHE_PATH,
+    shared_slots=PRINCIPAL_CACHE_SLOTS
+)
+
+def schedule_invalidation(conn, user_id: int = None):
+    '''
+    Invalidate a user's cached principals (or all principals when no user
+    is given) once the given ORM session commits. Without a session the
+    invalidation happens immediately
+    '''
+    if conn is None:
+        if user_id is None:
+            PRINCIPAL_CACHE.invalidate_all()
+        else:
+            PRINCIPAL_CACHE.invalidate_user(user_id)
+        return
+    pending = conn.info.setdefault("principal_invalidations", set())
+    pending.add(user_id)
+
+def apply_scheduled_invalidations(conn):
+    '''
+    ORM after_commit hook that applies invalidations scheduled on the session
+    '''
+    pending = conn.info.pop("principal_invalidations", None)
+    if not pending:
+        return
+    if None in pending:
+        PRINCIPAL_CACHE.invalidate_all()
+        return
+    for user_id in pending:
+        PRINCIPAL_CACHE.invalidate_user(user_id)
@@ -1,11 +1,51 @@
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker, object_session
+from sqlalchemy.orm import Session as ORMSession
 # Import Base
 from backsite.db.schema.base import Base
 # Import all table classes for easy access
 from backsite.db.schema.user import User
+from backsite.db.schema.revocation import RevokedToken, UserRevocation
 from backsite.db.schema.session import Session
 from backsite.db.schema.permission import Permission, user_permissions
 from backsite.db.schema.group import Group, user_groups, group_permissions
-from backsite.db.schema.post import Post
+from backsite.db.schema.follow import follows, home_timeline, high_fanout_author
+from backsite.db.schema.post import Post, collect_post_changes, queue_post_index_operations
+from backsite.db.schema.post import apply_content_updates, discard_content_updates
+from backsite.db.schema.outbox import OutboxMessage
+from backsite.db.schema.effective_permission import user_effective_permissions
+from backsite.db.schema.effective_permission import refresh_effective_permissions, sync_effective_permissions
+from backsite.db.principal import schedule_invalidation, apply_scheduled_invalidations
 
-DBSession = scoped_session(sessionmaker())
\ No newline at end of file
+DBSession = scoped_session(sessionmaker())
+
+# Cached session principals carry permissions, so any change to who holds
+# which permission has to invalidate them once the change is committed
+def _user_membership_changed(target, value, initiator):
+    if target.user_id is not None:
+        schedule_invalidation(object_session(target), target.user_id)
+
+def _member_user_changed(target, value, initiator):
+    if value.user_id is not None:
+        schedule_invalidation(object_session(value), value.user_id)
+
+def _group_permissions_changed(target, value, initiator):
+    schedule_invalidation(object_session(target))
+
+for attribute in (User.permissions, User.groups):
+    event.listen(attribute, "append", _user_membership_changed)
+    event.listen(attribute, "remove", _user_membership_changed)
+for attribute in (Permission.users, Group.users):
+    event.listen(attribute, "append", _member_user_changed)
+    event.listen(attribute, "remove", _member_user_changed)
+for attribute in (Group.permissions, Permission.groups):
+    event.listen(attribute, "append", _group_permissions_changed)
+    event.listen(attribute, "remove", _group_permissions_changed)
+
+event.listen(ORMSession, "after_commit", apply_scheduled_invalidations)
+event.listen(ORMSession, "after_flush", sync_effective_permissions)
+# Keep the post search index in step with the post table
+event.listen(ORMSession, "after_flush", collect_post_changes)
+event.listen(ORMSession, "after_flush_postexec", queue_post_index_operations)
+event.listen(ORMSession, "after_commit", apply_content_updates)
+event.listen(ORMSession, "after_rollback", discard_content_updates)
@@ -0,0 +1,92 @@
+from itertools import chain
+from sqlalchemy import Column, ForeignKey, Table, select, insert, delete
+from sqlalchemy.orm import attributes
+from backsite.db.schema import Base
+from backsite.db.schema.user import User
+from backsite.db.schema.permission import Permission, user_permissions
+from backsite.db.schema.group import Group, user_groups, group_permissions
+from backsite.db.schema.revocation import UserRevocation
+
+# Materialized union of each user's direct and group permissions, so that
+# resolving a user's permissions is a single indexed lookup
+user_effective_permissions = Table(
+    "user_effective_permissions",
+    Base.metadata,
+    Column("user_id", ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True),
+    Column("permission", ForeignKey("permission.permission_name", ondelete="CASCADE"), primary_key=True)
+)
+
+def affected_users(user_ids = None, group_names = None):
+    '''
+    Select the ids of the given users and of every member of the given groups
+    '''
+    affected = select(User.user_id).where(User.user_id.in_(list(user_ids or [])))
+    if group_names:
+        affected = affected.union(
+            select(user_groups.c.user_id).where(user_groups.c.group.in_(list(group_names)))
+        )
+    return affected
+
+def refresh_effective_permissions(conn, user_ids = None, group_names = None):
+    '''
+    Recompute the effective permissions of the given users and of every
+    member of the given groups. With neither given, every user is recomputed
+    '''
+    direct = select(user_permissions.c.user_id, user_permissions.c.permission)
+    inherited = select(user_groups.c.user_id, group_permissions.c.permission).join(
+        group_permissions, user_groups.c.group == group_permissions.c.group
+    )
+    remove = delete(user_effective_permissions)
+    if user_ids is not None or group_names is not None:
+        affected = affected_users(user_ids, group_names)
+        direct = direct.where(user_permissions.c.user_id.in_(affected))
+        inherited = inherited.where(user_groups.c.user_id.in_(affected))
+        remove = remove.where(user_effective_permissions.c.user_id.in_(affected))
+    conn.execute(remove)
+    conn.execute(
+        insert(user_effective_permissions).from_select(
+            ["user_id", "permission"],
+            direct.union(inherited)
+        )
+    )
+
+def _collection_changed(obj, key: str) -> bool:
+    return attributes.get_history(obj, key, passive=attributes.PASSIVE_NO_INITIALIZE).has_changes()
+
+def sync_effective_permissions(conn, flush_context):
+    '''
+    ORM after_flush hook that keeps user_effective_permissions in step with
+    user_permissions, user_groups and group_permissions
+    '''
+    user_ids = set()
+    group_names = set()
+    refresh_all = False
+    for obj in chain(conn.new, conn.dirty):
+        if isinstance(obj, User):
+            if _collection_changed(obj, "permissions") or _collection_changed(obj, "groups"):
+                user_ids.add(obj.user_id)
+        elif isinstance(obj, Group):
+            if _collection_changed(obj, "permissions"):
+                group_names.add(obj.group_name)
+            if _collection_changed(obj, "users"):
+                history = attributes.get_history(obj, "users", passive=attributes.PASSIVE_NO_INITIALIZE)
+                user_ids.update(u.user_id for u in chain(history.added, history.deleted))
+        elif isinstance(obj, Permission):
+            if _collection_changed(obj, "users"):
+                history = attributes.get_history(obj, "users", passive=attributes.PASSIVE_NO_INITIALIZE)
+                user_ids.update(u.user_id for u in chain(history.added, history.deleted))
+            if _collection_changed(obj, "groups"):
+                history = attributes.get_history(obj, "groups", passive=attributes.PASSIVE_NO_INITIALIZE)
+                group_names.update(g.group_name for g in chain(history.added, history.deleted))
+    for obj in conn.deleted:
+        # Memberships of deleted groups and permissions are already gone
+        if isinstance(obj, (Group, Permission)):
+            refresh_all = True
+    user_ids.discard(None)
+    if refresh_all:
+        refresh_effective_permissions(conn.connection())
+        # Signed session tokens carry permissions, flag them as stale
+        UserRevocation.bump_permissions_version(conn.connection(), select(User.user_id))
+    elif len(user_ids) > 0 or len(group_names) > 0:
+        refresh_effective_permissions(conn.connection(), user_ids, group_names)
+        UserRevocation.bump_permissions_version(conn.connection(), affected_users(user_ids, group_names))
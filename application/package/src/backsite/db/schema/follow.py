@@ -0,0 +1,80 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Table, Index, select, delete, func
+from sqlalchemy.dialects.postgresql import insert
+from backsite.db.schema import Base
+from backsite.db.schema.outbox import OutboxMessage
+from datetime import datetime
+
+# Consumed by the timeline jobs in backsite_jobs
+TIMELINE_QUEUE = "timeline_jobs"
+
+# Who follows whom. The primary key serves "who does X follow", the
+# followee index serves fan-out to "who follows X"
+follows = Table(
+    "follows",
+    Base.metadata,
+    Column("follower_id", ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True),
+    Column("followee_id", ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True),
+    Column("created", DateTime, nullable=False, default=datetime.utcnow),
+    Index("follows_followee_idx", "followee_id", "follower_id")
+)
+
+# Materialized home timelines: one row per post in each follower's feed,
+# written by the fan-out job. The primary key is the order feeds are read
+# in, so a page is a single range scan
+home_timeline = Table(
+    "home_timeline",
+    Base.metadata,
+    Column("user_id", ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True),
+    Column("timestamp", DateTime, primary_key=True),
+    Column("post_id", ForeignKey("post.post_id", ondelete="CASCADE"), primary_key=True),
+    Column("author_id", Integer, nullable=False),
+    Index("home_timeline_post_idx", "post_id"),
+    # Lets the retention sweep find old entries
+    Index("home_timeline_timestamp_idx", "timestamp")
+)
+
+# Authors with too many followers to fan out to. Their posts are merged
+# into followers' feeds at read time instead
+high_fanout_author = Table(
+    "high_fanout_author",
+    Base.metadata,
+    Column("user_id", ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True),
+    Column("follower_count", Integer, nullable=False),
+    Column("updated", DateTime, nullable=False, default=datetime.utcnow)
+)
+
+def follow(conn, follower_id: int, followee_id: int):
+    '''
+    Make follower_id follow followee_id and queue copying the followee's
+    recent posts into the follower's home timeline
+    '''
+    result = conn.execute(insert(follows).values(
+        follower_id=follower_id,
+        followee_id=followee_id,
+        created=datetime.utcnow()
+    ).on_conflict_do_nothing())
+    if result.rowcount > 0:
+        OutboxMessage.enqueue(conn, {
+            "command": "backfillFollow",
+            "params": {"follower_id": follower_id, "followee_id": followee_id}
+        }, TIMELINE_QUEUE)
+
+def unfollow(conn, follower_id: int, followee_id: int):
+    '''
+    Stop following, removing the followee's posts from the follower's home timeline
+    '''
+    conn.execute(delete(follows).where(
+        follows.c.follower_id == follower_id,
+        follows.c.followee_id == followee_id
+    ))
+    # Bounded by the follower's own timeline, which the primary key leads with
+    conn.execute(delete(home_timeline).where(
+        home_timeline.c.user_id == follower_id,
+        home_timeline.c.author_id == followee_id
+    ))
+
+def follower_count(conn, user_id: int) -> int:
+    return conn.execute(select(func.count()).select_from(follows).where(follows.c.followee_id == user_id)).scalar()
+
+def following_count(conn, user_id: int) -> int:
+    return conn.execute(select(func.count()).select_from(follows).where(follows.c.follower_id == user_id)).scalar()
@@ -0,0 +1,27 @@
+import json
+from sqlalchemy import Column, String, BigInteger, DateTime, Text
+from backsite.db.schema import Base
+from datetime import datetime
+from backsite.utils.rabbitmq import stamp_enqueued
+
+class OutboxMessage(Base):
+    '''
+    Background command written in the same transaction as the change that
+    caused it. The outbox relay in backsite_jobs publishes it to RabbitMQ
+    and deletes it, so a command is sent if and only if its change commits
+    '''
+    __tablename__ = "outbox"
+
+    outbox_id = Column(BigInteger, primary_key=True, autoincrement=True)
+    queue = Column(String(length=255), nullable=False)
+    payload = Column(Text, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def enqueue(cls, conn, data, queue_name: str):
+        '''
+        Add a message to the outbox as part of the connection's current transaction
+        '''
+        message = cls(queue=queue_name, payload=json.dumps(stamp_enqueued(data)))
+        conn.add(message)
+        return message
@@ -1,26 +1,65 @@
 import os
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey
-from sqlalchemy.orm import relationship, Mapped
+import json
+import base64
+from sqlalchemy import Column, String, Text, Integer, DateTime, ForeignKey, Index, inspect, select, update, literal, tuple_
+from sqlalchemy.orm import relationship, Mapped, object_session, selectinload, deferred
 from backsite.db.schema import Base
+from backsite.db.schema.user import User, PUBLIC_USER_FIELDS
+from backsite.db.schema.outbox import OutboxMessage
+from backsite.db.schema.follow import follows, home_timeline, high_fanout_author, TIMELINE_QUEUE
 from backsite.db.connection import create_connection
+from backsite.db.elastic import get_elastic_connection
+from backsite.utils.cache import LRUCache
 from uuid import uuid4
 from datetime import datetime
-from elasticsearch import Elasticsearch
 
-ELASTIC_HOST = os.getenv("ELASTIC_HOST", "elastic")
-ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD", "backsite")
+# Consumed by the post indexer in backsite_jobs
+POST_INDEX_QUEUE = "post_index"
+# Columns copied into the search document, and the document field they fill
+INDEXED_COLUMNS = {"title": "title", "timestamp": "timestamp", "user_id": "author", "replying_to": "replying_to"}
+# Post contents cached per worker, 0 disables the cache. Other workers'
+# content updates are only seen once their cached entry expires
+POST_CONTENT_CACHE_SIZE = int(os.getenv("POST_CONTENT_CACHE_SIZE", "10000"))
+POST_CONTENT_CACHE_TTL = float(os.getenv("POST_CONTENT_CACHE_TTL", "60"))
+CONTENT_CACHE = LRUCache(POST_CONTENT_CACHE_SIZE, POST_CONTENT_CACHE_TTL) if POST_CONTENT_CACHE_SIZE > 0 else None
 
-def get_elastic_connection():
-    return Elasticsearch(f"https://{ELASTIC_HOST}:9200", http_auth=("elastic", ELASTIC_PASSWORD), verify_certs=False)
+def encode_cursor(timestamp: datetime, post_id: int) -> str:
+    '''
+    Opaque cursor pointing just past a post in a timeline
+    '''
+    data = json.dumps([timestamp.isoformat(), post_id]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    '''
+    Return the (timestamp, post_id) a cursor points past.
+    Raises ValueError for malformed cursors
+    '''
+    try:
+        timestamp, post_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
 
 class Post(Base):
     __tablename__ = "post"
+    __table_args__ = (
+        # Keyset pagination of timelines, newest first
+        Index("post_author_timeline_idx", "user_id", "timestamp", "post_id"),
+        Index("post_timeline_idx", "timestamp", "post_id"),
+        # Walking reply threads
+        Index("post_replying_to_idx", "replying_to"),
+    )
 
     post_id = Column(Integer, primary_key = True, autoincrement = True)
     title = Column(String, nullable=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
     user_id = Column(ForeignKey("backsite_user.user_id", ondelete="CASCADE"), nullable=False)
     replying_to = Column(ForeignKey("post.post_id"), nullable=True)
+    # Source of truth for the content, which reads get from the search
+    # index. Not loaded with the post. Null for posts written before the
+    # column existed, until a reindex copies their content back
+    stored_content = deferred(Column("content", Text, nullable=True))
 
     author = relationship("User", back_populates="posts")
     original = relationship("Post", back_populates="replies", remote_side=[post_id])
@@ -28,42 +67,307 @@ class Post(Base):
 
     @property
     def json(self):
-        return {
-            "post_id": self.post_id,
-            "title": self.title,
-            "author": self.author.json,
-            "timestamp": self.timestamp.isoformat(),
-            "replying_to": self.replying_to,
-        }
+        return Post.serialize([self])[0]
+
+    @classmethod
+    def load_options(cls) -> list:
+        '''
+        Query options loading what serialize needs for a whole result set:
+        authors' public columns, in one extra IN query
+        '''
+        return [selectinload(cls.author).load_only(*[getattr(User, field) for field in PUBLIC_USER_FIELDS])]
+
+    @classmethod
+    def serialize(cls, posts: list, include_content: bool = False, author_fields: tuple = PUBLIC_USER_FIELDS) -> list:
+        '''
+        Serialize posts with their author's public fields. Authors that
+        weren't loaded with the posts are fetched in one query, and contents
+        in one _mget when requested
+        '''
+        conn = next((object_session(post) for post in posts if object_session(post) is not None), None)
+        authors = {post.user_id: post.author for post in posts if "author" in post.__dict__}
+        unloaded = {post.user_id for post in posts} - authors.keys()
+        if len(unloaded) > 0 and conn is not None:
+            for author in conn.scalars(select(User).where(User.user_id.in_(unloaded))):
+                authors[author.user_id] = author
+        for post in posts:
+            if post.user_id not in authors:
+                authors[post.user_id] = post.author
+        author_json = dict(zip(authors.keys(), User.serialize(list(authors.values()), author_fields)))
+        contents = cls.load_contents(posts) if include_content else {}
+        serialized = []
+        for post in posts:
+            data = {
+                "post_id": post.post_id,
+                "title": post.title,
+                "author": author_json[post.user_id],
+                "timestamp": post.timestamp.isoformat(),
+                "replying_to": post.replying_to,
+            }
+            if include_content:
+                data["content"] = contents.get(post.post_id)
+            serialized.append(data)
+        return serialized
+
+    @classmethod
+    def timeline(cls, conn, author_id: int = None, cursor: str = None, limit: int = 20):
+        '''
+        Return a page of posts, newest first, and the cursor of the next page
+        (None on the last page). Pages are found by seeking past the cursor's
+        (timestamp, post_id) in the timeline index instead of with OFFSET, so
+        deep pages cost the same as the first
+        '''
+        statement = select(cls).options(*cls.load_options())
+        if author_id is not None:
+            statement = statement.where(cls.user_id == author_id)
+        if cursor is not None:
+            timestamp, post_id = decode_cursor(cursor)
+            statement = statement.where(tuple_(cls.timestamp, cls.post_id) < tuple_(timestamp, post_id))
+        statement = statement.order_by(cls.timestamp.desc(), cls.post_id.desc()).limit(limit + 1)
+        posts = conn.scalars(statement).all()
+        if len(posts) <= limit:
+            return posts, None
+        posts = posts[:limit]
+        return posts, encode_cursor(posts[-1].timestamp, posts[-1].post_id)
+
+    @classmethod
+    def home_timeline(cls, conn, user_id: int, cursor: str = None, limit: int = 20):
+        '''
+        Return a page of the user's home timeline, newest first, and the
+        cursor of the next page. Posts fanned out to the user are read with
+        one range scan of their materialized timeline; posts of followed
+        high-fanout authors are pulled from each author's timeline index and
+        merged in
+        '''
+        position = decode_cursor(cursor) if cursor is not None else None
+        materialized = select(home_timeline.c.timestamp, home_timeline.c.post_id).where(home_timeline.c.user_id == user_id)
+        if position is not None:
+            materialized = materialized.where(tuple_(home_timeline.c.timestamp, home_timeline.c.post_id) < tuple_(*position))
+        materialized = materialized.order_by(home_timeline.c.timestamp.desc(), home_timeline.c.post_id.desc()).limit(limit + 1)
+        entries = {post_id: timestamp for timestamp, post_id in conn.execute(materialized)}
+        pulled_authors = conn.scalars(
+            select(high_fanout_author.c.user_id).where(
+                high_fanout_author.c.user_id.in_(
+                    select(follows.c.followee_id).where(follows.c.follower_id == user_id)
+                ) | (high_fanout_author.c.user_id == user_id)
+            )
+        ).all()
+        for author_id in pulled_authors:
+            pulled = select(cls.timestamp, cls.post_id).where(cls.user_id == author_id)
+            if position is not None:
+                pulled = pulled.where(tuple_(cls.timestamp, cls.post_id) < tuple_(*position))
+            pulled = pulled.order_by(cls.timestamp.desc(), cls.post_id.desc()).limit(limit + 1)
+            # Posts from before the author became high-fanout may be in both
+            entries.update({post_id: timestamp for timestamp, post_id in conn.execute(pulled)})
+        page = sorted(entries.items(), key=lambda entry: (entry[1], entry[0]), reverse=True)[:limit + 1]
+        post_ids = [post_id for post_id, timestamp in page[:limit]]
+        loaded = {post.post_id: post for post in conn.scalars(select(cls).options(*cls.load_options()).where(cls.post_id.in_(post_ids)))}
+        posts = [loaded[post_id] for post_id in post_ids if post_id in loaded]
+        if len(page) <= limit:
+            return posts, None
+        last_id, last_timestamp = page[limit - 1]
+        return posts, encode_cursor(last_timestamp, last_id)
+
+    @classmethod
+    def thread(cls, conn, post_id: int, max_depth: int = None, max_posts: int = None):
+        '''
+        Return (tree, truncated): the post serialized with its replies nested
+        under "replies", recursively, down to max_depth levels of replies (all
+        of them when None), or None if the post doesn't exist. Trees with more
+        than max_posts posts are cut to their first max_posts posts level by
+        level, with truncated set. The whole tree is read with one recursive
+        query, its authors and contents with one more each
+        '''
+        tree = select(cls.post_id, literal(0).label("depth")).where(cls.post_id == post_id).cte("thread", recursive=True)
+        replies = select(cls.post_id, tree.c.depth + 1).where(cls.replying_to == tree.c.post_id)
+        if max_depth is not None:
+            replies = replies.where(tree.c.depth < max_depth)
+        tree = tree.union_all(replies)
+        found = select(tree.c.post_id, tree.c.depth)
+        if max_posts is not None:
+            # The recursion stops once one post more than allowed was found.
+            # Postgres finds replies a level at a time, so the posts kept are
+            # the shallowest ones, without sorting the whole tree first
+            found = found.limit(max_posts + 1)
+        found = found.subquery()
+        statement = select(cls).options(*cls.load_options()).join(found, cls.post_id == found.c.post_id)
+        # Parents come before their replies, and replies in the order they were posted
+        posts = conn.scalars(statement.order_by(found.c.depth, cls.timestamp, cls.post_id)).all()
+        if len(posts) == 0:
+            return None, False
+        truncated = max_posts is not None and len(posts) > max_posts
+        if truncated:
+            posts = posts[:max_posts]
+        nodes = {}
+        for post, data in zip(posts, cls.serialize(posts, include_content=True)):
+            data["replies"] = []
+            if post.post_id == post_id:
+                nodes[post.post_id] = data
+            elif post.replying_to in nodes:
+                # Replies of posts cut from a truncated tree are left out too
+                nodes[post.post_id] = data
+                nodes[post.replying_to]["replies"].append(data)
+        return nodes[post_id], truncated
+
+    def queue_fan_out(self, conn):
+        '''
+        Queue copying this new post into its author's followers' home timelines
+        '''
+        OutboxMessage.enqueue(conn, {
+            "command": "fanOutPost",
+            "params": {"post_id": self.post_id, "author_id": self.user_id, "timestamp": self.timestamp.isoformat()}
+        }, TIMELINE_QUEUE)
 
     @property
     def content(self):
-        es = get_elastic_connection()
-        doc = es.get(index="posts", id=self.post_id)["_source"]
-        return doc['content']
+        if "_loaded_content" not in self.__dict__:
+            Post.load_contents([self])
+        return self._loaded_content
+
+    @classmethod
+    def load_contents(cls, posts: list) -> dict:
+        '''
+        Load the content of several posts, from the cache or with a single
+        _mget that only fetches the content field. Returns contents by post
+        id, None for posts that aren't indexed (yet)
+        '''
+        contents = {}
+        missing = []
+        for post in posts:
+            if "_loaded_content" in post.__dict__:
+                contents[post.post_id] = post._loaded_content
+                continue
+            cached = CONTENT_CACHE.get(post.post_id) if CONTENT_CACHE is not None else None
+            if cached is not None:
+                contents[post.post_id] = cached
+            elif post.post_id not in missing:
+                missing.append(post.post_id)
+        if len(missing) > 0:
+            es = get_elastic_connection()
+            response = es.mget(index="posts", body={"ids": missing}, _source_includes=["content"])
+            for doc in response["docs"]:
+                post_id = int(doc["_id"])
+                content = doc["_source"].get("content") if doc.get("found") else None
+                contents[post_id] = content
+                if content is not None and CONTENT_CACHE is not None:
+                    CONTENT_CACHE.put(post_id, content)
+        for post in posts:
+            post._loaded_content = contents.get(post.post_id)
+        return contents
     
     @content.setter
     def content(self, value):
-        es = get_elastic_connection()
-        doc = self.json
-        doc['content'] = value
-        es.update(index="posts", id=self.post_id, body={"doc": doc})
+        '''
+        Content is saved with the post and indexed in the background once
+        the post's session commits. Posts not yet flushed carry it to their
+        index operation. Raises ValueError for content Postgres can't store
+        '''
+        if value is not None and "\x00" in value:
+            raise ValueError("Content can't contain NUL characters")
+        state = inspect(self)
+        self._loaded_content = value
+        if state.transient or state.pending:
+            self.stored_content = value
+        elif state.detached:
+            conn = create_connection()
+            try:
+                conn.execute(update(Post).where(Post.post_id == self.post_id).values({Post.stored_content: value}))
+                self.queue_index_operation(conn, "update", {"content": value})
+                conn.commit()
+            finally:
+                conn.close()
+        else:
+            self.stored_content = value
+            self.queue_index_operation(object_session(self), "update", {"content": value})
+
+    def queue_index_operation(self, conn, action: str, document: dict = None):
+        '''
+        Write an index, update or delete of this post's search document to
+        the outbox, as part of the connection's current transaction
+        '''
+        params = {"post_id": self.post_id}
+        if document is not None:
+            params["document"] = document
+        OutboxMessage.enqueue(conn, {"command": action, "params": params}, POST_INDEX_QUEUE)
+        if action == "delete" or "content" in (document or {}):
+            # Update this worker's cached content once the change commits
+            pending = conn.info.setdefault("post_content_updates", {})
+            pending[self.post_id] = None if action == "delete" else document["content"]
 
     @classmethod
-    def createPost(cls, content, author_id, title=None, replying_to_id = None):
-        # Add post to SQL DB
-        conn = create_connection()
+    def createPost(cls, content, author_id, title=None, replying_to_id = None, conn = None):
+        # Add post to SQL DB, its search document is indexed in the background
+        conn = conn if conn is not None else create_connection()
         postObj = cls(
             user_id=author_id,
             title=title,
             replying_to=replying_to_id
         )
+        postObj.content = content
         conn.add(postObj)
         conn.commit()
-        # Add post to ElasticSearch
-        doc = postObj.json
-        doc['content'] = content
-        es = get_elastic_connection()
-        es.index(index="posts", id=postObj.post_id, document=doc)
         # Return SQL Object
-        return postObj
\ No newline at end of file
+        return postObj
+
+def collect_post_changes(conn, flush_context):
+    '''
+    after_flush hook: note which posts this flush wrote, while attribute
+    history is still available
+    '''
+    changes = conn.info.setdefault("post_index_changes", [])
+    for post in conn.new:
+        if isinstance(post, Post):
+            changes.append((post, "index", None))
+    for post in conn.dirty:
+        if not isinstance(post, Post):
+            continue
+        state = inspect(post)
+        changed = [field for column, field in INDEXED_COLUMNS.items() if state.attrs[column].history.has_changes()]
+        if len(changed) > 0:
+            changes.append((post, "update", changed))
+    for post in conn.deleted:
+        if isinstance(post, Post):
+            changes.append((post, "delete", None))
+
+def queue_post_index_operations(conn, flush_context):
+    '''
+    after_flush_postexec hook: write search index operations for the posts
+    collected above to the outbox, so the index follows the database
+    without an Elasticsearch round-trip in the request, and queue the
+    fan-out of new posts. Runs once posts are persistent so their author
+    can be loaded
+    '''
+    changes = conn.info.pop("post_index_changes", [])
+    written = [post for post, action, changed in changes if action != "delete"]
+    documents = dict(zip([id(post) for post in written], Post.serialize(written)))
+    for post, action, changed in changes:
+        if action == "index":
+            document = documents[id(post)]
+            document["content"] = post.__dict__.get("stored_content") or ""
+            post.queue_index_operation(conn, "index", document)
+            post.queue_fan_out(conn)
+        elif action == "update":
+            document = documents[id(post)]
+            post.queue_index_operation(conn, "update", {field: document[field] for field in changed})
+        else:
+            post.queue_index_operation(conn, "delete")
+
+def apply_content_updates(conn):
+    '''
+    after_commit hook: replace cached contents changed by the transaction,
+    so this worker doesn't serve the old content while the index catches up
+    '''
+    pending = conn.info.pop("post_content_updates", None)
+    if not pending or CONTENT_CACHE is None:
+        return
+    for post_id, content in pending.items():
+        if content is None:
+            CONTENT_CACHE.pop(post_id)
+        else:
+            CONTENT_CACHE.put(post_id, content)
+
+def discard_content_updates(conn):
+    '''
+    after_rollback hook: forget content changes that were never committed
+    '''
+    conn.info.pop("post_content_updates", None)
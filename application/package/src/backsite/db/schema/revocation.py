@@ -0,0 +1,136 @@
+import os
+import threading
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, select, literal
+from sqlalchemy.dialects.postgresql import insert
+from backsite.db.schema import Base
+from backsite.db.connection import create_connection
+from datetime import datetime, timedelta
+from time import monotonic
+from traceback import print_exc
+
+REVOCATION_REFRESH_INTERVAL = float(os.getenv("REVOCATION_REFRESH_INTERVAL", "5"))
+
+class RevokedToken(Base):
+    '''
+    Signed session tokens that were logged out before they expired
+    '''
+    __tablename__ = "revoked_token"
+
+    token_id = Column(String(length=32), primary_key=True)
+    user_id = Column(ForeignKey("backsite_user.user_id", ondelete="CASCADE"), nullable=False)
+    expiration = Column(DateTime, nullable=False, index=True)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class UserRevocation(Base):
+    '''
+    Per-user revocation state for signed session tokens. Tokens issued
+    before sessions_invalidated_before are rejected, and tokens carrying an
+    older permissions_version must have their permissions re-resolved
+    '''
+    __tablename__ = "user_revocation"
+
+    user_id = Column(ForeignKey("backsite_user.user_id", ondelete="CASCADE"), primary_key=True)
+    sessions_invalidated_before = Column(DateTime, nullable=True)
+    permissions_version = Column(Integer, nullable=False, default=0)
+    updated = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def invalidate_sessions(cls, user_id: int, conn):
+        '''
+        Reject every signed token issued to the user up to now
+        '''
+        now = datetime.utcnow()
+        statement = insert(cls).values(user_id=user_id, sessions_invalidated_before=now, permissions_version=0, updated=now)
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[cls.user_id],
+            set_={"sessions_invalidated_before": now, "updated": now}
+        ))
+        REVOCATION_LIST.invalidate_user(user_id, now)
+
+    @classmethod
+    def bump_permissions_version(cls, conn, affected_users):
+        '''
+        Mark the permissions carried by the given users' signed tokens as stale.
+        affected_users is a select of user ids
+        '''
+        now = datetime.utcnow()
+        statement = insert(cls).from_select(
+            ["user_id", "permissions_version", "updated"],
+            select(affected_users.subquery().c[0], literal(1), literal(now))
+        )
+        conn.execute(statement.on_conflict_do_update(
+            index_elements=[cls.user_id],
+            set_={"permissions_version": cls.permissions_version + 1, "updated": now}
+        ))
+
+class RevocationList:
+    '''
+    In-memory snapshot of revoked tokens and per-user revocation state,
+    refreshed incrementally from the database at most every
+    REVOCATION_REFRESH_INTERVAL seconds so token verification never waits
+    on the database
+    '''
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.tokens = {}
+        self.users = {}
+        self._synced_at = None
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        started = datetime.utcnow()
+        # Overlap windows so rows written by workers with skewed clocks aren't missed
+        since = self._synced_at - timedelta(seconds=self.refresh_interval) if self._synced_at is not None else None
+        conn = create_connection()
+        try:
+            tokens = select(RevokedToken.token_id, RevokedToken.expiration).where(RevokedToken.expiration > started)
+            users = select(UserRevocation.user_id, UserRevocation.sessions_invalidated_before, UserRevocation.permissions_version)
+            if since is not None:
+                tokens = tokens.where(RevokedToken.created >= since)
+                users = users.where(UserRevocation.updated >= since)
+            for token_id, expiration in conn.execute(tokens):
+                self.tokens[token_id] = expiration
+            for user_id, invalidated_before, permissions_version in conn.execute(users):
+                self.users[user_id] = (invalidated_before, permissions_version)
+        finally:
+            conn.close()
+        # Forget revoked tokens that have expired on their own
+        for token_id in [t for t, expiration in self.tokens.items() if expiration <= started]:
+            del self.tokens[token_id]
+        self._synced_at = started
+
+    def maybe_refresh(self):
+        if monotonic() < self._next_refresh:
+            return
+        if not self._lock.acquire(blocking=self._synced_at is None):
+            # Another thread is already refreshing, use the current snapshot
+            return
+        try:
+            if monotonic() >= self._next_refresh:
+                self._refresh()
+        except Exception as e:
+            print(f"Error refreshing session revocation list: {e}")
+            print_exc()
+        finally:
+            self._next_refresh = monotonic() + self.refresh_interval
+            self._lock.release()
+
+    def is_revoked(self, token_id: str, user_id: int, issued_at: datetime) -> bool:
+        self.maybe_refresh()
+        if token_id in self.tokens:
+            return True
+        invalidated_before = self.users.get(user_id, (None, 0))[0]
+        return invalidated_before is not None and issued_at <= invalidated_before
+
+    def permissions_version(self, user_id: int) -> int:
+        self.maybe_refresh()
+        return self.users.get(user_id, (None, 0))[1]
+
+    def revoke_token(self, token_id: str, expiration: datetime):
+        self.tokens[token_id] = expiration
+
+    def invalidate_user(self, user_id: int, invalidated_before: datetime):
+        self.users[user_id] = (invalidated_before, self.users.get(user_id, (None, 0))[1])
+
+REVOCATION_LIST = RevocationList(REVOCATION_REFRESH_INTERVAL)
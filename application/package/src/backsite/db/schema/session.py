@@ -1,10 +1,24 @@
+import os
+import json
+import hmac
+import hashlib
+import base64
 from sqlalchemy import Column, String, Integer, ForeignKey, DateTime
 from sqlalchemy.orm import relationship
 from backsite.db.schema import Base
+from backsite.db.schema.user import User
+from backsite.db.schema.revocation import RevokedToken, UserRevocation, REVOCATION_LIST
 from backsite.db.connection import create_connection
+from backsite.db.principal import Principal
 from uuid import uuid4
 from datetime import datetime, timedelta
 
+# "opaque" tokens are looked up in the session table, "signed" tokens are
+# self-contained and only checked against the revocation list
+SESSION_TOKEN_MODE = os.getenv("SESSION_TOKEN_MODE", "opaque")
+SESSION_SIGNING_KEY = os.getenv("SESSION_SIGNING_KEY", "").encode()
+SIGNED_TOKEN_PREFIX = "v1."
+
 def generate_uuid():
     return uuid4().hex
 
@@ -14,12 +28,17 @@ def generate_expiration():
     '''
     return datetime.utcnow() + timedelta(days=14)
 
-def clear_expired_sessions(conn):
-    now = datetime.utcnow()
-    sessions = conn.query(Session).where(Session.expiration <= now).all()
-    for s in sessions:
-        conn.delete(s)
-    conn.commit()
+def _timestamp(value: datetime) -> float:
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(body: str) -> bytes:
+    return hmac.new(SESSION_SIGNING_KEY, body.encode(), hashlib.sha256).digest()
 
 class Session(Base):
     '''
@@ -31,7 +50,8 @@ class Session(Base):
     expiration = Column(
         DateTime,
         nullable=False,
-        default=generate_expiration
+        default=generate_expiration,
+        index=True
     )
     token = Column(
         String(length=32),
@@ -53,10 +73,95 @@ class Session(Base):
     @classmethod
     def validate(cls, token: str, conn):
         '''
-        Validate the given token
+        Validate the given token. Expired sessions are treated as invalid,
+        they are deleted separately by the background session sweeper
         '''
-        session = conn.query(cls).where(cls.token == token).first()
+        session = conn.query(cls).where(
+            cls.token == token,
+            cls.expiration > datetime.utcnow()
+        ).first()
+
+        return session
 
-        clear_expired_sessions(conn)
+    @staticmethod
+    def is_signed(token: str) -> bool:
+        return token.startswith(SIGNED_TOKEN_PREFIX)
 
-        return session
\ No newline at end of file
+    @classmethod
+    def issue_signed(cls, user, conn) -> str:
+        '''
+        Create a stateless session token for the user. The token carries
+        everything needed to authorize requests without a database lookup
+        '''
+        if SESSION_SIGNING_KEY == b"":
+            raise RuntimeError("SESSION_SIGNING_KEY must be set to issue signed session tokens")
+        revocation = conn.get(UserRevocation, user.user_id)
+        now = datetime.utcnow()
+        payload = {
+            "j": uuid4().hex,
+            "u": user.user_id,
+            "i": _timestamp(now),
+            "e": _timestamp(generate_expiration()),
+            "v": revocation.permissions_version if revocation is not None else 0,
+            "p": sorted(user.all_permissions),
+        }
+        body = SIGNED_TOKEN_PREFIX + _b64encode(json.dumps(payload, separators=(",", ":")).encode())
+        return body + "." + _b64encode(_sign(body))
+
+    @classmethod
+    def _decode_signed(cls, token: str):
+        '''
+        Return the payload of a correctly signed, unexpired token, or None
+        '''
+        if SESSION_SIGNING_KEY == b"" or not cls.is_signed(token):
+            return None
+        body, _, signature = token.rpartition(".")
+        try:
+            if not hmac.compare_digest(_b64decode(signature), _sign(body)):
+                return None
+            payload = json.loads(_b64decode(body[len(SIGNED_TOKEN_PREFIX):]))
+        except ValueError:
+            return None
+        if payload["e"] <= _timestamp(datetime.utcnow()):
+            return None
+        return payload
+
+    @classmethod
+    def verify_signed(cls, token: str, conn = None):
+        '''
+        Verify a signed session token and return its Principal, or None.
+        The database is only used when the permissions carried by the token
+        are out of date and a connection was given to re-resolve them
+        '''
+        payload = cls._decode_signed(token)
+        if payload is None:
+            return None
+        user_id = payload["u"]
+        if REVOCATION_LIST.is_revoked(payload["j"], user_id, datetime.utcfromtimestamp(payload["i"])):
+            return None
+        permissions = frozenset(payload["p"])
+        if payload["v"] < REVOCATION_LIST.permissions_version(user_id):
+            if conn is None:
+                return None
+            user = conn.get(User, user_id)
+            if user is None:
+                return None
+            permissions = frozenset(user.all_permissions)
+        return Principal(
+            user_id=user_id,
+            expiration=datetime.utcfromtimestamp(payload["e"]),
+            permissions=permissions
+        )
+
+    @classmethod
+    def revoke_signed(cls, token: str, conn):
+        '''
+        Add a signed token to the revocation list
+        '''
+        payload = cls._decode_signed(token)
+        if payload is None:
+            return
+        expiration = datetime.utcfromtimestamp(payload["e"])
+        conn.add(RevokedToken(token_id=payload["j"], user_id=payload["u"], expiration=expiration))
+        conn.commit()
+        REVOCATION_LIST.revoke_token(payload["j"], expiration)
@@ -1,11 +1,22 @@
-import hashlib
-from sqlalchemy import Column, String, Integer, Boolean
-from sqlalchemy.orm import relationship, Mapped
+from sqlalchemy import Column, String, Integer, Boolean, select
+from sqlalchemy.orm import relationship, Mapped, object_session
 from backsite.db.schema import Base
 from backsite.db.connection import create_connection
+from backsite.db.principal import PRINCIPAL_CACHE
+from backsite.db.schema.revocation import UserRevocation
+from backsite.utils.hashing import HASHER
 from uuid import uuid4
 
-HASH_FUNCTION = hashlib.sha512
+# Postgres' default names for the unique constraints on backsite_user
+UNIQUE_CONSTRAINT_FIELDS = {
+    "backsite_user_email_key": "email",
+    "backsite_user_username_key": "username",
+}
+
+# Field sets for User.serialize. Only public fields may be shown next to
+# content other users can see
+PUBLIC_USER_FIELDS = ("user_id", "username")
+PRIVATE_USER_FIELDS = ("user_id", "email", "username", "verified", "groups", "permissions")
 
 def generate_salt():
     '''
@@ -48,23 +59,86 @@ class User(Base):
     permissions = relationship("Permission", secondary="user_permissions", back_populates="users")
     # List of groups the user is part of
     groups = relationship("Group", secondary="user_groups", back_populates="users")
+    # Users this user follows and users following this user. Read only,
+    # follow() and unfollow() also maintain the home timelines
+    following = relationship(
+        "User",
+        secondary="follows",
+        primaryjoin="User.user_id == follows.c.follower_id",
+        secondaryjoin="User.user_id == follows.c.followee_id",
+        back_populates="followers",
+        viewonly=True
+    )
+    followers = relationship(
+        "User",
+        secondary="follows",
+        primaryjoin="User.user_id == follows.c.followee_id",
+        secondaryjoin="User.user_id == follows.c.follower_id",
+        back_populates="following",
+        viewonly=True
+    )
 
     @property
     def json(self) -> dict:
         '''
         Return JSON representation of the user
         '''
-        return {
-            "user_id": self.user_id,
-            "email": self.email,
-            "username": self.username,
-            "verified": self.verified,
-            "groups": [group.json for group in self.groups],
-            "permissions": [p for p in self.all_permissions]
-        }
+        return User.serialize([self])[0]
+
+    @property
+    def public_json(self) -> dict:
+        '''
+        Return the JSON representation other users may see
+        '''
+        return User.serialize([self], PUBLIC_USER_FIELDS)[0]
+
+    @classmethod
+    def serialize(cls, users: list, fields: tuple = PRIVATE_USER_FIELDS) -> list:
+        '''
+        Serialize users with the given field set. Groups and permissions are
+        only loaded when requested, with one query each for all the users
+        '''
+        saved = [user for user in users if user.user_id is not None and object_session(user) is not None]
+        conn = object_session(saved[0]) if len(saved) > 0 else None
+        user_ids = [user.user_id for user in saved]
+        groups = {}
+        permissions = {}
+        if "groups" in fields and conn is not None:
+            memberships = Base.metadata.tables["user_groups"]
+            statement = select(memberships.c.user_id, memberships.c.group).where(memberships.c.user_id.in_(user_ids))
+            for user_id, group in conn.execute(statement):
+                groups.setdefault(user_id, []).append({"group_name": group})
+        if "permissions" in fields and conn is not None:
+            effective = Base.metadata.tables["user_effective_permissions"]
+            statement = select(effective.c.user_id, effective.c.permission).where(effective.c.user_id.in_(user_ids))
+            for user_id, permission in conn.execute(statement):
+                permissions.setdefault(user_id, []).append(permission)
+        batched = set(user_ids) if conn is not None else set()
+        serialized = []
+        for user in users:
+            data = {}
+            for field in fields:
+                if field == "groups":
+                    data["groups"] = groups.get(user.user_id, []) if user.user_id in batched else [group.json for group in user.groups]
+                elif field == "permissions":
+                    data["permissions"] = permissions.get(user.user_id, []) if user.user_id in batched else list(user.all_permissions)
+                else:
+                    data[field] = getattr(user, field)
+            serialized.append(data)
+        return serialized
 
     @property
     def all_permissions(self):
+        '''
+        Names of every permission the user holds directly or through a group
+        '''
+        conn = object_session(self)
+        if conn is not None and self.user_id is not None:
+            # One indexed lookup against the materialized permissions
+            effective = Base.metadata.tables["user_effective_permissions"]
+            rows = conn.query(effective.c.permission).where(effective.c.user_id == self.user_id)
+            return {row.permission for row in rows}
+        # Users that haven't been saved yet: walk the relationships
         permission_set = set()
         for permission in self.permissions:
             permission_set.add(permission.permission_name)
@@ -76,15 +150,10 @@ class User(Base):
     @classmethod
     def calculate_salted_hash(cls, salt: str, password: str):
         '''
-        Generate a hash based on the given salt and password
+        Generate a hash based on the given salt and password.
+        Raises HashingBusyError when the hashing pool is saturated
         '''
-        # Take half the salt and prepend it to the password
-        pre_salt = salt[:16]
-        # Take the other half and append it to the password
-        post_salt = salt[16:]
-        salted_password = pre_salt + password + post_salt
-        # Calculate salted hash
-        return HASH_FUNCTION(salted_password.encode()).hexdigest()
+        return HASHER.hash(password, salt)
 
     @classmethod
     def create_user(cls, username: str, email: str, password: str, verified: bool = False):
@@ -96,7 +165,15 @@ class User(Base):
         # Apply salt to given password and calculate the hash
         salted_password_hash = cls.calculate_salted_hash(salt, password)
         # Create new user
-        u = User(username=username, email=email, password_hash=salted_password_hash, salt=salt, verified=verified)
+        u = User(
+            username=username,
+            email=email,
+            password_hash=salted_password_hash,
+            salt=salt,
+            verified=verified,
+            # Set now rather than at insert so jobs can be queued in the same transaction
+            user_secret=generate_user_secret()
+        )
         return u
     
     @classmethod
@@ -109,12 +186,12 @@ class User(Base):
         # If we couldn't find the user, return None
         if user is None or not user.verified:
             return None
-        # Calculate salted hash using the user's salt and the given password
-        salted_password_hash = cls.calculate_salted_hash(user.salt, password)
-        
-        # If the calculated hash doesn't match the user's hash, return None
-        if salted_password_hash != user.password_hash:
+        # If the password doesn't match the user's hash, return None
+        if not user.check_password(password):
             return None
+        # Save the upgraded hash if the stored one was outdated
+        if conn.is_modified(user):
+            conn.commit()
 
         return user
     
@@ -122,17 +199,12 @@ class User(Base):
     def verify(cls, username: str, password: str, secret, conn):
         user = conn.query(cls).where(cls.username == username).first()
         if user is None:
-            conn.close()
             return None
-        # Calculate salted hash using the user's salt and the given password
-        salted_password_hash = cls.calculate_salted_hash(user.salt, password)
-        # Verify that hashes match
-        if salted_password_hash != user.password_hash:
-            conn.close()
+        # Verify that the password matches
+        if not user.check_password(password):
             return None
         # Verify that the provided secret matches
         if secret != user.user_secret:
-            conn.close()
             return None
         # Mark user as verified
         user.verified = True
@@ -143,34 +215,73 @@ class User(Base):
         return user
     
     @classmethod
-    def email_in_use(cls, email: str):
-        conn = create_connection()
-        existing = conn.query(cls).where(cls.email == email).first()
-        conn.close()
-        return existing is not None
+    def conflicting_field(cls, error):
+        '''
+        Return the field ("email" or "username") whose unique constraint
+        the given IntegrityError violated, or None
+        '''
+        diag = getattr(error.orig, "diag", None)
+        constraint_name = getattr(diag, "constraint_name", None)
+        if constraint_name in UNIQUE_CONSTRAINT_FIELDS:
+            return UNIQUE_CONSTRAINT_FIELDS[constraint_name]
+        # Fall back to the error text for drivers without diagnostics
+        message = str(error.orig)
+        for constraint_name, field in UNIQUE_CONSTRAINT_FIELDS.items():
+            if constraint_name in message:
+                return field
+        return None
+
+    @classmethod
+    def email_in_use(cls, email: str, conn = None):
+        return cls._value_in_use(cls.email, email, conn)
+
+    @classmethod
+    def username_in_use(cls, username: str, conn = None):
+        return cls._value_in_use(cls.username, username, conn)
 
     @classmethod
-    def username_in_use(cls, username: str):
-        conn = create_connection()
-        existing = conn.query(cls).where(cls.username == username).first()
-        conn.close()
+    def _value_in_use(cls, column, value: str, conn = None):
+        '''
+        Check whether a user already has the given value in the given column.
+        Reuses the caller's connection when one is given
+        '''
+        own_connection = conn is None
+        if own_connection:
+            conn = create_connection()
+        existing = conn.query(cls.user_id).where(column == value).first()
+        if own_connection:
+            conn.close()
         return existing is not None
     
     def shuffle_secret(self):
         self.user_secret = generate_user_secret()
 
+    def check_password(self, password: str) -> bool:
+        '''
+        Verify the given password. Legacy or outdated hashes are transparently
+        upgraded on success, the caller is responsible for committing
+        '''
+        matches, needs_rehash = HASHER.verify(password, self.salt, self.password_hash)
+        if needs_rehash:
+            self.password_hash = HASHER.hash(password, self.salt)
+        return matches
+
     def change_password(self, old_password, new_password):
-        # Calculate old password candidate hash
-        old_hash = self.__class__.calculate_salted_hash(self.salt, old_password)
-        if old_hash != self.password_hash:
+        # Verify the old password
+        if not HASHER.verify(old_password, self.salt, self.password_hash)[0]:
             return False
         # Calculate new password hash
         new_hash = self.__class__.calculate_salted_hash(self.salt, new_password)
         self.password_hash = new_hash
+        # Sessions authenticated with the old password must be re-validated
+        PRINCIPAL_CACHE.invalidate_user(self.user_id)
         # Return True to indicate success
         return True
     
     def clear_sessions(self, conn):
         for session in self.sessions:
             conn.delete(session)
-        conn.commit()
\ No newline at end of file
+        # Signed session tokens can't be deleted, revoke them instead
+        UserRevocation.invalidate_sessions(self.user_id, conn)
+        conn.commit()
+        PRINCIPAL_CACHE.invalidate_user(self.user_id)
\ No newline at end of file
@@ -0,0 +1,196 @@
+'''
+Full text search over the posts index
+'''
+import os
+import json
+import base64
+import threading
+from elasticsearch import NotFoundError, RequestError
+from backsite.db.elastic import get_elastic_connection
+from backsite.utils.cache import LRUCache
+
+POST_INDEX = "posts"
+# How long a search's point in time stays open after each page
+SEARCH_KEEP_ALIVE = os.getenv("SEARCH_KEEP_ALIVE", "2m")
+# Result pages cached per worker, 0 disables the cache. Kept short since
+# new posts only show up in searches once their cached pages expire
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "10"))
+SEARCH_CACHE = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL) if SEARCH_CACHE_SIZE > 0 else None
+# Document fields matched against the query, and the ones returned per hit.
+# Contents are left out of results, they can be large
+SEARCH_FIELDS = ["title^2", "content"]
+SEARCH_SOURCE_FIELDS = ["title", "author", "timestamp", "replying_to"]
+# Mapping of indexes created by the reindex command. Documents have the
+# shape of Post.serialize with the content added
+POST_INDEX_MAPPINGS = {
+    "properties": {
+        "post_id": {"type": "long"},
+        "title": {"type": "text"},
+        "content": {"type": "text"},
+        "timestamp": {"type": "date"},
+        "replying_to": {"type": "long"},
+        "author": {
+            "properties": {
+                "user_id": {"type": "long"},
+                "username": {"type": "keyword"},
+            }
+        },
+    }
+}
+
+class SearchStatistics:
+    '''
+    Per worker counters of search requests, cache hits, points in time
+    opened and the time Elasticsearch reported spending on searches
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.pits_opened = 0
+        self.took_total = 0
+        self.took_max = 0
+
+    def record(self, took: int = None):
+        '''
+        Record one search, took is None when it was answered from the cache
+        '''
+        with self._lock:
+            self.requests += 1
+            if took is None:
+                self.cache_hits += 1
+            else:
+                self.took_total += took
+                self.took_max = max(self.took_max, took)
+
+    def record_pit(self):
+        with self._lock:
+            self.pits_opened += 1
+
+    @property
+    def json(self) -> dict:
+        with self._lock:
+            searched = self.requests - self.cache_hits
+            return {
+                "requests": self.requests,
+                "cache_hits": self.cache_hits,
+                "hit_rate": self.cache_hits / self.requests if self.requests > 0 else 0.0,
+                "pits_opened": self.pits_opened,
+                "took_mean_ms": self.took_total / searched if searched > 0 else 0.0,
+                "took_max_ms": self.took_max,
+            }
+
+SEARCH_STATISTICS = SearchStatistics()
+
+def post_document(post_id: int, title: str, timestamp, author_id: int, username: str, replying_to: int, content: str) -> dict:
+    '''
+    Build a post's search document from its columns, for writers that
+    don't go through Post.serialize
+    '''
+    return {
+        "post_id": post_id,
+        "title": title,
+        "author": {"user_id": author_id, "username": username},
+        "timestamp": timestamp.isoformat(),
+        "replying_to": replying_to,
+        "content": content or "",
+    }
+
+def normalize_query(query: str) -> str:
+    '''
+    Case and whitespace don't change results, so they don't split the cache
+    '''
+    return " ".join(query.lower().split())
+
+def encode_search_cursor(pit_id: str, after: list) -> str:
+    '''
+    Opaque cursor holding the search's point in time and the sort values of
+    the last hit returned
+    '''
+    data = json.dumps({"pit": pit_id, "after": after}).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str):
+    '''
+    Return the (pit_id, after) of a cursor. Raises ValueError for malformed cursors
+    '''
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        pit_id, after = data["pit"], data["after"]
+        if type(pit_id) != str or type(after) != list:
+            raise ValueError()
+        return pit_id, after
+    except (TypeError, ValueError, KeyError):
+        raise ValueError("Invalid cursor")
+
+def search_posts(query: str, cursor: str = None, limit: int = 20) -> dict:
+    '''
+    Return a page of posts matching the query, best match first, with the
+    cursor of the next page (None on the last page). The first page
+    searches the index directly. Only when it has a next page is a point in
+    time opened, which later pages search with search_after, so results
+    don't shift while paging and deep pages cost the same as the first.
+    Pages are cached by normalized query and cursor.
+    Raises ValueError for empty queries and invalid or expired cursors
+    '''
+    normalized = normalize_query(query)
+    if normalized == "":
+        raise ValueError("Expected a search query")
+    key = (normalized, cursor, limit)
+    page = SEARCH_CACHE.get(key) if SEARCH_CACHE is not None else None
+    if page is not None:
+        SEARCH_STATISTICS.record()
+        return dict(page, cached=True)
+
+    es = get_elastic_connection()
+    body = {
+        "query": {"multi_match": {"query": normalized, "fields": SEARCH_FIELDS}},
+        # post_id breaks ties between equal scores, so search_after never skips or repeats a hit
+        "sort": [{"_score": "desc"}, {"post_id": "asc"}],
+        "_source": SEARCH_SOURCE_FIELDS,
+        # One extra hit tells whether there is a next page
+        "size": limit + 1,
+        "track_total_hits": False,
+    }
+    if cursor is None:
+        pit_id = None
+        response = es.search(index=POST_INDEX, body=body)
+    else:
+        pit_id, after = decode_search_cursor(cursor)
+        body["pit"] = {"id": pit_id, "keep_alive": SEARCH_KEEP_ALIVE}
+        body["search_after"] = after
+        try:
+            response = es.search(body=body)
+        except (NotFoundError, RequestError):
+            raise ValueError("Search has expired, start a new search")
+    SEARCH_STATISTICS.record(response["took"])
+
+    hits = response["hits"]["hits"]
+    posts = [
+        {
+            "post_id": int(hit["_id"]),
+            "title": hit["_source"].get("title"),
+            "author": hit["_source"].get("author"),
+            "timestamp": hit["_source"].get("timestamp"),
+            "replying_to": hit["_source"].get("replying_to"),
+            "score": hit["_score"],
+        }
+        for hit in hits[:limit]
+    ]
+    if len(hits) > limit:
+        if pit_id is None:
+            # Single page searches, most of them, never hold a point in time.
+            # Later pages may include posts indexed since the first
+            pit_id = es.open_point_in_time(index=POST_INDEX, keep_alive=SEARCH_KEEP_ALIVE)["id"]
+            SEARCH_STATISTICS.record_pit()
+        else:
+            # The point in time may be replaced between pages
+            pit_id = response.get("pit_id", pit_id)
+        next_cursor = encode_search_cursor(pit_id, hits[limit - 1]["sort"])
+    else:
+        next_cursor = None
+    page = {"posts": posts, "next_cursor": next_cursor, "took": response["took"]}
+    if SEARCH_CACHE is not None:
+        SEARCH_CACHE.put(key, page)
+    return dict(page, cached=False)
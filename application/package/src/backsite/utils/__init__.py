@@ -1,8 +1,42 @@
+import os
 import json
+import threading
+from time import monotonic
 
 CONFIG_PATH = "/opt/configuration/config.json"
+# Minimum time between checks of a cached file's modification time
+FILE_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1"))
+
+class CachedFile:
+    '''
+    Keeps the parsed contents of a file in memory and reloads it only when
+    the file's modification time changes
+    '''
+    def __init__(self, path: str, parse, check_interval: float = FILE_CHECK_INTERVAL):
+        self.path = path
+        self.parse = parse
+        self.check_interval = check_interval
+        self.value = None
+        self.mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if monotonic() < self._next_check and self.value is not None:
+            return self.value
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime or self.value is None:
+                with open(self.path, "r") as f:
+                    self.value = self.parse(f.read())
+                self.mtime = mtime
+            self._next_check = monotonic() + self.check_interval
+        return self.value
+
+CONFIG_FILE = CachedFile(CONFIG_PATH, json.loads)
 
 def get_configuration():
-    with open(CONFIG_PATH,"r") as f:
-        data = json.loads(f.read())
-        return data
\ No newline at end of file
+    '''
+    Return the parsed configuration file. The returned dictionary is shared, don't modify it
+    '''
+    return CONFIG_FILE.get()
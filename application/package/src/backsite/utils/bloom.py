@@ -0,0 +1,64 @@
+'''
+Compact probabilistic set membership
+'''
+import math
+import hashlib
+import threading
+
+class BloomFilter:
+    '''
+    Bloom filter sized for an expected number of items and a target false
+    positive rate. A negative answer is always correct, a positive answer
+    is wrong with roughly the configured probability
+    '''
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.bit_count = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.bit_count / self.capacity * math.log(2))))
+        self.items = 0
+        self._bits = bytearray((self.bit_count + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, value: str):
+        # Kirsch-Mitzenmacher double hashing from a single digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, value: str):
+        positions = self._positions(value)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.items += 1
+
+    def __contains__(self, value: str) -> bool:
+        bits = self._bits
+        for position in self._positions(value):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._bits)
+
+    @property
+    def estimated_error_rate(self) -> float:
+        '''
+        Expected false positive rate given the number of items added so far
+        '''
+        return (1 - math.exp(-self.hash_count * self.items / self.bit_count)) ** self.hash_count
+
+    @property
+    def json(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "items": self.items,
+            "size_bytes": self.size_bytes,
+            "hash_count": self.hash_count,
+            "target_error_rate": self.error_rate,
+            "estimated_error_rate": self.estimated_error_rate,
+        }
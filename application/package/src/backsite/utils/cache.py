@@ -0,0 +1,289 @@
+'''
+In-process and cross-process caches
+'''
+import os
+import mmap
+import fcntl
+import struct
+import threading
+import zlib
+from time import time, monotonic
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class CacheStatistics:
+    '''
+    Counters shared by the cache implementations below
+    '''
+    FIELDS = ("hits", "misses", "evictions", "expirations", "invalidations")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+
+    def increment(self, counter: str, amount: int = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    @property
+    def json(self) -> dict:
+        with self._lock:
+            data = {field: getattr(self, field) for field in self.FIELDS}
+        lookups = data["hits"] + data["misses"]
+        data["hit_rate"] = data["hits"] / lookups if lookups > 0 else 0.0
+        return data
+
+class LRUCache:
+    '''
+    Thread-safe least recently used cache where every entry expires after a TTL
+    '''
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStatistics()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.increment("misses")
+                return default
+            value, deadline = entry
+            if deadline <= monotonic():
+                del self._entries[key]
+                self.stats.increment("expirations")
+                self.stats.increment("misses")
+                return default
+            self._entries.move_to_end(key)
+        self.stats.increment("hits")
+        return value
+
+    def put(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.increment("evictions")
+
+    def pop(self, key, default = None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self.stats.increment("invalidations")
+        return entry[0]
+
+    def remove_where(self, predicate):
+        '''
+        Remove every entry whose value matches the given predicate
+        '''
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+            for key in keys:
+                del self._entries[key]
+        self.stats.increment("invalidations", len(keys))
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+        self.stats.increment("invalidations", count)
+
+class SharedMemoryTable:
+    '''
+    Fixed-size, direct-mapped hash table stored in a memory mapped file so
+    that every process on the host can share it. Readers are lock-free
+    (each slot is guarded by a sequence counter), writers serialize on a
+    file lock. Deleted keys and tags are appended to a small ring of
+    invalidations that processes replay against their private caches, and
+    clear bumps a global epoch that tells them to drop those caches.
+    Keys must be 32 byte digests
+    '''
+    MAGIC = b"BSCACHE2"
+    # magic, epoch, generation, invalidations logged
+    HEADER = struct.Struct("<8sQQQ")
+    HEADER_SIZE = 64
+    # sequence, key (empty for tags), tag
+    LOG_ENTRY = struct.Struct("<Q32sq")
+    SLOT_HEADER = struct.Struct("<QQd32sqH")
+    SEQUENCE = struct.Struct("<Q")
+
+    def __init__(self, path: str, slots: int = 4096, value_size: int = 512, log_size: int = 1024):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self.log_size = log_size
+        self.slot_size = self.SLOT_HEADER.size + value_size
+        self.stats = CacheStatistics()
+        self._thread_lock = threading.Lock()
+        self._slots_start = self.HEADER_SIZE + self.log_size * self.LOG_ENTRY.size
+        size = self._slots_start + self.slots * self.slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic = self.HEADER.unpack_from(self._map, 0)[0]
+            if magic != self.MAGIC:
+                self._map[:] = bytes(size)
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, 0, 0, 0)
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Exclusive writer lock across threads (lock) and processes (lockf)
+        '''
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def epoch(self) -> int:
+        return self.HEADER.unpack_from(self._map, 0)[1]
+
+    @property
+    def generation(self) -> int:
+        return self.HEADER.unpack_from(self._map, 0)[2]
+
+    @property
+    def invalidation_sequence(self) -> int:
+        return self.HEADER.unpack_from(self._map, 0)[3]
+
+    def _log_invalidation(self, key: bytes = None, tag: int = 0):
+        '''
+        Append a deleted key or tag to the ring. Called with the writer lock held
+        '''
+        magic, epoch, generation, sequence = self.HEADER.unpack_from(self._map, 0)
+        sequence += 1
+        offset = self.HEADER_SIZE + (sequence % self.log_size) * self.LOG_ENTRY.size
+        # Readers check the entry's sequence before and after reading it
+        self.SEQUENCE.pack_into(self._map, offset, 0)
+        self.LOG_ENTRY.pack_into(self._map, offset, sequence, key or bytes(32), tag)
+        self.HEADER.pack_into(self._map, 0, magic, epoch, generation, sequence)
+
+    def invalidations(self, since: int):
+        '''
+        Return the invalidation sequence and the (key, tag) pairs logged
+        after since, key being None for tags. The pairs are None when the
+        ring has been overwritten since then
+        '''
+        sequence = self.invalidation_sequence
+        if sequence - since > self.log_size:
+            return sequence, None
+        entries = []
+        for expected in range(since + 1, sequence + 1):
+            offset = self.HEADER_SIZE + (expected % self.log_size) * self.LOG_ENTRY.size
+            entry_sequence, key, tag = self.LOG_ENTRY.unpack_from(self._map, offset)
+            if entry_sequence != expected or self.SEQUENCE.unpack_from(self._map, offset)[0] != expected:
+                return sequence, None
+            entries.append((None if key == bytes(32) else key, tag))
+        return sequence, entries
+
+    def _offset(self, key: bytes) -> int:
+        return self._slots_start + (zlib.crc32(key) % self.slots) * self.slot_size
+
+    def _read_slot(self, offset: int):
+        '''
+        Read a consistent copy of a slot, or None if a writer kept racing us
+        '''
+        for _ in range(4):
+            sequence = self.SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence & 1:
+                continue
+            header = self.SLOT_HEADER.unpack_from(self._map, offset)
+            value_start = offset + self.SLOT_HEADER.size
+            value = bytes(self._map[value_start:value_start + header[5]])
+            if self.SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                return header, value
+        return None
+
+    def _write_slot(self, offset: int, generation: int, deadline: float, key: bytes, tag: int, value: bytes):
+        sequence = self.SEQUENCE.unpack_from(self._map, offset)[0]
+        self.SEQUENCE.pack_into(self._map, offset, sequence + 1)
+        self.SLOT_HEADER.pack_into(self._map, offset, sequence + 1, generation, deadline, key, tag, len(value))
+        value_start = offset + self.SLOT_HEADER.size
+        self._map[value_start:value_start + len(value)] = value
+        self.SEQUENCE.pack_into(self._map, offset, sequence + 2)
+
+    def get(self, key: bytes):
+        '''
+        Return (value, tag) for the key, or None
+        '''
+        slot = self._read_slot(self._offset(key))
+        if slot is None:
+            self.stats.increment("misses")
+            return None
+        (_, generation, deadline, slot_key, tag, _), value = slot
+        if slot_key != key or generation != self.generation:
+            self.stats.increment("misses")
+            return None
+        if deadline <= time():
+            self.stats.increment("expirations")
+            self.stats.increment("misses")
+            return None
+        self.stats.increment("hits")
+        return value, tag
+
+    def put(self, key: bytes, value: bytes, tag: int = 0, ttl: float = 60.0) -> bool:
+        if len(value) > self.value_size or ttl <= 0:
+            return False
+        offset = self._offset(key)
+        with self._locked():
+            (_, generation, deadline, slot_key, _, _) = self.SLOT_HEADER.unpack_from(self._map, offset)
+            current_generation = self.generation
+            if slot_key != key and generation == current_generation and deadline > time():
+                self.stats.increment("evictions")
+            self._write_slot(offset, current_generation, time() + ttl, key, tag, value)
+        return True
+
+    def delete(self, key: bytes):
+        offset = self._offset(key)
+        with self._locked():
+            slot_key = self.SLOT_HEADER.unpack_from(self._map, offset)[3]
+            if slot_key == key:
+                self._write_slot(offset, 0, 0.0, bytes(32), 0, b"")
+            self._log_invalidation(key=key)
+        self.stats.increment("invalidations")
+
+    def delete_tag(self, tag: int):
+        '''
+        Remove every entry stored with the given tag
+        '''
+        removed = 0
+        with self._locked():
+            for index in range(self.slots):
+                offset = self._slots_start + index * self.slot_size
+                if self.SLOT_HEADER.unpack_from(self._map, offset)[4] == tag:
+                    self._write_slot(offset, 0, 0.0, bytes(32), 0, b"")
+                    removed += 1
+            self._log_invalidation(tag=tag)
+        self.stats.increment("invalidations", removed)
+        return removed
+
+    def clear(self):
+        '''
+        Drop every entry by moving to a new generation, and bump the epoch
+        so processes drop their private caches
+        '''
+        with self._locked():
+            magic, epoch, generation, sequence = self.HEADER.unpack_from(self._map, 0)
+            self.HEADER.pack_into(self._map, 0, magic, epoch + 1, generation + 1, sequence)
+        self.stats.increment("invalidations")
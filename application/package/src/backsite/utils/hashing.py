@@ -0,0 +1,157 @@
+'''
+Password hashing service
+
+Passwords are hashed with scrypt, a memory-hard KDF. The KDF work runs in
+a small process pool so it neither holds the GIL in the gunicorn worker
+nor stalls its other request threads, and the number of queued hashes is
+bounded: when the pool is saturated callers fail fast with
+HashingBusyError instead of piling up behind each other.
+
+Stored hashes are versioned:
+    legacy SHA-512:  128 hex characters
+    scrypt:          $scrypt$ln=<log2 N>,r=<r>,p=<p>$<base64 digest>
+'''
+import os
+import hmac
+import base64
+import hashlib
+import threading
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of processes doing KDF work, 0 hashes inline on the calling thread
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", "2"))
+# Maximum hashes running or waiting per worker before new ones are rejected
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "8"))
+# How long a caller may wait for a queue slot before failing
+HASH_QUEUE_TIMEOUT = float(os.getenv("HASH_QUEUE_TIMEOUT", "0.1"))
+SCRYPT_LOG_N = int(os.getenv("SCRYPT_LOG_N", "14"))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+SCRYPT_DIGEST_SIZE = 32
+SCRYPT_PREFIX = "$scrypt$"
+
+class HashingBusyError(Exception):
+    '''
+    Raised when the hashing pool has no capacity left for another hash
+    '''
+    pass
+
+def legacy_hash(salt: str, password: str) -> str:
+    '''
+    Original salted SHA-512 scheme, only used to verify and upgrade old hashes
+    '''
+    # Take half the salt and prepend it to the password, the other half is appended
+    salted_password = salt[:16] + password + salt[16:]
+    return hashlib.sha512(salted_password.encode()).hexdigest()
+
+def scrypt_digest(password: str, salt: str, log_n: int, r: int, p: int) -> bytes:
+    n = 1 << log_n
+    return hashlib.scrypt(
+        password.encode(),
+        salt=salt.encode(),
+        n=n,
+        r=r,
+        p=p,
+        maxmem=256 * n * r * p,
+        dklen=SCRYPT_DIGEST_SIZE
+    )
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+def parse_scrypt_hash(stored: str):
+    '''
+    Split a stored scrypt hash into (log_n, r, p, digest)
+    '''
+    parameters, digest = stored[len(SCRYPT_PREFIX):].split("$")
+    values = dict(item.split("=") for item in parameters.split(","))
+    return int(values["ln"]), int(values["r"]), int(values["p"]), _b64decode(digest)
+
+class PasswordHasher:
+    '''
+    Hashes and verifies passwords using a bounded process pool
+    '''
+    def __init__(self, pool_size: int, queue_limit: int, queue_timeout: float, log_n: int, r: int, p: int):
+        self.pool_size = pool_size
+        self.queue_timeout = queue_timeout
+        self.log_n = log_n
+        self.r = r
+        self.p = p
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    # spawn rather than fork, this process has threads and open sockets
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.pool_size,
+                        mp_context=multiprocessing.get_context("spawn")
+                    )
+                    self._executor_pid = pid
+        return self._executor
+
+    def _digest(self, password: str, salt: str, log_n: int, r: int, p: int) -> bytes:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self.rejected += 1
+            raise HashingBusyError("Password hashing capacity exhausted")
+        start = perf_counter()
+        try:
+            if self.pool_size <= 0:
+                return scrypt_digest(password, salt, log_n, r, p)
+            return self._get_executor().submit(scrypt_digest, password, salt, log_n, r, p).result()
+        finally:
+            self._slots.release()
+            self.completed += 1
+            self.total_seconds += perf_counter() - start
+
+    def hash(self, password: str, salt: str) -> str:
+        '''
+        Hash a password with the current KDF parameters
+        '''
+        digest = self._digest(password, salt, self.log_n, self.r, self.p)
+        return f"{SCRYPT_PREFIX}ln={self.log_n},r={self.r},p={self.p}${_b64encode(digest)}"
+
+    def verify(self, password: str, salt: str, stored: str):
+        '''
+        Check a password against a stored hash.
+        Returns (matches, needs_rehash) where needs_rehash means the stored
+        hash uses a legacy format or outdated parameters
+        '''
+        if not stored.startswith(SCRYPT_PREFIX):
+            matches = hmac.compare_digest(legacy_hash(salt, password), stored)
+            return matches, matches
+        log_n, r, p, expected = parse_scrypt_hash(stored)
+        matches = hmac.compare_digest(self._digest(password, salt, log_n, r, p), expected)
+        outdated = (log_n, r, p) != (self.log_n, self.r, self.p)
+        return matches, matches and outdated
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "pool_size": self.pool_size,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "average_seconds": self.total_seconds / self.completed if self.completed > 0 else 0.0,
+        }
+
+HASHER = PasswordHasher(
+    pool_size=HASH_POOL_SIZE,
+    queue_limit=HASH_QUEUE_LIMIT,
+    queue_timeout=HASH_QUEUE_TIMEOUT,
+    log_n=SCRYPT_LOG_N,
+    r=SCRYPT_R,
+    p=SCRYPT_P
+)
@@ -0,0 +1,167 @@
+'''
+Long-lived RabbitMQ publisher shared by the threads of a worker process
+'''
+import os
+import sys
+import json
+import threading
+import pika
+from time import perf_counter, monotonic, sleep, time
+from traceback import print_exc
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+RABBITMQ_HEARTBEAT = int(os.getenv("RABBITMQ_HEARTBEAT", "60"))
+# Wait for the broker to confirm every published message
+RABBITMQ_PUBLISHER_CONFIRMS = os.getenv("RABBITMQ_PUBLISHER_CONFIRMS", "false").lower() in ("1", "true", "yes")
+# Reconnect attempts per publish, with exponential backoff starting at RABBITMQ_RETRY_BACKOFF seconds
+RABBITMQ_PUBLISH_RETRIES = int(os.getenv("RABBITMQ_PUBLISH_RETRIES", "2"))
+RABBITMQ_RETRY_BACKOFF = float(os.getenv("RABBITMQ_RETRY_BACKOFF", "0.1"))
+# After all retries failed, fail fast for this long instead of retrying again
+RABBITMQ_FAILURE_COOLDOWN = float(os.getenv("RABBITMQ_FAILURE_COOLDOWN", "5"))
+
+def stamp_enqueued(data):
+    '''
+    Record when a job message was enqueued so the jobs daemon can measure
+    end-to-end latency. Messages already stamped keep their original time
+    '''
+    if isinstance(data, dict) and "enqueued_at" not in data:
+        data = {**data, "enqueued_at": time()}
+    return data
+
+class PublisherStatistics:
+    '''
+    Publish counters and latency totals
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+        self.reconnects = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, messages: int, latency: float, success: bool):
+        with self._lock:
+            if success:
+                self.published += messages
+            else:
+                self.failed += messages
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+
+    @property
+    def json(self) -> dict:
+        with self._lock:
+            attempts = self.published + self.failed
+            return {
+                "published": self.published,
+                "failed": self.failed,
+                "reconnects": self.reconnects,
+                "average_latency_seconds": self.total_latency / attempts if attempts > 0 else 0.0,
+                "max_latency_seconds": self.max_latency,
+            }
+
+class RabbitMQPublisher:
+    '''
+    Reuses one connection and channel for every publish in this process.
+    pika's BlockingConnection isn't thread-safe, so publishes are serialized.
+    Delivery is at-least-once: a batch interrupted by a connection failure
+    is retried in full
+    '''
+    def __init__(self, host: str, confirms: bool = False, retries: int = 2, backoff: float = 0.1, cooldown: float = 5.0):
+        self.host = host
+        self.confirms = confirms
+        self.retries = retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.stats = PublisherStatistics()
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+        self._pid = None
+        self._retry_after = 0.0
+        self._lock = threading.Lock()
+
+    def _ensure_channel(self):
+        if self._pid != os.getpid():
+            # Inherited from a parent process, the socket isn't ours to use
+            self._connection = None
+            self._channel = None
+            self._pid = os.getpid()
+        if self._connection is not None and self._connection.is_open:
+            # Service heartbeats and notice a connection closed by the broker
+            self._connection.process_data_events(time_limit=0)
+        if self._connection is None or not self._connection.is_open or not self._channel.is_open:
+            self._close()
+            self._connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=self.host, heartbeat=RABBITMQ_HEARTBEAT)
+            )
+            self._channel = self._connection.channel()
+            if self.confirms:
+                self._channel.confirm_delivery()
+            self._declared = set()
+        return self._channel
+
+    def _close(self):
+        connection = self._connection
+        self._connection = None
+        self._channel = None
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _declare(self, channel, queue_name: str):
+        if queue_name not in self._declared:
+            channel.queue_declare(queue=queue_name)
+            self._declared.add(queue_name)
+
+    def publish(self, data, queue_name: str) -> bool:
+        return self.publish_batch([data], queue_name)
+
+    def publish_batch(self, messages: list, queue_name: str) -> bool:
+        '''
+        Publish JSON messages to a queue. Returns False if they couldn't be sent
+        '''
+        start = perf_counter()
+        with self._lock:
+            if monotonic() < self._retry_after:
+                self.stats.record(len(messages), perf_counter() - start, False)
+                return False
+            for attempt in range(self.retries + 1):
+                try:
+                    channel = self._ensure_channel()
+                    self._declare(channel, queue_name)
+                    for data in messages:
+                        channel.basic_publish(
+                            exchange='',
+                            routing_key=queue_name,
+                            body=json.dumps(stamp_enqueued(data)),
+                            properties=pika.BasicProperties(content_type="application/json")
+                        )
+                    self.stats.record(len(messages), perf_counter() - start, True)
+                    return True
+                except Exception as e:
+                    print(f"Error while trying to send message to RabbitMQ (attempt {attempt + 1}): {e}")
+                    print_exc()
+                    sys.stdout.flush()
+                    self._close()
+                    self.stats.record_reconnect()
+                    if attempt < self.retries:
+                        sleep(self.backoff * (2 ** attempt))
+            self._retry_after = monotonic() + self.cooldown
+        self.stats.record(len(messages), perf_counter() - start, False)
+        return False
+
+PUBLISHER = RabbitMQPublisher(
+    RABBITMQ_HOST,
+    confirms=RABBITMQ_PUBLISHER_CONFIRMS,
+    retries=RABBITMQ_PUBLISH_RETRIES,
+    backoff=RABBITMQ_RETRY_BACKOFF,
+    cooldown=RABBITMQ_FAILURE_COOLDOWN
+)
@@ -0,0 +1,94 @@
+'''
+Check the SMTP pool against a local aiosmtpd server
+
+Sends messages over the pool to a server that refuses one recipient and
+drops the session once, and checks that refused recipients keep the
+session while a dropped one is replaced and the message retried. Then
+times sending over pooled sessions against a new session per message.
+
+Usage: python benchmarks/smtp_pool.py [--messages 200]
+'''
+import socket
+import smtplib
+import argparse
+from time import perf_counter
+from aiosmtpd.controller import Controller
+from backsite_jobs.email import SMTPConnectionPool
+
+HOST = "127.0.0.1"
+REFUSED = "refused@example.com"
+DROPPED = "dropped@example.com"
+MESSAGE = "Subject: Test\r\n\r\nHello"
+
+class Handler:
+    def __init__(self):
+        self.received = 0
+        self.dropped = False
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == REFUSED:
+            return "550 No such user"
+        if address == DROPPED and not self.dropped:
+            # Drop the session once, like a server timing out an idle client
+            self.dropped = True
+            server.transport.close()
+            return "421 Closing connection"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 Message accepted"
+
+def check(port: int, handler: Handler):
+    pool = SMTPConnectionPool(HOST, port, use_ssl=False, size=1, smtp_factory=smtplib.SMTP)
+    pool.send("api@example.com", "someone@example.com", MESSAGE)
+    try:
+        pool.send("api@example.com", REFUSED, MESSAGE)
+        raise AssertionError("Expected the refused recipient to raise")
+    except smtplib.SMTPRecipientsRefused:
+        pass
+    pool.send("api@example.com", "someone@example.com", MESSAGE)
+    stats = pool.stats
+    assert stats["connections_opened"] == 1, f"A refused recipient replaced the session: {stats}"
+    pool.send("api@example.com", DROPPED, MESSAGE)
+    stats = pool.stats
+    assert stats["connections_opened"] == 2, f"A dropped session wasn't replaced: {stats}"
+    assert handler.received == 3, f"Expected 3 messages delivered, got {handler.received}"
+    pool.close_all()
+    print(f"ok: {stats['sent']} sent, {stats['failed']} failed, {stats['connections_opened']} sessions opened")
+
+def run(port: int, messages: int, pooled: bool) -> float:
+    pool = SMTPConnectionPool(HOST, port, use_ssl=False, size=1, max_messages=messages if pooled else 1, smtp_factory=smtplib.SMTP)
+    start = perf_counter()
+    for _ in range(messages):
+        pool.send("api@example.com", "someone@example.com", MESSAGE)
+    elapsed = perf_counter() - start
+    pool.close_all()
+    return elapsed / messages * 1e3
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    handler = Handler()
+    port = free_port()
+    controller = Controller(handler, hostname=HOST, port=port)
+    controller.start()
+    try:
+        check(port, handler)
+        pooled = run(port, args.messages, True)
+        unpooled = run(port, args.messages, False)
+        print(f"{'pooled ms':>12}{'unpooled ms':>14}{'speedup':>10}")
+        print(f"{pooled:>12.2f}{unpooled:>14.2f}{unpooled / pooled:>9.1f}x")
+    finally:
+        controller.stop()
+
+if __name__ == "__main__":
+    main()
@@ -14,7 +14,8 @@ setuptools.setup(
         "psycopg2-binary==2.9.6",
         "sqlalchemy==2.0.12",
         "sqlalchemy-utils==0.41.1",
-        "pika==1.3.2"
+        "pika==1.3.2",
+        "elasticsearch==7.17.9",
     ],
     package_dir={"": "src"},
     packages=[
@@ -0,0 +1,97 @@
+'''
+Configuration and email template cache for the job daemon
+
+Mirrors backsite.utils.CachedFile (the job daemon is packaged separately
+from the web application): files are parsed once and only reloaded when
+their modification time changes, so rendering an email is a pure
+in-memory operation
+'''
+import os
+import json
+import threading
+from string import Formatter
+from time import monotonic
+
+CONFIG_PATH = "/opt/configuration/config.json"
+EMAIL_TEMPLATE_DIR = "/opt/configuration/email_templates"
+# Minimum time between checks of a cached file's modification time
+FILE_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1"))
+
+class CachedFile:
+    '''
+    Keeps the parsed contents of a file in memory and reloads it only when
+    the file's modification time changes
+    '''
+    def __init__(self, path: str, parse, check_interval: float = FILE_CHECK_INTERVAL):
+        self.path = path
+        self.parse = parse
+        self.check_interval = check_interval
+        self.value = None
+        self.mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if monotonic() < self._next_check and self.value is not None:
+            return self.value
+        with self._lock:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime != self.mtime or self.value is None:
+                with open(self.path, "r") as f:
+                    self.value = self.parse(f.read())
+                self.mtime = mtime
+            self._next_check = monotonic() + self.check_interval
+        return self.value
+
+class EmailTemplate:
+    '''
+    str.format style template parsed once into literal text and field slots
+    '''
+    FIELDS = {"API_COMMON_NAME", "USERNAME", "VERIFICATION_URL"}
+
+    def __init__(self, text: str):
+        self.pieces = []
+        for literal, field, format_spec, conversion in Formatter().parse(text):
+            if field is not None and field not in self.FIELDS:
+                raise ValueError(f"Unknown template field {{{field}}}, expected one of {sorted(self.FIELDS)}")
+            if conversion is not None:
+                raise ValueError(f"Conversions aren't supported in template field {{{field}}}")
+            self.pieces.append((literal, field, format_spec or ""))
+
+    def render(self, **values) -> str:
+        parts = []
+        for literal, field, format_spec in self.pieces:
+            parts.append(literal)
+            if field is not None:
+                parts.append(format(values[field], format_spec))
+        return "".join(parts)
+
+def parse_configuration(text: str) -> dict:
+    config = json.loads(text)
+    # Normalize once at load time rather than on every email
+    endpoint = config.get("VERIFICATION_ENDPOINT", "")
+    if endpoint != "" and endpoint[0] != "/":
+        config["VERIFICATION_ENDPOINT"] = "/" + endpoint
+    return config
+
+CONFIG_FILE = CachedFile(CONFIG_PATH, parse_configuration)
+TEMPLATES = {
+    name: CachedFile(f"{EMAIL_TEMPLATE_DIR}/{name}", EmailTemplate)
+    for name in ("email_verification_template.html", "email_verification_template.txt")
+}
+
+def get_configuration() -> dict:
+    '''
+    Return the parsed configuration file. The returned dictionary is shared, don't modify it
+    '''
+    return CONFIG_FILE.get()
+
+def get_template(name: str) -> EmailTemplate:
+    return TEMPLATES[name].get()
+
+def validate_templates():
+    '''
+    Load and parse every template, raising if one is missing or invalid
+    '''
+    for template in TEMPLATES.values():
+        template.get()
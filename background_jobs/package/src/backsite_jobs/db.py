@@ -0,0 +1,23 @@
+import os
+import threading
+from sqlalchemy import create_engine
+
+DATABASE_NAME = os.environ.get("POSTGRES_DB_NAME", "backsite")
+DATABASE_HOST = os.environ.get("POSTGRES_HOST", "db")
+DATABASE_PORT = os.environ.get("POSTGRES_PORT", "5432")
+DATABASE_USERNAME = os.environ.get("POSTGRES_USER", "backsite")
+DATABASE_PASSWORD = os.environ.get("POSTGRES_PASSWORD", "backsite")
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_sql_engine():
+    '''
+    Return the engine shared by the job daemon, creating it on first use
+    '''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            db_string = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+            _engine = create_engine(db_string, pool_size=5, max_overflow=5, pool_pre_ping=True)
+    return _engine
@@ -1,115 +1,262 @@
-import pika
 import os
-import sys
-import json
 import smtplib, ssl
+import socket
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from threading import Thread
-from time import sleep
-from traceback import print_exc
+from threading import Lock, BoundedSemaphore
+from time import monotonic, perf_counter
+from collections import deque
+from contextlib import contextmanager
+from backsite_jobs.config import get_configuration, get_template, validate_templates
+from backsite_jobs.framework import CommandRegistry, JobQueue
 
-RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
-CONFIG_PATH = "/opt/configuration/config.json"
-EMAIL_TEMPLATE_DIR = "/opt/configuration/email_templates"
+EMAIL_QUEUE = "email_jobs"
+# Workers consuming the email queue, as threads or processes
+EMAIL_JOB_WORKERS = int(os.getenv("EMAIL_JOB_WORKERS", "4"))
+EMAIL_JOB_MODE = os.getenv("EMAIL_JOB_MODE", "thread")
+EMAIL_COMMANDS = CommandRegistry()
 
-with open(CONFIG_PATH, "r") as config_handle:
-    CONFIG = json.loads(config_handle.read())
+# Number of SMTP sessions kept open at once
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+# Messages sent over one session before it is replaced
+SMTP_MAX_MESSAGES_PER_CONNECTION = int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100"))
+# Sessions idle for longer than this are closed instead of reused
+SMTP_IDLE_TIMEOUT = float(os.getenv("SMTP_IDLE_TIMEOUT", "60"))
+# Sessions idle for longer than this are checked with NOOP before reuse
+SMTP_NOOP_AFTER = float(os.getenv("SMTP_NOOP_AFTER", "10"))
+# Errors that leave a session unusable. Other SMTP errors, like a refused
+# recipient, are replies on a session that can keep sending
+SESSION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout, ssl.SSLError)
 
-class EmailJobs:
+class PooledSMTPConnection:
+    def __init__(self, server):
+        self.server = server
+        self.messages_sent = 0
+        self.last_used = monotonic()
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            pass
+
+class SMTPConnectionPool:
+    '''
+    Keeps authenticated SMTP sessions open and hands them out for sending,
+    so each email doesn't pay for a new TCP/TLS handshake and login.
+    smtp_factory can be given to connect to a local stand-in server
+    '''
+    def __init__(self, host: str, port: int, username: str = "", password: str = "", use_ssl: bool = True,
+                 size: int = SMTP_POOL_SIZE, max_messages: int = SMTP_MAX_MESSAGES_PER_CONNECTION,
+                 idle_timeout: float = SMTP_IDLE_TIMEOUT, noop_after: float = SMTP_NOOP_AFTER, smtp_factory = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.smtp_factory = smtp_factory
+        self.sent = 0
+        self.failed = 0
+        self.connections_opened = 0
+        self.total_send_seconds = 0.0
+        self.max_send_seconds = 0.0
+        self._idle = deque()
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(size)
+
+    def _connect(self) -> PooledSMTPConnection:
+        if self.smtp_factory is not None:
+            server = self.smtp_factory(self.host, self.port)
+        elif self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(self.host, self.port)
+        if self.username != "":
+            server.login(self.username, self.password)
+        with self._lock:
+            self.connections_opened += 1
+        return PooledSMTPConnection(server)
+
+    def _healthy(self, connection: PooledSMTPConnection) -> bool:
+        idle = monotonic() - connection.last_used
+        if idle > self.idle_timeout or connection.messages_sent >= self.max_messages:
+            return False
+        if idle > self.noop_after:
+            try:
+                return connection.server.noop()[0] == 250
+            except (smtplib.SMTPException, *SESSION_ERRORS):
+                return False
+        return True
+
+    def acquire(self) -> PooledSMTPConnection:
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if len(self._idle) > 0 else None
+                if connection is None:
+                    return self._connect()
+                if self._healthy(connection):
+                    return connection
+                connection.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, connection: PooledSMTPConnection, broken: bool = False):
+        if broken or connection.messages_sent >= self.max_messages:
+            connection.close()
+        else:
+            connection.last_used = monotonic()
+            with self._lock:
+                self._idle.append(connection)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except SESSION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def _record(self, seconds: float, success: bool):
+        with self._lock:
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.total_send_seconds += seconds
+            self.max_send_seconds = max(self.max_send_seconds, seconds)
 
-    consumerThread = None
-    shouldRun = False
-    channel = None
+    def _send_one(self, connection: PooledSMTPConnection, from_email: str, to_email: str, message: str) -> float:
+        start = perf_counter()
+        try:
+            connection.server.sendmail(from_email, to_email, message)
+        except Exception:
+            self._record(perf_counter() - start, False)
+            raise
+        connection.messages_sent += 1
+        elapsed = perf_counter() - start
+        self._record(elapsed, True)
+        return elapsed
+
+    def send(self, from_email: str, to_email: str, message: str) -> float:
+        '''
+        Send one message, retrying once on a fresh session if the pooled
+        one was dropped. Returns the send latency in seconds. Refused
+        recipients or messages raise without discarding the session
+        '''
+        try:
+            with self.connection() as connection:
+                return self._send_one(connection, from_email, to_email, message)
+        except SESSION_ERRORS:
+            with self.connection() as connection:
+                return self._send_one(connection, from_email, to_email, message)
+
+    def close_all(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for connection in idle:
+            connection.close()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            attempts = self.sent + self.failed
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "connections_opened": self.connections_opened,
+                "idle_connections": len(self._idle),
+                "average_send_seconds": self.total_send_seconds / attempts if attempts > 0 else 0.0,
+                "max_send_seconds": self.max_send_seconds,
+            }
+
+class EmailJobs:
+    '''
+    Consumes the email_jobs queue on a pool of workers
+    '''
+    queue = None
+    smtpPool = None
+    smtpSettings = None
+    smtpLock = Lock()
 
     @classmethod
     def start(cls):
-        cls.shouldRun = True
-        cls.consumerThread = Thread(target=cls.__start_thread, daemon=True)
-        cls.consumerThread.start()
+        # Fail at startup rather than on the first email if a template is broken
+        validate_templates()
+        cls.queue = JobQueue(EMAIL_QUEUE, EMAIL_COMMANDS, workers=EMAIL_JOB_WORKERS, mode=EMAIL_JOB_MODE)
+        cls.queue.start()
+        print("Listening for email jobs.")
 
     @classmethod
     def stop(cls):
-        cls.shouldRun = False
-        cls.channel.stop_consuming()
-        cls.consumerThread.join()
-
-    @classmethod
-    def __start_thread(cls):
-        print("Listening for email jobs.")
-        while True:
-            try:
-                connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-                cls.channel = connection.channel()
-                break
-            except Exception as e:
-                print(f"Failed to connect to RabbitMQ. Sleeping and trying again")
-                sleep(60)
-        print("Connected to RabbitMQ")
-        cls.channel.queue_declare(queue='email_jobs')
-        cls.channel.basic_consume(queue='email_jobs', on_message_callback=cls.callback, auto_ack=True)
-        cls.channel.start_consuming()
+        cls.queue.stop()
+        if cls.smtpPool is not None:
+            cls.smtpPool.close_all()
 
     @classmethod
     def send_verification_email(cls, username: str, email: str, secret: str):
-        # Open HTML Email Template
-        with open(f"{EMAIL_TEMPLATE_DIR}/email_verification_template.html", "r") as html_handle:
-            html_template = html_handle.read()
-        # Open TXT Email Template
-        with open(f"{EMAIL_TEMPLATE_DIR}/email_verification_template.txt", "r") as txt_handle:
-            txt_template = txt_handle.read()
+        config = get_configuration()
         # Generate Verification URL
-        if CONFIG["VERIFICATION_ENDPOINT"][0] != "/":
-            CONFIG["VERIFICATION_ENDPOINT"] = "/" + CONFIG["VERIFICATION_ENDPOINT"]
-        verification_url = f"{CONFIG['FRONTFACING_URL']}{CONFIG['VERIFICATION_ENDPOINT']}?key={secret}"
+        verification_url = f"{config['FRONTFACING_URL']}{config['VERIFICATION_ENDPOINT']}?key={secret}"
         # Fill out HTML template
-        html_email = html_template.format(
-            API_COMMON_NAME=CONFIG["API_COMMON_NAME"],
+        html_email = get_template("email_verification_template.html").render(
+            API_COMMON_NAME=config["API_COMMON_NAME"],
             USERNAME=username,
             VERIFICATION_URL=verification_url
         )
         # Fill out TXT template
-        txt_email = txt_template.format(
-            API_COMMON_NAME=CONFIG["API_COMMON_NAME"],
+        txt_email = get_template("email_verification_template.txt").render(
+            API_COMMON_NAME=config["API_COMMON_NAME"],
             USERNAME=username,
             VERIFICATION_URL=verification_url
         )
         # Send email
         cls.send_email(
             to_email=email, 
-            subject=f"Verify your email address for {CONFIG['API_COMMON_NAME']}", 
+            subject=f"Verify your email address for {config['API_COMMON_NAME']}", 
             text_content=txt_email, 
             html_content=html_email
         )
         print(f"Verification email sent to {email}")
     
     @classmethod
-    def callback(cls, ch, method, properties, body):
-        '''
-        Main callback function to handle any jobs received through RabbitMQ
-        '''
-        commandMap = {
-            "sendVerificationEmail": cls.send_verification_email
-        }
-        print(f"Received body {body}")
-        data = json.loads(body.decode())
-        command = data['command']
-        params = data["params"]
-        if command in commandMap:
-            try:
-                commandMap[command](**params)
-            except Exception as e:
-                print(f"Error executing command {command}: {e}")
-                print_exc()
-        else:
-            print(f"Error, unknown command {command}")
+    def get_smtp_pool(cls):
+        config = get_configuration()
+        settings = (
+            config["SMTP_HOST"],
+            int(config["SMTP_PORT"]),
+            config["SMTP_USERNAME"],
+            config["SMTP_PASSWORD"],
+            config.get("SMTP_USE_SSL", True)
+        )
+        # Replace the pool if the SMTP settings were changed in the config file
+        with cls.smtpLock:
+            if cls.smtpPool is None or settings != cls.smtpSettings:
+                if cls.smtpPool is not None:
+                    cls.smtpPool.close_all()
+                host, port, username, password, use_ssl = settings
+                cls.smtpPool = SMTPConnectionPool(host, port, username, password, use_ssl=use_ssl)
+                cls.smtpSettings = settings
+        return cls.smtpPool
 
     @classmethod
-    def send_email(cls, to_email: str, subject: str, text_content: str, html_content: str):
+    def build_email(cls, to_email: str, subject: str, text_content: str, html_content: str):
         #Generate email headers
         message = MIMEMultipart("alternative")
         message["Subject"] = subject
-        message["From"] = CONFIG["API_EMAIL"]
+        api_email = get_configuration()["API_EMAIL"]
+        message["From"] = api_email
         message["To"] = to_email
         # Add TXT and HTML email options
         part1 = MIMEText(text_content, "plain")
@@ -117,12 +264,14 @@ class EmailJobs:
         # Attach to message
         message.attach(part1)
         message.attach(part2)
-        # Send email
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(CONFIG["SMTP_HOST"], CONFIG["SMTP_PORT"], context=context) as server:
-            server.login(CONFIG["SMTP_USERNAME"], CONFIG["SMTP_PASSWORD"])
-            server.sendmail(
-                CONFIG["API_EMAIL"], to_email, message.as_string()
-            )
+        return (api_email, to_email, message.as_string())
+
+    @classmethod
+    def send_email(cls, to_email: str, subject: str, text_content: str, html_content: str):
+        # Send email over a pooled SMTP session
+        latency = cls.get_smtp_pool().send(*cls.build_email(to_email, subject, text_content, html_content))
+        print(f"Email sent to {to_email} in {latency:.3f}s")
         # Done
-        return True
\ No newline at end of file
+        return True
+
+EMAIL_COMMANDS.register("sendVerificationEmail", EmailJobs.send_verification_email, max_concurrency=SMTP_POOL_SIZE)
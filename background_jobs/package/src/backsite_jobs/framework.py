@@ -0,0 +1,272 @@
+'''
+Generic RabbitMQ job framework
+
+Messages are JSON objects of the form {"command": <name>, "params": {...}}.
+Each queue is consumed by a JobQueue which dispatches commands from its
+CommandRegistry to a pool of worker threads (or processes). Messages are
+acknowledged only once their command finished; failed commands are
+retried with exponential backoff through per-delay retry queues, and
+messages that keep failing (or name unknown commands) are moved to a
+dead-letter queue.
+'''
+import os
+import json
+import pika
+import multiprocessing
+from functools import partial
+from threading import Thread, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import sleep, time, perf_counter
+from traceback import print_exc, format_exception_only
+from backsite_jobs.metrics import REGISTRY
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", "5"))
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "5"))
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "600"))
+# How often each consumer samples the depth of its queues
+JOB_QUEUE_DEPTH_INTERVAL = float(os.getenv("JOB_QUEUE_DEPTH_INTERVAL", "15"))
+RETRY_HEADER = "x-retry-count"
+
+JOBS_RECEIVED = REGISTRY.counter("backsite_jobs_received_total", "Job messages received", ("queue", "command"))
+JOBS_SUCCEEDED = REGISTRY.counter("backsite_jobs_succeeded_total", "Jobs completed successfully", ("queue", "command"))
+JOBS_FAILED = REGISTRY.counter("backsite_jobs_failed_total", "Job attempts that raised an error", ("queue", "command"))
+JOBS_RETRIED = REGISTRY.counter("backsite_jobs_retried_total", "Failed jobs scheduled for another attempt", ("queue", "command"))
+JOBS_DEAD_LETTERED = REGISTRY.counter("backsite_jobs_dead_lettered_total", "Messages moved to a dead-letter queue", ("queue", "command"))
+JOB_PROCESSING_SECONDS = REGISTRY.histogram("backsite_job_processing_seconds", "Time spent running a job handler", ("queue", "command"))
+JOB_END_TO_END_SECONDS = REGISTRY.histogram(
+    "backsite_job_end_to_end_seconds", "Time from a job being enqueued to its successful completion", ("queue", "command"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+QUEUE_DEPTH = REGISTRY.gauge("backsite_job_queue_depth", "Messages ready in a queue", ("queue",))
+
+def default_connection_factory():
+    return pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+
+class Command:
+    '''
+    A registered job handler and its execution limits
+    '''
+    def __init__(self, name: str, handler, max_concurrency: int = None, max_retries: int = JOB_MAX_RETRIES):
+        self.name = name
+        self.handler = handler
+        self.max_retries = max_retries
+        self.slots = BoundedSemaphore(max_concurrency) if max_concurrency is not None else None
+
+class CommandRegistry:
+    '''
+    Maps command names to handlers
+    '''
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name: str, handler = None, max_concurrency: int = None, max_retries: int = JOB_MAX_RETRIES):
+        '''
+        Register a handler, either directly or as a decorator
+        '''
+        if handler is None:
+            return partial(self.register, name, max_concurrency=max_concurrency, max_retries=max_retries)
+        self.commands[name] = Command(name, handler, max_concurrency, max_retries)
+        return handler
+
+    def get(self, name: str):
+        return self.commands.get(name)
+
+class JobQueue:
+    '''
+    Consumes one queue and runs its commands on a worker pool.
+    pika connections aren't thread-safe, so workers hand acks and
+    republishes back to the consumer thread via add_callback_threadsafe.
+    connection_factory can be replaced to run against a broker stand-in
+    '''
+    def __init__(self, queue_name: str, registry: CommandRegistry, workers: int = 4, mode: str = "thread",
+                 prefetch: int = None, retry_base_delay: float = JOB_RETRY_BASE_DELAY,
+                 retry_max_delay: float = JOB_RETRY_MAX_DELAY, connection_factory = default_connection_factory):
+        self.queue_name = queue_name
+        self.dead_letter_queue = f"{queue_name}.dead"
+        self.registry = registry
+        self.workers = workers
+        self.mode = mode
+        self.prefetch = prefetch if prefetch is not None else workers * 2
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.connection_factory = connection_factory
+        self.connection = None
+        self.channel = None
+        self.should_run = False
+        self.consumer_thread = None
+        self.executor = None
+        self.process_pool = None
+        self._retry_queues = set()
+
+    def start(self):
+        self.should_run = True
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.queue_name)
+        if self.mode == "process":
+            # Threads still dispatch (and enforce concurrency limits), processes do the work.
+            # spawn rather than fork, this process has threads and open sockets
+            self.process_pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        self.consumer_thread = Thread(target=self._consume_forever, daemon=True)
+        self.consumer_thread.start()
+
+    def stop(self):
+        self.should_run = False
+        if self.connection is not None and self.connection.is_open:
+            self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        self.consumer_thread.join()
+        self.executor.shutdown(wait=True)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+
+    def _consume_forever(self):
+        delay = 1
+        while self.should_run:
+            try:
+                self.connection = self.connection_factory()
+                self.channel = self.connection.channel()
+                delay = 1
+                print(f"Connected to RabbitMQ, listening on {self.queue_name}")
+                self._consume()
+            except Exception as e:
+                print(f"Lost connection to RabbitMQ while consuming {self.queue_name}: {e}")
+                print_exc()
+            finally:
+                if self.connection is not None and self.connection.is_open:
+                    self.connection.close()
+            if self.should_run:
+                # Unacked messages are redelivered by the broker after a reconnect
+                sleep(delay)
+                delay = min(delay * 2, 60)
+
+    def _consume(self):
+        self._retry_queues = set()
+        self.channel.basic_qos(prefetch_count=self.prefetch)
+        self.channel.queue_declare(queue=self.queue_name)
+        self.channel.queue_declare(queue=self.dead_letter_queue)
+        self.channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message, auto_ack=False)
+        self._sample_depth()
+        self.channel.start_consuming()
+
+    def _sample_depth(self):
+        '''
+        Runs on the consumer thread: read queue depths with passive declares
+        and schedule the next sample
+        '''
+        try:
+            for queue_name in [self.queue_name, self.dead_letter_queue]:
+                result = self.channel.queue_declare(queue=queue_name, passive=True)
+                QUEUE_DEPTH.set(result.method.message_count, queue=queue_name)
+        except Exception as e:
+            print(f"Error sampling depth of {self.queue_name}: {e}")
+            return
+        self.connection.call_later(JOB_QUEUE_DEPTH_INTERVAL, self._sample_depth)
+
+    def _on_message(self, channel, method, properties, body):
+        '''
+        Runs on the consumer thread: decode the message and hand it to a worker
+        '''
+        try:
+            data = json.loads(body.decode())
+            name = data["command"]
+            params = data.get("params", {})
+            enqueued_at = data.get("enqueued_at")
+        except (ValueError, KeyError, TypeError) as e:
+            JOBS_RECEIVED.inc(queue=self.queue_name, command="")
+            self._dead_letter(channel, method.delivery_tag, properties, body, f"Malformed message: {e}", "")
+            return
+        JOBS_RECEIVED.inc(queue=self.queue_name, command=name)
+        command = self.registry.get(name)
+        if command is None:
+            self._dead_letter(channel, method.delivery_tag, properties, body, f"Unknown command {name}", name)
+            return
+        connection = self.connection
+        future = self.executor.submit(self._execute, command, params)
+        future.add_done_callback(
+            lambda f: self._schedule_finish(connection, partial(self._finish, channel, method.delivery_tag, properties, body, command, enqueued_at, f))
+        )
+
+    def _schedule_finish(self, connection, callback):
+        '''
+        Runs on a worker thread: hand the ack back to the consumer thread
+        '''
+        try:
+            connection.add_callback_threadsafe(callback)
+        except Exception:
+            # The connection this message came from is gone, the broker redelivers it
+            print(f"Connection closed before a {self.queue_name} job could be acknowledged")
+
+    def _execute(self, command: Command, params: dict):
+        '''
+        Runs on a worker thread
+        '''
+        if command.slots is not None:
+            command.slots.acquire()
+        start = perf_counter()
+        try:
+            if self.process_pool is not None:
+                return self.process_pool.submit(command.handler, **params).result()
+            return command.handler(**params)
+        finally:
+            JOB_PROCESSING_SECONDS.observe(perf_counter() - start, queue=self.queue_name, command=command.name)
+            if command.slots is not None:
+                command.slots.release()
+
+    def _finish(self, channel, delivery_tag, properties, body, command: Command, enqueued_at, future):
+        '''
+        Runs on the consumer thread once a command completed
+        '''
+        error = future.exception()
+        if error is None:
+            channel.basic_ack(delivery_tag)
+            JOBS_SUCCEEDED.inc(queue=self.queue_name, command=command.name)
+            if isinstance(enqueued_at, (int, float)):
+                # Includes time spent in the outbox, the queue and any retry delays
+                JOB_END_TO_END_SECONDS.observe(max(0.0, time() - enqueued_at), queue=self.queue_name, command=command.name)
+            return
+        JOBS_FAILED.inc(queue=self.queue_name, command=command.name)
+        print(f"Error executing command {command.name}: {''.join(format_exception_only(type(error), error)).strip()}")
+        headers = dict(properties.headers or {})
+        retries = headers.get(RETRY_HEADER, 0)
+        if retries < command.max_retries:
+            headers[RETRY_HEADER] = retries + 1
+            delay = min(self.retry_base_delay * (2 ** retries), self.retry_max_delay)
+            self._publish(channel, self._retry_queue(channel, delay), body, headers)
+            channel.basic_ack(delivery_tag)
+            JOBS_RETRIED.inc(queue=self.queue_name, command=command.name)
+        else:
+            self._dead_letter(channel, delivery_tag, properties, body, str(error), command.name)
+
+    def _retry_queue(self, channel, delay: float) -> str:
+        '''
+        Declare (once) the queue holding messages for the given delay. Expired
+        messages are dead-lettered by the broker back onto the work queue
+        '''
+        delay_ms = int(delay * 1000)
+        name = f"{self.queue_name}.retry.{delay_ms}"
+        if name not in self._retry_queues:
+            channel.queue_declare(queue=name, arguments={
+                "x-message-ttl": delay_ms,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue_name,
+            })
+            self._retry_queues.add(name)
+        return name
+
+    def _dead_letter(self, channel, delivery_tag, properties, body, reason: str, command_name: str):
+        print(f"Moving message to {self.dead_letter_queue}: {reason}")
+        JOBS_DEAD_LETTERED.inc(queue=self.queue_name, command=command_name)
+        headers = dict(properties.headers or {})
+        headers["x-error"] = reason[:1024]
+        self._publish(channel, self.dead_letter_queue, body, headers)
+        channel.basic_ack(delivery_tag)
+
+    def _publish(self, channel, queue_name: str, body, headers: dict):
+        channel.basic_publish(
+            exchange='',
+            routing_key=queue_name,
+            body=body,
+            properties=pika.BasicProperties(content_type="application/json", headers=headers)
+        )
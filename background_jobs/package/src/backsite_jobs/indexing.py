@@ -0,0 +1,290 @@
+'''
+Background Elasticsearch indexing for posts
+
+The web app writes index/update/delete operations for posts to the
+post_index queue (through the outbox). The indexer buffers them, keeps a
+single coalesced operation per post, and writes them with the _bulk API
+once enough posts are buffered or the oldest operation has waited long
+enough. Messages are only acknowledged once their operation was applied
+or failed permanently; items rejected with a retryable status are sent
+again with exponential backoff. While Elasticsearch can't be reached or
+rejects whole requests under load, operations stay buffered and
+unacknowledged and the request is retried until it gets through. Requests
+rejected for what they contain are split to find the operations at fault.
+'''
+import os
+import json
+import pika
+from threading import Thread
+from time import sleep, monotonic, perf_counter, time
+from traceback import print_exc
+from elasticsearch import Elasticsearch, TransportError, ConnectionTimeout, ConnectionError as ElasticConnectionError
+from backsite_jobs.metrics import REGISTRY
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+ELASTIC_HOST = os.getenv("ELASTIC_HOST", "elastic")
+ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD", "backsite")
+POST_INDEX = "posts"
+POST_INDEX_QUEUE = "post_index"
+# Flush once this many posts have buffered operations...
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "500"))
+# ...or the oldest buffered operation has waited this long
+INDEX_FLUSH_INTERVAL = float(os.getenv("INDEX_FLUSH_INTERVAL", "1.0"))
+# Attempts for an item rejected with a retryable status before it's dropped
+INDEX_MAX_RETRIES = int(os.getenv("INDEX_MAX_RETRIES", "5"))
+INDEX_RETRY_BACKOFF = float(os.getenv("INDEX_RETRY_BACKOFF", "0.5"))
+INDEX_RETRY_MAX_DELAY = float(os.getenv("INDEX_RETRY_MAX_DELAY", "30"))
+# Statuses worth retrying: rejected under load, or a transient shard failure
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+INDEX_OPERATIONS = REGISTRY.counter("backsite_index_operations_total", "Post index operations applied or dropped", ("action", "result"))
+INDEX_COALESCED = REGISTRY.counter("backsite_index_coalesced_total", "Post index operations merged into an already buffered one")
+INDEX_BULK_SECONDS = REGISTRY.histogram("backsite_index_bulk_seconds", "Duration of _bulk requests")
+INDEX_BULK_SIZE = REGISTRY.histogram("backsite_index_bulk_size", "Operations per _bulk request", buckets=(1, 5, 10, 50, 100, 250, 500, 1000, 5000))
+INDEX_LAG_SECONDS = REGISTRY.histogram(
+    "backsite_index_lag_seconds", "Time from a post write to its search document being updated",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+)
+INDEX_PENDING = REGISTRY.gauge("backsite_index_pending", "Posts with buffered index operations")
+
+def get_elastic_connection():
+    return Elasticsearch(f"https://{ELASTIC_HOST}:9200", http_auth=("elastic", ELASTIC_PASSWORD), verify_certs=False)
+
+class IndexOperation:
+    '''
+    The net effect of every buffered operation for one post
+    '''
+    def __init__(self, post_id, action: str, document: dict, enqueued_at, delivery_tag):
+        self.post_id = post_id
+        self.action = action
+        self.document = document or {}
+        self.enqueued_at = enqueued_at
+        self.delivery_tags = [delivery_tag]
+        self.attempts = 0
+
+    def merge(self, action: str, document: dict, enqueued_at, delivery_tag):
+        '''
+        Fold a later operation for the same post into this one
+        '''
+        self.delivery_tags.append(delivery_tag)
+        if action == "update":
+            if self.action == "delete":
+                # Updating a deleted post has no effect
+                return
+            self.document = {**self.document, **(document or {})}
+        else:
+            # index and delete replace whatever came before
+            self.action = action
+            self.document = document or {}
+        if self.enqueued_at is None:
+            self.enqueued_at = enqueued_at
+
+    def bulk_lines(self) -> list:
+        header = {self.action: {"_index": POST_INDEX, "_id": self.post_id}}
+        if self.action == "index":
+            return [header, self.document]
+        if self.action == "update":
+            return [header, {"doc": self.document}]
+        return [header]
+
+class IndexBatch:
+    '''
+    Operations buffered since the last flush, one per post
+    '''
+    def __init__(self):
+        self.operations = {}
+        self.first_buffered = None
+        self.retry_at = 0.0
+
+    def add(self, post_id, action: str, document: dict, enqueued_at, delivery_tag):
+        if len(self.operations) == 0:
+            self.first_buffered = monotonic()
+        operation = self.operations.get(post_id)
+        if operation is None:
+            self.operations[post_id] = IndexOperation(post_id, action, document, enqueued_at, delivery_tag)
+        else:
+            operation.merge(action, document, enqueued_at, delivery_tag)
+            INDEX_COALESCED.inc()
+        INDEX_PENDING.set(len(self.operations))
+
+    def due(self) -> bool:
+        if len(self.operations) == 0 or monotonic() < self.retry_at:
+            return False
+        return len(self.operations) >= INDEX_BATCH_SIZE or monotonic() - self.first_buffered >= INDEX_FLUSH_INTERVAL
+
+    def clear(self):
+        self.operations = {}
+        self.first_buffered = None
+        self.retry_at = 0.0
+        INDEX_PENDING.set(0)
+
+class PostIndexer:
+    '''
+    Consumes the post_index queue and applies it to Elasticsearch in bulk.
+    Consuming and flushing share one thread, as pika channels aren't thread-safe
+    '''
+    indexerThread = None
+    shouldRun = False
+    es = None
+    batch = IndexBatch()
+    # _bulk requests in a row that failed without a response
+    requestFailures = 0
+
+    @classmethod
+    def start(cls):
+        cls.shouldRun = True
+        cls.indexerThread = Thread(target=cls.__start_thread, daemon=True)
+        cls.indexerThread.start()
+
+    @classmethod
+    def stop(cls):
+        cls.shouldRun = False
+        cls.indexerThread.join()
+
+    @classmethod
+    def __start_thread(cls):
+        print("Indexing posts.")
+        while cls.shouldRun:
+            connection = None
+            try:
+                connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+                channel = connection.channel()
+                # Allow a full batch to buffer while the previous one is flushed
+                channel.basic_qos(prefetch_count=INDEX_BATCH_SIZE * 2)
+                channel.queue_declare(queue=POST_INDEX_QUEUE)
+                channel.basic_consume(queue=POST_INDEX_QUEUE, on_message_callback=cls.callback, auto_ack=False)
+                while cls.shouldRun:
+                    connection.process_data_events(time_limit=min(0.1, INDEX_FLUSH_INTERVAL))
+                    if cls.batch.due():
+                        cls.flush(channel)
+                # Apply whatever is buffered before shutting down
+                while len(cls.batch.operations) > 0 and monotonic() >= cls.batch.retry_at:
+                    cls.flush(channel)
+            except Exception as e:
+                print(f"Error indexing posts: {e}")
+                print_exc()
+                # Unacknowledged messages are redelivered after reconnecting
+                cls.batch.clear()
+                sleep(5)
+            finally:
+                if connection is not None and connection.is_open:
+                    connection.close()
+
+    @classmethod
+    def callback(cls, ch, method, properties, body):
+        try:
+            data = json.loads(body.decode())
+            action = data["command"]
+            params = data["params"]
+            if action not in ("index", "update", "delete"):
+                raise ValueError(f"unknown command {action}")
+            cls.batch.add(params["post_id"], action, params.get("document"), data.get("enqueued_at"), method.delivery_tag)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Dropping malformed index message {body}: {e}")
+            INDEX_OPERATIONS.inc(action="unknown", result="malformed")
+            ch.basic_ack(method.delivery_tag)
+
+    @classmethod
+    def get_elastic(cls):
+        if cls.es is None:
+            cls.es = get_elastic_connection()
+        return cls.es
+
+    @classmethod
+    def flush(cls, channel):
+        '''
+        Send the buffered operations in one _bulk request. Applied and
+        permanently failed operations are acknowledged; retryable ones stay
+        buffered and are sent again after a backoff
+        '''
+        retry = []
+        if not cls.send(channel, list(cls.batch.operations.values()), retry):
+            # Operations that weren't applied keep their item retries and
+            # stay unacknowledged for as long as Elasticsearch is unavailable
+            cls.requestFailures += 1
+            cls.batch.retry_at = monotonic() + cls.backoff(cls.requestFailures)
+            INDEX_PENDING.set(len(cls.batch.operations))
+            return
+        cls.requestFailures = 0
+        if len(retry) > 0:
+            cls.schedule_retry(channel, retry)
+        else:
+            cls.batch.retry_at = 0.0
+        INDEX_PENDING.set(len(cls.batch.operations))
+
+    @classmethod
+    def send(cls, channel, operations: list, retry: list) -> bool:
+        '''
+        Send operations in one _bulk request, adding the items rejected with
+        a retryable status to retry. A request rejected for its contents is
+        split in halves until the operation at fault fails on its own.
+        Returns False if Elasticsearch is unavailable
+        '''
+        lines = []
+        for operation in operations:
+            lines.extend(operation.bulk_lines())
+        start = perf_counter()
+        try:
+            response = cls.get_elastic().bulk(body=lines)
+        except (ElasticConnectionError, ConnectionTimeout) as e:
+            print(f"Bulk indexing request failed: {e}")
+            return False
+        except Exception as e:
+            if isinstance(e, TransportError) and cls.transient(e.status_code):
+                print(f"Bulk indexing request failed: {e}")
+                return False
+            # Malformed or too large, sending it again won't help
+            if len(operations) == 1:
+                print(f"Failed to {operations[0].action} post {operations[0].post_id}: {e}")
+                cls.complete(channel, operations[0], "failed")
+                return True
+            middle = len(operations) // 2
+            return cls.send(channel, operations[:middle], retry) and cls.send(channel, operations[middle:], retry)
+        INDEX_BULK_SECONDS.observe(perf_counter() - start)
+        INDEX_BULK_SIZE.observe(len(operations))
+        # Items are returned in request order
+        for operation, item in zip(operations, response["items"]):
+            status = item[operation.action]["status"]
+            if status < 300 or (operation.action == "delete" and status == 404):
+                cls.complete(channel, operation, "applied")
+            elif status in RETRYABLE_STATUSES:
+                retry.append(operation)
+            else:
+                print(f"Failed to {operation.action} post {operation.post_id}: {item[operation.action].get('error')}")
+                cls.complete(channel, operation, "failed")
+        return True
+
+    @classmethod
+    def transient(cls, status) -> bool:
+        '''
+        Whether a request rejected with the given status may succeed later
+        '''
+        return isinstance(status, int) and (status == 429 or status >= 500)
+
+    @classmethod
+    def complete(cls, channel, operation: IndexOperation, result: str):
+        '''
+        Acknowledge every message folded into an operation and drop it from the batch
+        '''
+        for delivery_tag in operation.delivery_tags:
+            channel.basic_ack(delivery_tag)
+        del cls.batch.operations[operation.post_id]
+        INDEX_OPERATIONS.inc(action=operation.action, result=result)
+        if result == "applied" and isinstance(operation.enqueued_at, (int, float)):
+            INDEX_LAG_SECONDS.observe(max(0.0, time() - operation.enqueued_at))
+
+    @classmethod
+    def schedule_retry(cls, channel, operations: list):
+        attempts = 0
+        for operation in operations:
+            operation.attempts += 1
+            if operation.attempts > INDEX_MAX_RETRIES:
+                print(f"Giving up on {operation.action} of post {operation.post_id} after {operation.attempts} attempts")
+                cls.complete(channel, operation, "failed")
+            else:
+                attempts = max(attempts, operation.attempts)
+        cls.batch.retry_at = monotonic() + cls.backoff(attempts)
+
+    @classmethod
+    def backoff(cls, attempts: int) -> float:
+        return min(INDEX_RETRY_MAX_DELAY, INDEX_RETRY_BACKOFF * (2 ** max(0, attempts - 1)))
@@ -0,0 +1,167 @@
+import os
+import sys
+import pika
+from datetime import datetime
+from threading import Thread, Event, Lock
+from time import monotonic
+from traceback import print_exc
+from sqlalchemy import text, bindparam
+from backsite_jobs.db import get_sql_engine
+from backsite_jobs.metrics import REGISTRY
+
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.2"))
+OUTBOX_RELAY_THREADS = int(os.getenv("OUTBOX_RELAY_THREADS", "1"))
+OUTBOX_REPORT_INTERVAL = float(os.getenv("OUTBOX_REPORT_INTERVAL", "60"))
+
+OUTBOX_RELAYED = REGISTRY.counter("backsite_outbox_relayed_total", "Outbox messages published to RabbitMQ")
+OUTBOX_LAG_SECONDS = REGISTRY.gauge("backsite_outbox_lag_seconds", "Age of the oldest message in the last relayed batch")
+
+# Claim the oldest messages. SKIP LOCKED lets several relays (threads or
+# daemons) drain the outbox in parallel without handing out a message twice
+CLAIM_BATCH = text('''
+    SELECT outbox_id, queue, payload, created
+    FROM outbox
+    ORDER BY outbox_id
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+''')
+DELETE_BATCH = text('''
+    DELETE FROM outbox WHERE outbox_id IN :ids
+''').bindparams(bindparam("ids", expanding=True))
+
+class RelayStatistics:
+    '''
+    Batch sizes and relay lag (time from outbox insert to publish)
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self.batches = 0
+        self.messages = 0
+        self.failures = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def record_batch(self, size: int, lag: float):
+        with self._lock:
+            self.batches += 1
+            self.messages += size
+            self.last_batch_size = size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    @property
+    def json(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "messages": self.messages,
+                "failures": self.failures,
+                "average_batch_size": self.messages / self.batches if self.batches > 0 else 0.0,
+                "last_batch_size": self.last_batch_size,
+                "max_batch_size": self.max_batch_size,
+                "last_lag_seconds": self.last_lag,
+                "max_lag_seconds": self.max_lag,
+            }
+
+class OutboxRelay:
+    '''
+    Publishes messages written to the outbox table to RabbitMQ
+    '''
+    relayThreads = []
+    stopEvent = Event()
+    stats = RelayStatistics()
+
+    @classmethod
+    def start(cls, threads: int = OUTBOX_RELAY_THREADS):
+        cls.stopEvent.clear()
+        cls.relayThreads = [Thread(target=cls.__start_thread, daemon=True) for _ in range(threads)]
+        for thread in cls.relayThreads:
+            thread.start()
+
+    @classmethod
+    def stop(cls):
+        cls.stopEvent.set()
+        for thread in cls.relayThreads:
+            thread.join()
+
+    @classmethod
+    def __start_thread(cls):
+        print("Relaying outbox messages.")
+        connection = None
+        channel = None
+        declared = set()
+        next_report = monotonic() + OUTBOX_REPORT_INTERVAL
+        while not cls.stopEvent.is_set():
+            try:
+                if channel is None or not channel.is_open:
+                    connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
+                    channel = connection.channel()
+                    channel.confirm_delivery()
+                    declared = set()
+                relayed = cls.relay_batch(channel, declared)
+                if monotonic() >= next_report:
+                    print(f"Outbox relay: {cls.stats.json}")
+                    sys.stdout.flush()
+                    next_report = monotonic() + OUTBOX_REPORT_INTERVAL
+                # Keep draining while batches come back full. Otherwise wait
+                # on the connection, which keeps answering broker heartbeats
+                if relayed < OUTBOX_BATCH_SIZE:
+                    connection.sleep(OUTBOX_POLL_INTERVAL)
+                else:
+                    connection.process_data_events(time_limit=0)
+            except Exception as e:
+                print(f"Error relaying outbox messages: {e}")
+                print_exc()
+                cls.stats.record_failure()
+                cls.close_connection(connection)
+                connection = None
+                channel = None
+                cls.stopEvent.wait(5)
+        cls.close_connection(connection)
+
+    @classmethod
+    def close_connection(cls, connection):
+        if connection is None or not connection.is_open:
+            return
+        try:
+            connection.close()
+        except Exception as e:
+            print(f"Error closing RabbitMQ connection: {e}")
+
+    @classmethod
+    def relay_batch(cls, channel, declared: set, batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+        '''
+        Claim, publish and delete one batch of outbox messages.
+        Messages are only deleted once the broker confirmed them, so a
+        failure part way through resends the batch (at-least-once delivery)
+        '''
+        engine = get_sql_engine()
+        with engine.begin() as conn:
+            rows = conn.execute(CLAIM_BATCH, {"batch_size": batch_size}).all()
+            if len(rows) == 0:
+                return 0
+            for outbox_id, queue, payload, created in rows:
+                if queue not in declared:
+                    channel.queue_declare(queue=queue)
+                    declared.add(queue)
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=queue,
+                    body=payload,
+                    properties=pika.BasicProperties(content_type="application/json")
+                )
+            conn.execute(DELETE_BATCH, {"ids": [row.outbox_id for row in rows]})
+        lag = (datetime.utcnow() - rows[0].created).total_seconds()
+        cls.stats.record_batch(len(rows), lag)
+        OUTBOX_RELAYED.inc(len(rows))
+        OUTBOX_LAG_SECONDS.set(lag)
+        return len(rows)
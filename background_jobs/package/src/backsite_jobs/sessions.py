@@ -0,0 +1,85 @@
+import os
+from datetime import datetime
+from threading import Thread, Event
+from time import perf_counter
+from traceback import print_exc
+from sqlalchemy import text
+from backsite_jobs.db import get_sql_engine
+
+SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("SESSION_SWEEP_BATCH_SIZE", "1000"))
+
+# Delete a bounded chunk of expired rows. Selecting by ctid keeps every
+# statement short, so row locks are held briefly and the web workers are
+# never blocked behind one huge DELETE
+DELETE_EXPIRED_BATCH = '''
+    DELETE FROM {table}
+    WHERE ctid IN (
+        SELECT ctid FROM {table}
+        WHERE expiration <= :now
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+'''
+# Expired sessions, and revocations of signed tokens that have expired anyway
+SWEPT_TABLES = ["session", "revoked_token"]
+
+class SessionSweeper:
+    '''
+    Periodically deletes expired user sessions in batches
+    '''
+    sweeperThread = None
+    stopEvent = Event()
+    lastResult = None
+
+    @classmethod
+    def start(cls):
+        cls.stopEvent.clear()
+        cls.sweeperThread = Thread(target=cls.__start_thread, daemon=True)
+        cls.sweeperThread.start()
+
+    @classmethod
+    def stop(cls):
+        cls.stopEvent.set()
+        cls.sweeperThread.join()
+
+    @classmethod
+    def __start_thread(cls):
+        print("Sweeping expired sessions.")
+        while not cls.stopEvent.is_set():
+            try:
+                cls.sweep()
+            except Exception as e:
+                print(f"Error while sweeping expired sessions: {e}")
+                print_exc()
+            cls.stopEvent.wait(SWEEP_INTERVAL)
+
+    @classmethod
+    def sweep(cls, batch_size: int = SWEEP_BATCH_SIZE):
+        '''
+        Delete every session that expired before now, one committed batch at a time.
+        Returns the number of rows deleted and the time taken
+        '''
+        now = datetime.utcnow()
+        engine = get_sql_engine()
+        deleted = 0
+        batches = 0
+        start = perf_counter()
+        for table in SWEPT_TABLES:
+            statement = text(DELETE_EXPIRED_BATCH.format(table=table))
+            while not cls.stopEvent.is_set():
+                with engine.begin() as conn:
+                    result = conn.execute(statement, {"now": now, "batch_size": batch_size})
+                deleted += result.rowcount
+                batches += 1
+                if result.rowcount < batch_size:
+                    break
+        duration = perf_counter() - start
+        cls.lastResult = {
+            "deleted": deleted,
+            "batches": batches,
+            "duration_seconds": duration,
+            "finished": datetime.utcnow().isoformat(),
+        }
+        print(f"Session sweep deleted {deleted} expired sessions in {batches} batches ({duration:.3f}s)")
+        return deleted, duration
@@ -1,14 +1,29 @@
 import time
 import sys
 from backsite_jobs.email import EmailJobs
+from backsite_jobs.sessions import SessionSweeper
+from backsite_jobs.outbox import OutboxRelay
+from backsite_jobs.indexing import PostIndexer
+from backsite_jobs.timeline import TimelineJobs
+from backsite_jobs.metrics import MetricsServer
 
 def start():
     print("Starting job listeners...")
+    MetricsServer.start()
     EmailJobs.start()
+    SessionSweeper.start()
+    OutboxRelay.start()
+    PostIndexer.start()
+    TimelineJobs.start()
     while True:
         sys.stdout.flush()
         time.sleep(5)
     EmailJobs.stop()
+    SessionSweeper.stop()
+    OutboxRelay.stop()
+    PostIndexer.stop()
+    TimelineJobs.stop()
+    MetricsServer.stop()
 
 if __name__ == "__main__":
     start()
\ No newline at end of file
@@ -0,0 +1,190 @@
+'''
+Home timeline maintenance
+
+New posts are fanned out on write: their id is copied into the
+home_timeline rows of every follower of the author, in committed batches.
+Authors with more than FANOUT_FOLLOWER_LIMIT followers are recorded in
+high_fanout_author and skipped; the web app merges their posts into
+followers' feeds at read time. Entries older than the retention period are
+swept periodically.
+'''
+import os
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from time import perf_counter
+from traceback import print_exc
+from sqlalchemy import text
+from backsite_jobs.db import get_sql_engine
+from backsite_jobs.framework import CommandRegistry, JobQueue
+from backsite_jobs.metrics import REGISTRY
+
+TIMELINE_QUEUE = "timeline_jobs"
+TIMELINE_JOB_WORKERS = int(os.getenv("TIMELINE_JOB_WORKERS", "4"))
+# Authors with more followers than this are merged into feeds at read time
+FANOUT_FOLLOWER_LIMIT = int(os.getenv("FANOUT_FOLLOWER_LIMIT", "10000"))
+# Followers written per transaction
+FANOUT_BATCH_SIZE = int(os.getenv("FANOUT_BATCH_SIZE", "1000"))
+# Recent posts copied into a feed when a user follows someone
+HOME_TIMELINE_BACKFILL = int(os.getenv("HOME_TIMELINE_BACKFILL", "200"))
+HOME_TIMELINE_RETENTION_DAYS = float(os.getenv("HOME_TIMELINE_RETENTION_DAYS", "30"))
+HOME_TIMELINE_SWEEP_INTERVAL = float(os.getenv("HOME_TIMELINE_SWEEP_INTERVAL", "3600"))
+HOME_TIMELINE_SWEEP_BATCH_SIZE = int(os.getenv("HOME_TIMELINE_SWEEP_BATCH_SIZE", "5000"))
+
+TIMELINE_COMMANDS = CommandRegistry()
+
+FANOUT_ROWS = REGISTRY.counter("backsite_fanout_rows_total", "Home timeline entries written by fan-out")
+FANOUT_SKIPPED = REGISTRY.counter("backsite_fanout_skipped_total", "Posts not fanned out because their author has too many followers")
+FANOUT_SECONDS = REGISTRY.histogram("backsite_fanout_seconds", "Time to fan a post out to every follower")
+
+IS_HIGH_FANOUT = text('''
+    SELECT EXISTS (SELECT 1 FROM high_fanout_author WHERE user_id = :author_id)
+''')
+COUNT_FOLLOWERS = text('''
+    SELECT count(*) FROM follows WHERE followee_id = :author_id
+''')
+MARK_HIGH_FANOUT = text('''
+    INSERT INTO high_fanout_author (user_id, follower_count, updated)
+    VALUES (:author_id, :follower_count, :now)
+    ON CONFLICT (user_id) DO UPDATE SET follower_count = EXCLUDED.follower_count, updated = EXCLUDED.updated
+''')
+# Walk the author's followers in id order, one batch per transaction
+FOLLOWER_BATCH = text('''
+    SELECT follower_id FROM follows
+    WHERE followee_id = :author_id AND follower_id > :after
+    ORDER BY follower_id
+    LIMIT :batch_size
+''')
+# The post may have been deleted since it was queued
+INSERT_ENTRIES = text('''
+    INSERT INTO home_timeline (user_id, timestamp, post_id, author_id)
+    SELECT user_id, :timestamp, :post_id, :author_id
+    FROM unnest(CAST(:user_ids AS integer[])) AS user_id
+    WHERE EXISTS (SELECT 1 FROM post WHERE post_id = :post_id)
+    ON CONFLICT DO NOTHING
+''')
+# The follow may have been undone since it was queued
+BACKFILL_FOLLOW = text('''
+    INSERT INTO home_timeline (user_id, timestamp, post_id, author_id)
+    SELECT :follower_id, timestamp, post_id, user_id FROM post
+    WHERE user_id = :followee_id
+      AND timestamp > :since
+      AND EXISTS (SELECT 1 FROM follows WHERE follower_id = :follower_id AND followee_id = :followee_id)
+    ORDER BY timestamp DESC, post_id DESC
+    LIMIT :limit
+    ON CONFLICT DO NOTHING
+''')
+DELETE_OLD_ENTRIES = text('''
+    DELETE FROM home_timeline
+    WHERE ctid IN (
+        SELECT ctid FROM home_timeline
+        WHERE timestamp < :cutoff
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+''')
+
+class TimelineJobs:
+    '''
+    Fans posts out to home timelines and sweeps old timeline entries
+    '''
+    queue = None
+    sweeperThread = None
+    stopEvent = Event()
+
+    @classmethod
+    def start(cls):
+        cls.queue = JobQueue(TIMELINE_QUEUE, TIMELINE_COMMANDS, workers=TIMELINE_JOB_WORKERS)
+        cls.queue.start()
+        cls.stopEvent.clear()
+        cls.sweeperThread = Thread(target=cls.__start_sweeper, daemon=True)
+        cls.sweeperThread.start()
+        print("Listening for timeline jobs.")
+
+    @classmethod
+    def stop(cls):
+        cls.queue.stop()
+        cls.stopEvent.set()
+        cls.sweeperThread.join()
+
+    @classmethod
+    def fan_out_post(cls, post_id: int, author_id: int, timestamp: str):
+        '''
+        Copy a new post into the home timelines of its author and their followers
+        '''
+        start = perf_counter()
+        engine = get_sql_engine()
+        params = {"post_id": post_id, "author_id": author_id, "timestamp": datetime.fromisoformat(timestamp)}
+        with engine.begin() as conn:
+            high_fanout = conn.execute(IS_HIGH_FANOUT, params).scalar()
+            if not high_fanout:
+                follower_count = conn.execute(COUNT_FOLLOWERS, params).scalar()
+                high_fanout = follower_count > FANOUT_FOLLOWER_LIMIT
+                if high_fanout:
+                    # Once high-fanout, always high-fanout, so no post falls between both paths
+                    conn.execute(MARK_HIGH_FANOUT, {**params, "follower_count": follower_count, "now": datetime.utcnow()})
+            if high_fanout:
+                FANOUT_SKIPPED.inc()
+                return
+            result = conn.execute(INSERT_ENTRIES, {**params, "user_ids": [author_id]})
+            FANOUT_ROWS.inc(result.rowcount)
+        # Retries after a failure repeat the whole fan-out, existing entries are skipped
+        after = 0
+        while True:
+            with engine.begin() as conn:
+                follower_ids = conn.scalars(FOLLOWER_BATCH, {**params, "after": after, "batch_size": FANOUT_BATCH_SIZE}).all()
+                if len(follower_ids) == 0:
+                    break
+                result = conn.execute(INSERT_ENTRIES, {**params, "user_ids": follower_ids})
+                FANOUT_ROWS.inc(result.rowcount)
+            after = follower_ids[-1]
+            if len(follower_ids) < FANOUT_BATCH_SIZE:
+                break
+        FANOUT_SECONDS.observe(perf_counter() - start)
+
+    @classmethod
+    def backfill_follow(cls, follower_id: int, followee_id: int):
+        '''
+        Copy a newly followed user's recent posts into the follower's home timeline
+        '''
+        engine = get_sql_engine()
+        with engine.begin() as conn:
+            if conn.execute(IS_HIGH_FANOUT, {"author_id": followee_id}).scalar():
+                # Their posts are merged in at read time
+                return
+            result = conn.execute(BACKFILL_FOLLOW, {
+                "follower_id": follower_id,
+                "followee_id": followee_id,
+                "since": datetime.utcnow() - timedelta(days=HOME_TIMELINE_RETENTION_DAYS),
+                "limit": HOME_TIMELINE_BACKFILL,
+            })
+            FANOUT_ROWS.inc(result.rowcount)
+
+    @classmethod
+    def __start_sweeper(cls):
+        while not cls.stopEvent.is_set():
+            try:
+                cls.sweep()
+            except Exception as e:
+                print(f"Error while sweeping home timelines: {e}")
+                print_exc()
+            cls.stopEvent.wait(HOME_TIMELINE_SWEEP_INTERVAL)
+
+    @classmethod
+    def sweep(cls, batch_size: int = HOME_TIMELINE_SWEEP_BATCH_SIZE):
+        '''
+        Delete home timeline entries older than the retention period, one committed batch at a time
+        '''
+        cutoff = datetime.utcnow() - timedelta(days=HOME_TIMELINE_RETENTION_DAYS)
+        engine = get_sql_engine()
+        deleted = 0
+        while not cls.stopEvent.is_set():
+            with engine.begin() as conn:
+                result = conn.execute(DELETE_OLD_ENTRIES, {"cutoff": cutoff, "batch_size": batch_size})
+            deleted += result.rowcount
+            if result.rowcount < batch_size:
+                break
+        print(f"Home timeline sweep deleted {deleted} entries")
+        return deleted
+
+TIMELINE_COMMANDS.register("fanOutPost", TimelineJobs.fan_out_post)
+TIMELINE_COMMANDS.register("backfillFollow", TimelineJobs.backfill_follow)
@@ -0,0 +1 @@
+curl -X GET 'http://localhost:8080/api/user/availability?username=test01&email=fake@fake.com' -k
@@ -0,0 +1,2 @@
+curl -X POST http://localhost:8080/api/user/2/follow -k --cookie ./cookies
+curl -X GET 'http://localhost:8080/api/post/home?limit=20' -k --cookie ./cookies
@@ -0,0 +1,2 @@
+curl -X GET 'http://localhost:8080/api/post/search?q=hello%20world&limit=20' -k
+curl -X GET 'http://localhost:8080/api/post/search/stats' -k
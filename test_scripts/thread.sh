@@ -0,0 +1,2 @@
+curl -X GET 'http://localhost:8080/api/post/1/thread' -k
+curl -X GET 'http://localhost:8080/api/post/1/thread?depth=2' -k
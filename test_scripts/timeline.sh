@@ -0,0 +1,2 @@
+curl -X GET 'http://localhost:8080/api/post/timeline?limit=20' -k
+curl -X GET 'http://localhost:8080/api/user/1/posts?limit=20' -k